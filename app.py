@@ -5,24 +5,56 @@
 - 接收微信服务器验证请求
 - 处理用户消息
 - 启动定时推送任务
+
+生产环境由 gunicorn 启动（gunicorn -c gunicorn.conf.py app:app）：create_app() 只注册路由，
+建表在主进程执行一次，每个 worker 启动后预热（warm_up），后台任务只在一个 worker 中运行
+（start_background）。开发环境直接 python3 app.py。
 """
 
+import contextlib
 import hashlib
-from flask import Flask, request, abort
-from wechatpy import parse_message, create_reply
+import hmac
+import os
+import time
+from flask import Flask, request, abort, g
 from wechatpy.utils import check_signature
 from wechatpy.exceptions import InvalidSignatureException
 
-from config import WECHAT_TOKEN, FLASK_HOST, FLASK_PORT, FLASK_DEBUG
-from database import init_db
-from wechat_handler import parse_message as handle_message
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境没有 fcntl，单进程运行时直接启动后台任务
+    fcntl = None
+
+import category_matcher
+import maintenance
+import profiler
+import repository
+import slow_query
+from config import (
+    WECHAT_TOKEN, WECHAT_MESSAGE_MODE, WECHAT_ENCODING_AES_KEY, BACKGROUND_LOCK_PATH,
+    FLASK_HOST, FLASK_PORT, FLASK_DEBUG, ADMIN_TOKEN
+)
+from repository import init_db, record_interaction, unsubscribe_user
+from wechat_handler import parse_message as handle_message, command_name
 from scheduler import init_scheduler, shutdown_scheduler
+from wechat_client import get_client
+from wechat_message import (
+    parse_xml, message_event, render_text_reply, decrypt_message, encrypt_reply, MessageCryptoError,
+    get_context,
+)
+
 
+# 会开启 48 小时客服消息窗口的事件（取消关注、模板消息回执等不算）
+INTERACTION_EVENTS = ('subscribe', 'subscribe_scan', 'scan', 'click')
 
-app = Flask(__name__)
+# 本进程的启动耗时：冷启动（进程开始到预热完成）和第一个请求的处理时间，单位毫秒
+startup = {'pid': os.getpid(), 'cold_start_ms': None, 'first_request_ms': None}
+_started_at = time.perf_counter()
+
+# 本进程持有的后台任务锁（没有持有时为 None）
+_background_lock = None
 
 
-@app.route('/wechat', methods=['GET', 'POST'])
 def wechat():
     """微信接口入口"""
     
@@ -43,35 +75,55 @@ def wechat():
             abort(403)
     
     # POST 请求：处理用户消息
+    # 安全模式 / 兼容模式下微信在 URL 中带 encrypt_type=aes 和 msg_signature
+    encrypted = request.args.get('encrypt_type') == 'aes' and WECHAT_MESSAGE_MODE != 'plain'
+    if WECHAT_MESSAGE_MODE == 'safe' and not encrypted:
+        print(f"[微信] 安全模式下收到明文消息，已拒绝")
+        abort(403)
     try:
         check_signature(WECHAT_TOKEN, signature, timestamp, nonce)
     except InvalidSignatureException:
         print(f"[微信] 消息签名验证失败")
         abort(403)
     
-    # 解析消息
-    msg = parse_message(request.data)
-    print(f"[微信] 收到消息: {msg.type} from {msg.source[:8]}...")
+    # 解析消息（密文先校验 msg_signature 再解密）
+    if encrypted:
+        try:
+            msg = decrypt_message(request.data, request.args.get('msg_signature', ''), timestamp, nonce)
+        except MessageCryptoError as e:
+            print(f"[微信] 密文消息处理失败: {e}")
+            abort(403)
+    else:
+        msg = parse_xml(request.data)
+    msg_type = msg.get('MsgType', '').lower()
+    event = message_event(msg)
+    source = msg.get('FromUserName', '')
+    print(f"[微信] 收到消息: {msg_type} from {source[:8]}...")
+    
+    def reply(text: str) -> str:
+        """文本回复（收到密文时加密回复）"""
+        xml = render_text_reply(msg, text)
+        return encrypt_reply(xml, nonce) if encrypted else xml
+    
+    # 取消关注：移出推送队列，无需回复
+    if msg_type == 'event' and event == 'unsubscribe':
+        unsubscribe_user(source)
+        return 'success'
+    
+    # 记录互动时间（用于判断能否发送客服消息）
+    if msg_type != 'event' or event in INTERACTION_EVENTS:
+        record_interaction(source)
     
     # 处理文本消息
-    if msg.type == 'text':
-        # 定义通知回调函数
-        from wechatpy import WeChatClient
-        from config import WECHAT_APP_ID, WECHAT_APP_SECRET
-        client = WeChatClient(WECHAT_APP_ID, WECHAT_APP_SECRET)
-        
-        def notify_callback(target_openid, message):
-            try:
-                client.message.send_text(target_openid, message)
-            except Exception as e:
-                print(f"[通知失败] {target_openid}: {e}")
-
-        response_text = handle_message(msg.source, msg.content, notify_callback=notify_callback)
-        reply = create_reply(response_text, msg)
-        return reply.render()
+    if msg_type == 'text':
+        content = msg.get('Content', '')
+        sampled = profiler.should_profile_request()
+        with profiler.profile(f'wechat-{command_name(content)}') if sampled else contextlib.nullcontext():
+            response_text = handle_message(source, content)
+        return reply(response_text)
     
     # 处理关注事件
-    elif msg.type == 'event' and msg.event == 'subscribe':
+    elif msg_type == 'event' and event in ('subscribe', 'subscribe_scan'):
         welcome = '''👋 欢迎使用记账小助手！
 
 🚀 发送「初始化」开始设置您的贷款和固定开支
@@ -83,16 +135,13 @@ def wechat():
 💡 快速开始：
 • 初始化 - 设置贷款和固定开支
 • 帮助 - 查看所有功能'''
-        reply = create_reply(welcome, msg)
-        return reply.render()
+        return reply(welcome)
     
     # 其他消息类型返回提示
     else:
-        reply = create_reply('暂不支持此类型消息，请发送文字', msg)
-        return reply.render()
+        return reply('暂不支持此类型消息，请发送文字')
 
 
-@app.route('/')
 def index():
     """首页"""
     return '''
@@ -126,10 +175,143 @@ def index():
     '''
 
 
-@app.route('/health')
 def health():
-    """健康检查"""
-    return {'status': 'ok'}
+    """健康检查（附带本进程的启动耗时）"""
+    return {'status': 'ok', 'startup': startup}
+
+
+def _check_admin():
+    """
+    管理接口鉴权：未配置 ADMIN_TOKEN 时接口不存在，令牌不对时拒绝
+
+    令牌只从请求头读取：放在查询参数里会被写进访问日志和代理日志
+    """
+    if not ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        abort(403)
+
+
+def admin_slow_queries():
+    """本进程累计耗时最多的慢查询（?limit=20）"""
+    _check_admin()
+    return {
+        'pid': os.getpid(),
+        'threshold_ms': slow_query.SLOW_QUERY_MS,
+        'statements': slow_query.top(request.args.get('limit', 20, type=int)),
+    }
+
+
+def admin_maintenance():
+    """最近的数据库维护记录：各库页数、空闲页数和各步骤耗时（?limit=20）"""
+    _check_admin()
+    return {'records': maintenance.history(request.args.get('limit', 20, type=int))}
+
+
+def admin_profile():
+    """
+    查看或调整性能剖析
+
+    POST 参数：request_percent（/wechat 文本消息的剖析比例）、push（剖析接下来几次推送）
+    """
+    _check_admin()
+    if request.method == 'POST':
+        settings = profiler.configure(request.values.get('request_percent', type=float),
+                                      request.values.get('push', type=int))
+    else:
+        settings = profiler.configure()
+    return {'pid': os.getpid(), 'settings': settings, 'files': profiler.list_profiles()}
+
+
+def _mark_request_start():
+    g.request_started_at = time.perf_counter()
+
+
+def _record_first_request(response):
+    """记录本进程处理第一个请求的耗时"""
+    if startup['first_request_ms'] is None and 'request_started_at' in g:
+        startup['first_request_ms'] = round((time.perf_counter() - g.request_started_at) * 1000, 1)
+        print(f"[启动] 进程 {os.getpid()} 首个请求耗时 {startup['first_request_ms']}ms")
+    return response
+
+
+def create_app() -> Flask:
+    """创建 Flask 应用（只注册路由，不访问数据库也不启动线程，可在 gunicorn 主进程中预加载）"""
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule('/wechat', view_func=wechat, methods=['GET', 'POST'])
+    flask_app.add_url_rule('/', view_func=index)
+    flask_app.add_url_rule('/health', view_func=health)
+    flask_app.add_url_rule('/admin/slow-queries', view_func=admin_slow_queries)
+    flask_app.add_url_rule('/admin/maintenance', view_func=admin_maintenance)
+    flask_app.add_url_rule('/admin/profile', view_func=admin_profile, methods=['GET', 'POST'])
+    flask_app.before_request(_mark_request_start)
+    flask_app.after_request(_record_first_request)
+    return flask_app
+
+
+def after_fork():
+    """worker 进程 fork 之后调用：重新开始计时"""
+    global _started_at
+    _started_at = time.perf_counter()
+    startup.update(pid=os.getpid(), cold_start_ms=None, first_request_ms=None)
+
+
+def warm_up():
+    """
+    预热本进程的资源，让第一个请求不用承担初始化开销：
+    数据库连接池与分类缓存、微信客户端、分类推断自动机、消息加解密上下文
+    """
+    start = time.perf_counter()
+    repository.warm_up()
+    get_client()
+    category_matcher.get_automaton()
+    if WECHAT_ENCODING_AES_KEY:
+        get_context()
+    now = time.perf_counter()
+    startup['cold_start_ms'] = round((now - _started_at) * 1000, 1)
+    print(f"[启动] 进程 {os.getpid()} 预热耗时 {(now - start) * 1000:.1f}ms，"
+          f"冷启动共 {startup['cold_start_ms']}ms")
+
+
+def start_background() -> bool:
+    """
+    抢到后台任务锁时在本进程启动调度器（推送、家庭汇总、预算预警）
+
+    同一台机器上只有一个进程持有锁；多台机器之间仍由数据库租约协调。
+
+    Returns:
+        是否由本进程运行后台任务
+    """
+    global _background_lock
+    if fcntl is not None:
+        os.makedirs(os.path.dirname(BACKGROUND_LOCK_PATH) or '.', exist_ok=True)
+        lock = open(BACKGROUND_LOCK_PATH, 'a+')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(os.getpid()))
+        lock.flush()
+        _background_lock = lock
+    init_scheduler()
+    print(f"[启动] 后台任务由进程 {os.getpid()} 运行")
+    return True
+
+
+def stop_background():
+    """关闭本进程的调度器并释放后台任务锁"""
+    global _background_lock
+    shutdown_scheduler()
+    if _background_lock is not None:
+        _background_lock.close()
+        _background_lock = None
+
+
+app = create_app()
 
 
 def main():
@@ -141,8 +323,9 @@ def main():
     # 初始化数据库
     init_db()
     
-    # 初始化定时任务
-    init_scheduler()
+    # 预热并启动后台任务
+    warm_up()
+    start_background()
     
     try:
         # 启动 Flask 应用
@@ -153,7 +336,7 @@ def main():
         
         app.run(host=FLASK_HOST, port=FLASK_PORT, debug=FLASK_DEBUG, use_reloader=False)
     finally:
-        shutdown_scheduler()
+        stop_background()
 
 
 if __name__ == '__main__':
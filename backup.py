@@ -0,0 +1,232 @@
+"""
+在线备份模块（SQLite）
+
+服务运行时直接复制库文件可能拷到写了一半的页，对整个库加锁复制又会阻塞 /wechat。
+这里通过 SQLite 的备份接口（sqlite3.Connection.backup）复制全局库和各分库：
+- WAL 模式下先在源库上开一个读事务固定快照：读事务不阻塞写入，复制期间的新写入也不会让备份从头开始；
+  每步复制 BACKUP_STEP_PAGES 页，步间按 BACKUP_RATE_MB MB/s 限速暂停，压缩时同样限速，
+  备份期间的磁盘读写不会挤占消息处理
+- 复制出的快照先执行 PRAGMA integrity_check，通过后 gzip 压缩为
+  BACKUP_DIR/<库名>-<时间>.db.gz，每个库保留最近 BACKUP_KEEP 份；检查不通过时丢弃本次快照，保留旧的备份
+- 非 WAL 模式（SQLITE_WAL=0）下读锁会阻塞写入，且其他连接的写入会让分步备份从头开始，只能一次复制完成
+
+各库分别备份，分库之间不是同一时刻的快照。PostgreSQL 请使用 pg_dump。
+
+手动执行与检查：
+python3 backup.py                                  # 立即备份
+python3 backup.py --verify data/backups/expense-20260101-030000.db.gz
+"""
+
+import argparse
+import gzip
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import database
+from config import DATABASE_BACKEND, BACKUP_DIR, BACKUP_STEP_PAGES, BACKUP_RATE_MB, BACKUP_KEEP
+
+
+# 压缩和解压时每次读写的字节数
+IO_CHUNK = 1024 * 1024
+
+SNAPSHOT_SUFFIX = '.db.gz'
+
+
+def _throttle():
+    """
+    限速器：返回 wait(已处理字节数)，处理速度超过 BACKUP_RATE_MB MB/s 时暂停到限速以内
+
+    BACKUP_RATE_MB 为 0 时不限速
+    """
+    started = time.monotonic()
+    rate = BACKUP_RATE_MB * 1024 * 1024
+
+    def wait(done: int):
+        if rate <= 0:
+            return
+        ahead = done / rate - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+    return wait
+
+
+def _copy(path: str, target_path: str) -> int:
+    """
+    通过备份接口把库复制到 target_path
+
+    Returns:
+        复制的页数
+    """
+    source = sqlite3.connect(path, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        page_size = source.execute('PRAGMA page_size').fetchone()[0]
+        wal = source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        if wal:
+            # 固定读快照：之后其他连接的写入对本连接不可见，备份不会从头开始
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        wait = _throttle()
+        copied = {'pages': 0}
+
+        def on_step(status, remaining, total):
+            copied['pages'] = total
+            # 步间限速暂停；WAL 读事务不阻塞写入，只是检查点要等备份结束后才能越过这个快照
+            if remaining:
+                wait((total - remaining) * page_size)
+
+        source.backup(target, pages=BACKUP_STEP_PAGES if wal else -1, progress=on_step)
+        if wal:
+            source.execute('COMMIT')
+        return copied['pages']
+    finally:
+        target.close()
+        source.close()
+
+
+def check(path: str) -> str:
+    """对库文件执行完整性检查，正常时返回 'ok'，否则返回发现的问题"""
+    conn = sqlite3.connect(path)
+    try:
+        return '; '.join(row[0] for row in conn.execute('PRAGMA integrity_check').fetchall())
+    finally:
+        conn.close()
+
+
+def _compress(path: str, snapshot: str):
+    """限速 gzip 压缩（先写临时文件，完成后改名）"""
+    wait = _throttle()
+    tmp = snapshot + '.tmp'
+    done = 0
+    with open(path, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+        while True:
+            chunk = src.read(IO_CHUNK)
+            if not chunk:
+                break
+            dst.write(chunk)
+            done += len(chunk)
+            wait(done)
+    os.replace(tmp, snapshot)
+
+
+def _remove(path: str):
+    """删除临时快照及 SQLite 可能留下的 -wal / -shm 文件"""
+    for name in (path, path + '-wal', path + '-shm', path + '-journal'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def snapshots(name: str) -> list:
+    """某个库的所有备份文件（按时间从旧到新）"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    prefix = name + '-'
+    # 库名-YYYYmmdd-HHMMSS.db.gz，时间戳定长，按文件名排序即按时间排序
+    return sorted(
+        os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR)
+        if f.startswith(prefix) and f.endswith(SNAPSHOT_SUFFIX)
+        and len(f) - len(prefix) - len(SNAPSHOT_SUFFIX) == 15
+    )
+
+
+def _rotate(name: str) -> int:
+    """只保留最近 BACKUP_KEEP 份，返回删除的份数"""
+    stale = snapshots(name)[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []
+    for path in stale:
+        os.remove(path)
+    return len(stale)
+
+
+def backup_file(path: str, stamp: str = None) -> dict:
+    """
+    备份一个库文件：复制、完整性检查、压缩、轮换
+
+    Returns:
+        {'database', 'snapshot', 'pages', 'bytes', 'compressed_bytes', 'removed', 'ms', 'error'（失败时）}
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    stamp = stamp or datetime.now().strftime('%Y%m%d-%H%M%S')
+    snapshot = os.path.join(BACKUP_DIR, f'{name}-{stamp}{SNAPSHOT_SUFFIX}')
+    partial = os.path.join(BACKUP_DIR, f'.{name}-{stamp}.partial')
+    result = {'database': os.path.basename(path), 'snapshot': None, 'ms': {}}
+    started = time.monotonic()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    try:
+        step = time.monotonic()
+        result['pages'] = _copy(path, partial)
+        result['ms']['copy'] = round((time.monotonic() - step) * 1000, 1)
+
+        step = time.monotonic()
+        status = check(partial)
+        result['ms']['check'] = round((time.monotonic() - step) * 1000, 1)
+        if status != 'ok':
+            result['error'] = f'完整性检查未通过: {status}'
+            return result
+
+        step = time.monotonic()
+        result['bytes'] = os.path.getsize(partial)
+        _compress(partial, snapshot)
+        result['ms']['compress'] = round((time.monotonic() - step) * 1000, 1)
+        result['snapshot'] = snapshot
+        result['compressed_bytes'] = os.path.getsize(snapshot)
+        result['removed'] = _rotate(name)
+    except (sqlite3.Error, OSError) as e:
+        result['error'] = str(e)
+    finally:
+        _remove(partial)
+        result['ms']['total'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+
+def backup_databases() -> list:
+    """
+    备份全局库和各分库（调度器每天执行）
+
+    Returns:
+        每个库的备份结果，PostgreSQL 时为空列表
+    """
+    if DATABASE_BACKEND != 'sqlite':
+        return []
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    results = [backup_file(path, stamp) for path in database.get_database_files()]
+    for item in results:
+        if 'error' in item:
+            print(f"[备份] {item['database']} 失败，保留旧的备份: {item['error']}")
+        else:
+            print(f"[备份] {item['database']}: {item['pages']} 页，{item['bytes']} -> {item['compressed_bytes']} 字节，"
+                  f"删除旧备份 {item['removed']} 份，耗时 {item['ms']}")
+    return results
+
+
+def verify(snapshot: str) -> str:
+    """解压备份文件到临时文件并执行完整性检查，正常时返回 'ok'"""
+    tmp = snapshot + '.verify'
+    try:
+        with gzip.open(snapshot, 'rb') as src, open(tmp, 'wb') as dst:
+            while True:
+                chunk = src.read(IO_CHUNK)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        return check(tmp)
+    finally:
+        _remove(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite 在线备份（不必停服）')
+    parser.add_argument('--verify', metavar='FILE', help='检查一个备份文件')
+    args = parser.parse_args()
+
+    if args.verify:
+        print(verify(args.verify))
+        return
+    results = backup_databases()
+    if any('error' in item for item in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+分类推断模块
+
+记账时分类写成商户或商品名（如「支出 35 星巴克拿铁」），或没写分类只写了备注时，按关键词推断标准分类：
+- 关键词词典（内置 DEFAULT_CATEGORY_KEYWORDS + CATEGORY_KEYWORDS_PATH 指向的 JSON 文件）
+  编译成 Aho-Corasick 自动机，一次扫描找出文本中出现的全部关键词，耗时只与文本长度有关
+- 自动机在首次使用时构建；词典文件修改后由 reload_if_changed()（调度器定时调用）重新加载
+- 多个关键词命中时取最长的（更具体），长度相同取先出现的
+- 用户自己的映射（category_aliases 中的用户别名，合并分类或记账时学习得到）优先于词典
+
+数据库访问见 database._infer_category，本模块只做纯文本匹配。
+"""
+
+import json
+import os
+import threading
+from collections import deque
+
+from config import CATEGORY_KEYWORDS_PATH
+
+
+# 内置关键词词典：{标准分类: [关键词]}，分类名本身也作为关键词
+DEFAULT_CATEGORY_KEYWORDS = {
+    '餐饮': [
+        '星巴克', '瑞幸', '喜茶', '奈雪', '蜜雪冰城', '茶百道', '古茗', '一点点', 'coco',
+        '麦当劳', '肯德基', '汉堡王', '必胜客', '德克士', '赛百味', '达美乐', '海底捞',
+        '西贝', '外婆家', '太二', '呷哺', '老乡鸡', '真功夫', '沙县', '兰州拉面', '黄焖鸡',
+        '美团外卖', '饿了么', '咖啡', '拿铁', '美式', '奶茶', '果茶', '豆浆', '油条', '包子',
+        '煎饼', '面包', '蛋糕', '甜品', '零食', '水果', '烧烤', '火锅', '串串', '麻辣烫',
+        '米线', '拉面', '盖饭', '快餐', '便当', '食堂', '聚餐', '请客', '饮料', '矿泉水',
+        '酸奶', '牛奶', '买菜', '生鲜', '盒马', '叮咚', '朴朴',
+    ],
+    '交通': [
+        '滴滴', '高德打车', '曹操出行', '哈啰', '美团单车', '青桔', '共享单车', '网约车',
+        '的士', '出租', '地铁卡', '公交卡', '一卡通', '12306', '动车', '航班', '携程机票',
+        '加油', '中石化', '中石油', '充电', '停车', '停车费', '过路费', 'etc', '高速',
+        '洗车', '保养', '车险', '船票', '轮渡',
+    ],
+    '购物': [
+        '天猫', '唯品会', '苏宁', '闲鱼', '得物', '抖音商城', '当当', '亚马逊', '优衣库',
+        'zara', 'h&m', '无印良品', '名创优品', '宜家', '屈臣氏', '丝芙兰', '沃尔玛',
+        '家乐福', '永辉', '山姆', '开市客', '大润发', '便利店', '全家便利店', '罗森', '7-11',
+        '衣服', '裤子', '鞋', '包包', '化妆品', '护肤品', '洗发水', '牙膏', '纸巾', '数码',
+        '手机壳', '耳机', '充电器', '家电',
+    ],
+    '娱乐': [
+        '电影票', '猫眼', '淘票票', '万达影城', 'ktv', '唱歌', '酒吧', '剧本杀', '密室',
+        '桌游', '网吧', '演唱会', '话剧', '展览', '门票', '景区', '酒店', '民宿', '爱奇艺',
+        '腾讯视频', '优酷', '芒果tv', 'b站', '网易云', 'qq音乐', 'steam', 'switch', '健身',
+        '游泳', '球馆',
+    ],
+    '居住': [
+        '物业', '物业费', '电费', '水费', '燃气费', '暖气', '供暖', '网费', '房贷', '租金',
+        '中介费', '维修', '保洁', '家政', '搬家',
+    ],
+    '医疗': [
+        '药店', '药房', '挂号', '门诊', '体检', '牙医', '口腔', '眼镜', '医保', '感冒药',
+        '疫苗', '住院',
+    ],
+    '通讯': [
+        '话费', '充话费', '流量包', '中国移动', '中国联通', '中国电信', '宽带费',
+    ],
+    '教育': [
+        '学费', '培训', '课程', '网课', '书店', '买书', '教材', '文具', '考试', '报名费',
+        '知乎会员',
+    ],
+    '人情': [
+        '红包', '份子钱', '礼金', '随礼', '礼物', '孝敬', '压岁钱',
+    ],
+}
+
+
+# 当前使用的自动机（整体替换，读取时无需加锁）
+_automaton = None
+_loaded_mtime = None
+_reload_lock = threading.Lock()
+
+
+def build_automaton(keywords: dict) -> dict:
+    """
+    把关键词编译成 Aho-Corasick 自动机
+
+    Args:
+        keywords: {关键词: 分类}，关键词不区分大小写
+
+    Returns:
+        {'goto': [{字符: 状态}], 'fail': [状态], 'output': [(关键词长度, 分类) 或 None]}
+        output 记录以该状态结尾的最长关键词（含失败链上的后缀）
+    """
+    goto = [{}]
+    fail = [0]
+    output = [None]
+    for word, category in keywords.items():
+        word = word.strip().lower()
+        if not word:
+            continue
+        node = 0
+        for ch in word:
+            nxt = goto[node].get(ch)
+            if nxt is None:
+                goto.append({})
+                fail.append(0)
+                output.append(None)
+                nxt = len(goto) - 1
+                goto[node][ch] = nxt
+            node = nxt
+        output[node] = (len(word), category)
+
+    # 按层构建失败指针，自身没有关键词的状态继承失败链上最长的后缀关键词
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for ch, nxt in goto[node].items():
+            queue.append(nxt)
+            state = fail[node]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            fail[nxt] = goto[state].get(ch, 0)
+            if output[nxt] is None:
+                output[nxt] = output[fail[nxt]]
+
+    return {'goto': goto, 'fail': fail, 'output': output}
+
+
+def match_category(automaton: dict, text: str) -> str:
+    """在文本中查找关键词，返回最长关键词对应的分类，没有命中时返回 None"""
+    goto, fail, output = automaton['goto'], automaton['fail'], automaton['output']
+    node = 0
+    best = None
+    for ch in (text or '').lower():
+        while node and ch not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(ch, 0)
+        found = output[node]
+        if found and (best is None or found[0] > best[0]):
+            best = found
+    return best[1] if best else None
+
+
+def load_keywords(path: str = None) -> dict:
+    """
+    合并内置词典与词典文件
+
+    词典文件格式与 DEFAULT_CATEGORY_KEYWORDS 相同（{分类: [关键词]}），同一关键词以文件为准。
+
+    Returns:
+        {关键词: 分类}
+    """
+    path = CATEGORY_KEYWORDS_PATH if path is None else path
+    sources = [DEFAULT_CATEGORY_KEYWORDS]
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            sources.append(json.load(f))
+
+    keywords = {}
+    for source in sources:
+        for category, words in source.items():
+            keywords[category.lower()] = category
+            for word in words:
+                keywords[word.lower()] = category
+    return keywords
+
+
+def _file_mtime(path: str) -> float:
+    return os.path.getmtime(path) if path and os.path.exists(path) else None
+
+
+def reload_keywords(path: str = None) -> int:
+    """
+    重新加载词典并替换自动机
+
+    Returns:
+        关键词数量
+    """
+    global _automaton, _loaded_mtime
+    path = CATEGORY_KEYWORDS_PATH if path is None else path
+    with _reload_lock:
+        mtime = _file_mtime(path)
+        keywords = load_keywords(path)
+        _automaton = build_automaton(keywords)
+        _loaded_mtime = mtime
+    print(f"[分类推断] 已加载关键词 {len(keywords)} 个")
+    return len(keywords)
+
+
+def reload_if_changed() -> bool:
+    """词典文件新增、修改或删除后重新加载（调度器定时调用）"""
+    if _automaton is None or _file_mtime(CATEGORY_KEYWORDS_PATH) != _loaded_mtime:
+        reload_keywords()
+        return True
+    return False
+
+
+def get_automaton() -> dict:
+    """获取当前自动机（首次使用时构建）"""
+    if _automaton is None:
+        reload_keywords()
+    return _automaton
+
+
+def infer_category(text: str, learned: dict = None) -> str:
+    """
+    推断文本所属的标准分类
+
+    Args:
+        text: 分类词或备注
+        learned: 用户学习到的映射 {别名: 分类名}，作为子串匹配时优先于词典
+
+    Returns:
+        分类名，无法推断时返回 None
+    """
+    text = (text or '').strip()
+    if not text:
+        return None
+    if learned:
+        lowered = text.lower()
+        hits = [alias for alias in learned if alias.lower() in lowered]
+        if hits:
+            return learned[max(hits, key=len)]
+    return match_category(get_automaton(), text)
@@ -0,0 +1,128 @@
+"""
+查询成本控制模块
+
+历史、搜索、统计的天数由用户输入，窗口越长扫描的记录越多，少数重查询会占满 worker，
+让同一时间的记账请求也跟着变慢。这里在执行前估算成本：
+- 天数截断到 MAX_QUERY_DAYS（超长的天数没有意义，也会让日期计算溢出）
+- 估算扫描行数 = 本月日均记账笔数 × 天数，笔数读取月累计（一次主键查询）
+- 估算不超过 HEAVY_READ_ROWS 的查询直接在请求线程执行；更重的交给有界线程池
+  （HEAVY_READ_WORKERS 个线程），同时最多 HEAVY_READ_QUEUE 个在排队或执行
+- 队列已满时改按默认天数直接查询；默认天数仍然很重时拒绝（Overloaded）
+- 等待超过 HEAVY_READ_TIMEOUT 秒时放弃等待（微信要求 5 秒内回复），查询在后台执行完毕后丢弃
+
+记账（支出/收入）不经过这里，重查询再多也只占用线程池中的线程。
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from config import (
+    MAX_QUERY_DAYS, HEAVY_READ_ROWS, HEAVY_READ_WORKERS, HEAVY_READ_QUEUE, HEAVY_READ_TIMEOUT
+)
+from repository import get_month_activity
+
+
+# 重查询线程池（首次使用时创建，fork 之后的子进程重新创建）及排队中的查询数
+_pool = {'executor': None, 'pid': None}
+_state = {'pending': 0, 'shed': 0, 'degraded': 0, 'timeouts': 0}
+_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    """重查询过多，本次查询被拒绝"""
+    pass
+
+
+def clamp_days(days: int) -> int:
+    """把用户输入的天数限制在 1 ~ MAX_QUERY_DAYS"""
+    return max(1, min(days, MAX_QUERY_DAYS))
+
+
+def daily_rate(openid: str) -> float:
+    """本月日均记账笔数"""
+    activity = get_month_activity(openid)
+    return activity['entries'] / max(activity['days'], 1)
+
+
+def estimate_rows(openid: str, days: int, rate: float = None) -> int:
+    """估算查询最近 days 天需要扫描的记录数"""
+    if rate is None:
+        rate = daily_rate(openid)
+    return int(rate * days)
+
+
+def _executor() -> ThreadPoolExecutor:
+    with _lock:
+        if _pool['executor'] is None or _pool['pid'] != os.getpid():
+            _pool.update(executor=ThreadPoolExecutor(max_workers=HEAVY_READ_WORKERS,
+                                                     thread_name_prefix='heavy-read'),
+                         pid=os.getpid())
+        return _pool['executor']
+
+
+def _run(fn, days: int):
+    try:
+        return fn(days)
+    finally:
+        with _lock:
+            _state['pending'] -= 1
+
+
+def run_read(openid: str, days: int, default_days: int, fn) -> tuple:
+    """
+    按成本执行查询
+
+    Args:
+        days: 用户请求的天数
+        default_days: 指令的默认天数，过载时退回到这个窗口
+        fn: 查询函数 (天数) -> 结果
+
+    Returns:
+        (结果, 实际查询的天数)
+
+    Raises:
+        Overloaded: 重查询过多或等待超时
+    """
+    days = clamp_days(days)
+    rate = daily_rate(openid)
+    if estimate_rows(openid, days, rate) <= HEAVY_READ_ROWS:
+        return fn(days), days
+
+    with _lock:
+        shed = _state['pending'] >= HEAVY_READ_QUEUE
+        if not shed:
+            _state['pending'] += 1
+    if shed:
+        if days > default_days and estimate_rows(openid, default_days, rate) <= HEAVY_READ_ROWS:
+            with _lock:
+                _state['degraded'] += 1
+            print(f"[查询控制] 重查询排队已满，{openid} 的 {days} 天查询缩短为 {default_days} 天")
+            return fn(default_days), default_days
+        with _lock:
+            _state['shed'] += 1
+        print(f"[查询控制] 重查询排队已满，拒绝 {openid} 的 {days} 天查询")
+        raise Overloaded(f'重查询排队已满（{HEAVY_READ_QUEUE}）')
+
+    future = _executor().submit(_run, fn, days)
+    try:
+        return future.result(timeout=HEAVY_READ_TIMEOUT), days
+    except TimeoutError:
+        with _lock:
+            _state['timeouts'] += 1
+        print(f"[查询控制] {openid} 的 {days} 天查询超过 {HEAVY_READ_TIMEOUT:g} 秒")
+        raise Overloaded(f'查询超过 {HEAVY_READ_TIMEOUT:g} 秒')
+
+
+def stats() -> dict:
+    """排队中的重查询数，以及缩短、拒绝、超时的累计次数"""
+    with _lock:
+        return dict(_state)
+
+
+def shutdown():
+    """关闭线程池（进程退出前调用）"""
+    with _lock:
+        if _pool['executor'] is not None and _pool['pid'] == os.getpid():
+            _pool['executor'].shutdown(wait=False)
+        _pool.update(executor=None, pid=None)
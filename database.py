@@ -2,13 +2,69 @@
 SQLite 数据库操作模块
 
 提供用户和记账记录的 CRUD 操作
+
+存储分为全局库和分库：
+- 全局库（DATABASE_PATH）：用户、家庭、家庭成员、分类字典
+- 分库：每个用户的记账记录、固定开支、预算，按 openid 稳定哈希路由
+DATABASE_SHARDS 为 1 时分库即全局库，所有数据都在同一个文件中。
 """
 
+import calendar
 import sqlite3
 import os
-from datetime import datetime, date
+import random
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
 from contextlib import contextmanager
-from config import DATABASE_PATH
+
+import category_matcher
+import hot_cache
+import journal
+import slow_query
+from config import (
+    DATABASE_PATH, DATABASE_SHARDS, DAILY_PUSH_HOUR, DAILY_PUSH_MINUTE, PUSH_JITTER_SECONDS,
+    BUDGET_ALERT_THRESHOLDS, SLOW_QUERY_ENABLED, SQLITE_WAL, BILLING_CHUNK, BILLING_CATCHUP_MONTHS
+)
+
+
+# 全局分类别名：常见口语说法归并到标准分类，init_db 时写入 category_aliases
+DEFAULT_CATEGORY_ALIASES = {
+    '餐饮': ['吃饭', '早饭', '午饭', '晚饭', '早餐', '午餐', '晚餐', '夜宵', '外卖', '饭钱'],
+    '交通': ['打车', '地铁', '公交', '滴滴', '出租车', '高铁', '火车票', '机票'],
+    '购物': ['网购', '淘宝', '京东', '拼多多', '日用品'],
+    '娱乐': ['电影', '游戏', '旅游'],
+    '居住': ['房租', '水电', '水电费', '燃气', '宽带'],
+    '医疗': ['看病', '买药', '医院'],
+    '工资': ['薪水', '薪资', '月薪'],
+}
+
+# 有还款期限的固定开支类型：按期数计算结束日期，到期后由夜间任务停用并通知「恭喜还清」；
+# 固定开支（fixed）的月数是摊销周期（如年费分 12 个月），到期后续费，不设结束日期
+TERM_TYPES = ('loan', 'debt')
+
+# 固定开支按月自动入账时使用的分类
+RECURRING_CATEGORIES = {'loan': '还贷', 'debt': '还款', 'fixed': '固定开支'}
+
+# 分类驻留缓存：分类只增不改，名称与 id 的映射可在进程内长期缓存
+_category_ids = {}
+_category_names = {}
+# 事务中新建、尚未提交的分类 {id(连接): {分类 id: 名称}}：提交后才写入上面的缓存，回滚或关闭连接时丢弃
+_uncommitted_categories = {}
+# 事务中待写入变更日志的记录 {id(连接): [(操作, 字段)]}：由 _commit() 提交后追加，回滚时丢弃
+_pending_journal = {}
+# 全局别名缓存（仅 init_db 写入，运行期只读）；用户别名可被合并修改，始终查库
+_global_category_aliases = None
+
+# 用户哈希桶数量：推送分区按桶区间划分，桶号在用户创建时写入并建索引
+USER_BUCKETS = 1024
+
+# 跨分库查询线程池（首次使用时创建，避免在 gunicorn fork 之前启动线程）
+_shard_executor = None
+_shard_executor_lock = threading.Lock()
 
 
 def get_db_path():
@@ -19,112 +75,792 @@ def get_db_path():
     return DATABASE_PATH
 
 
+def get_shard_index(openid: str, shards: int = None) -> int:
+    """按 openid 的 CRC32 计算分库编号（跨进程、跨重启稳定）"""
+    shards = shards or DATABASE_SHARDS
+    return zlib.crc32(openid.encode('utf-8')) % shards
+
+
+def get_user_bucket(openid: str) -> int:
+    """按 openid 的 CRC32 计算用户哈希桶（0 ~ USER_BUCKETS-1）"""
+    return zlib.crc32(openid.encode('utf-8')) % USER_BUCKETS
+
+
+def get_shard_path(shard: int, shards: int = None) -> str:
+    """获取分库文件路径，只有一个分库时即全局库"""
+    shards = shards or DATABASE_SHARDS
+    db_path = get_db_path()
+    if shards <= 1:
+        return db_path
+    base, ext = os.path.splitext(db_path)
+    return f'{base}_shard{shard:02d}{ext}'
+
+
+def get_database_files() -> list:
+    """全局库和各分库的文件路径（只有一个分库时即全局库）"""
+    paths = [get_db_path()]
+    for shard in range(DATABASE_SHARDS):
+        path = get_shard_path(shard)
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
 @contextmanager
-def get_connection():
-    """获取数据库连接的上下文管理器"""
-    conn = sqlite3.connect(get_db_path())
+def get_connection(openid: str = None, shard: int = None):
+    """
+    获取数据库连接的上下文管理器
+
+    不带参数时连接全局库；传入 openid 或分库编号时连接对应分库
+    """
+    if openid is not None:
+        shard = get_shard_index(openid)
+    path = get_db_path() if shard is None else get_shard_path(shard)
+    conn = sqlite3.connect(path, factory=slow_query.Connection if SLOW_QUERY_ENABLED else sqlite3.Connection)
     conn.row_factory = sqlite3.Row
     try:
         yield conn
     finally:
+        _uncommitted_categories.pop(id(conn), None)
+        _pending_journal.pop(id(conn), None)
         conn.close()
 
 
+def _placeholders(values) -> str:
+    """生成 IN 查询的参数占位符"""
+    return ', '.join('?' * len(values))
+
+
+def _fan_out(openids, query) -> list:
+    """
+    按分库分组并行执行查询，合并各分库返回的行
+
+    Args:
+        openids: 需要查询的用户 OpenID
+        query: 回调函数 (cursor, 同一分库内的 openid 列表) -> 行列表
+    """
+    global _shard_executor
+    groups = {}
+    for openid in openids:
+        groups.setdefault(get_shard_index(openid), []).append(openid)
+
+    def run(shard):
+        with get_connection(shard=shard) as conn:
+            return query(conn.cursor(), groups[shard])
+
+    if len(groups) <= 1:
+        results = [run(shard) for shard in groups]
+    else:
+        with _shard_executor_lock:
+            if _shard_executor is None:
+                _shard_executor = ThreadPoolExecutor(
+                    max_workers=DATABASE_SHARDS, thread_name_prefix='shard'
+                )
+        results = list(_shard_executor.map(run, groups))
+    return [row for rows in results for row in rows]
+
+
+def warm_up():
+    """预热进程内缓存（分类名称、全局别名），在 worker 启动后、处理第一个请求前调用"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name FROM categories')
+        for row in cursor.fetchall():
+            _category_ids[row['name']] = row['id']
+            _category_names[row['id']] = row['name']
+        _get_global_aliases(cursor)
+
+
+def close_pool():
+    """关闭跨分库查询线程池（进程 fork 之后或退出前调用；SQLite 连接按需建立，无需关闭）"""
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is not None:
+            _shard_executor.shutdown(wait=False)
+            _shard_executor = None
+
+
 def init_db():
-    """初始化数据库表"""
+    """初始化数据库表（全局库及所有分库）"""
     with get_connection() as conn:
+        init_storage(conn)
         cursor = conn.cursor()
-        
-        # 创建用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                openid TEXT PRIMARY KEY,
-                nickname TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 创建记账记录表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                openid TEXT NOT NULL,
-                type TEXT NOT NULL,
-                amount REAL NOT NULL,
-                category TEXT,
-                description TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (openid) REFERENCES users(openid)
-            )
-        ''')
-        
-        # 创建固定开支/贷款表（支持总额+月数计算）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS recurring_expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                openid TEXT NOT NULL,
-                type TEXT NOT NULL,
-                name TEXT NOT NULL,
-                total_amount REAL,
-                total_months INTEGER,
-                monthly_amount REAL NOT NULL,
-                start_date DATE,
-                end_date DATE,
-                is_active INTEGER DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (openid) REFERENCES users(openid)
-            )
-        ''')
-
-        # 创建家庭组表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS families (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                invite_code TEXT UNIQUE NOT NULL,
-                creator_openid TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (creator_openid) REFERENCES users(openid)
-            )
-        ''')
-
-        # 创建家庭成员表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS family_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                family_id INTEGER NOT NULL,
-                openid TEXT NOT NULL,
-                role TEXT DEFAULT 'member', -- 'creator' or 'member'
-                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(family_id, openid),
-                FOREIGN KEY (family_id) REFERENCES families(id),
-                FOREIGN KEY (openid) REFERENCES users(openid)
-            )
-        ''')
-        
-        # 创建预算表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS budgets (
-                openid TEXT PRIMARY KEY,
-                monthly_amount REAL NOT NULL,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (openid) REFERENCES users(openid)
-            )
-        ''')
-        
-        conn.commit()
+        _init_global_tables(cursor)
+        _commit(conn)
+
+        for shard in range(DATABASE_SHARDS):
+            if get_shard_path(shard) == get_db_path():
+                _init_shard_tables(cursor, cursor)
+            else:
+                with get_connection(shard=shard) as shard_conn:
+                    init_storage(shard_conn)
+                    _init_shard_tables(shard_conn.cursor(), cursor)
+                    shard_conn.commit()
+            _commit(conn)
+
         print("数据库初始化完成")
 
 
+def init_storage(conn):
+    """
+    设置库文件的存储方式（保存在文件中，对之后的所有连接生效）
+
+    - auto_vacuum = INCREMENTAL：删除数据后的空闲页由维护任务分步归还（maintenance.py）；
+      新建的库立即生效，已有数据的库需要 VACUUM 一次，由维护任务在低峰期完成
+    - journal_mode = WAL：读写互不阻塞，检查点由 SQLite 自动执行，维护任务在低峰期截断 WAL 文件
+    """
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    if SQLITE_WAL:
+        conn.execute('PRAGMA journal_mode = WAL')
+
+
+def _init_global_tables(cursor):
+    """创建全局库表：用户、家庭、分类字典、调度协调"""
+    # 创建用户表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            openid TEXT PRIMARY KEY,
+            nickname TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            push_bucket INTEGER,
+            last_push_date TEXT,
+            push_time TEXT,              -- 'HH:MM'，NULL 表示默认推送时间
+            push_enabled INTEGER DEFAULT 1,
+            next_push_at REAL,           -- 下一次推送时间戳，关闭推送或无法触达时为 NULL
+            subscribed INTEGER DEFAULT 1,
+            last_interaction_at REAL     -- 最近一次主动互动（消息/关注/菜单）的时间戳
+        )
+    ''')
+    _ensure_column(cursor, 'users', 'push_bucket', 'INTEGER')
+    _ensure_column(cursor, 'users', 'last_push_date', 'TEXT')
+    _ensure_column(cursor, 'users', 'push_time', 'TEXT')
+    _ensure_column(cursor, 'users', 'push_enabled', 'INTEGER DEFAULT 1')
+    _ensure_column(cursor, 'users', 'next_push_at', 'REAL')
+    _ensure_column(cursor, 'users', 'subscribed', 'INTEGER DEFAULT 1')
+    _ensure_column(cursor, 'users', 'last_interaction_at', 'REAL')
+    cursor.execute('SELECT openid FROM users WHERE push_bucket IS NULL')
+    cursor.executemany('UPDATE users SET push_bucket = ? WHERE openid = ?', [
+        (get_user_bucket(row['openid']), row['openid']) for row in cursor.fetchall()
+    ])
+    cursor.execute('''
+        SELECT openid, push_time, last_push_date FROM users
+        WHERE next_push_at IS NULL AND push_enabled = 1 AND subscribed = 1
+    ''')
+    cursor.executemany('UPDATE users SET next_push_at = ? WHERE openid = ?', [
+        (_next_push_at(row['push_time'], row['last_push_date']), row['openid'])
+        for row in cursor.fetchall()
+    ])
+    # 推送队列：按到期时间扫描，附带哈希桶用于分区过滤
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_next_push ON users(next_push_at, push_bucket)
+    ''')
+
+    # 创建调度租约表（多进程/多机选举领导者）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+    # 创建推送分区任务表（任何进程都可领取，租约过期后可被接手）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS push_tasks (
+            run_key TEXT NOT NULL,
+            partition_no INTEGER NOT NULL,
+            partitions INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending' or 'running'
+            holder TEXT,
+            lease_until REAL,
+            finished_at REAL,
+            due_at REAL,                             -- 分区内最早的推送时间，NULL 表示无人待推送
+            PRIMARY KEY (run_key, partition_no)
+        )
+    ''')
+    _ensure_column(cursor, 'push_tasks', 'due_at', 'REAL')
+    
+    # 创建分类字典表（expenses 只存整数 category_id）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL
+        )
+    ''')
+
+    # 创建分类别名表（openid 为空字符串表示全局别名）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_aliases (
+            openid TEXT NOT NULL DEFAULT '',
+            alias TEXT NOT NULL,
+            category_id INTEGER NOT NULL,
+            PRIMARY KEY (openid, alias),
+            FOREIGN KEY (category_id) REFERENCES categories(id)
+        )
+    ''')
+    
+    # 创建家庭组表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS families (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            invite_code TEXT UNIQUE NOT NULL,
+            creator_openid TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (creator_openid) REFERENCES users(openid)
+        )
+    ''')
+
+    # 创建家庭成员表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS family_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            family_id INTEGER NOT NULL,
+            openid TEXT NOT NULL,
+            role TEXT DEFAULT 'member', -- 'creator' or 'member'
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(family_id, openid),
+            FOREIGN KEY (family_id) REFERENCES families(id),
+            FOREIGN KEY (openid) REFERENCES users(openid)
+        )
+    ''')
+    
+    # 创建家庭通知发件箱（成员连续记账时合并成一条汇总通知）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS family_notify_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            family_id INTEGER NOT NULL,
+            openid TEXT NOT NULL,
+            category TEXT,
+            amount REAL NOT NULL,
+            description TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_family_outbox_family
+        ON family_notify_outbox(family_id, created_at)
+    ''')
+
+    # 创建家庭预算表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS family_budgets (
+            family_id INTEGER PRIMARY KEY,
+            monthly_amount REAL NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (family_id) REFERENCES families(id)
+        )
+    ''')
+
+    # 创建家庭月累计支出表（成员记账时累加，成员变动时清除后按成员月累计重算）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS family_month_totals (
+            family_id INTEGER NOT NULL,
+            month TEXT NOT NULL,         -- 'YYYY-MM'
+            expense REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (family_id, month)
+        )
+    ''')
+
+    # 创建预算预警表（每个预算每月每个阈值一行，sent_at 为空表示待发送）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budget_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,         -- 'user' or 'family'
+            scope_id TEXT NOT NULL,      -- openid 或家庭 id
+            month TEXT NOT NULL,
+            threshold INTEGER NOT NULL,  -- 百分比
+            spent REAL NOT NULL,
+            budget REAL NOT NULL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            UNIQUE(scope, scope_id, month, threshold)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_budget_alerts_pending ON budget_alerts(sent_at, id)
+    ''')
+    
+    # 写入全局分类别名
+    for name, aliases in DEFAULT_CATEGORY_ALIASES.items():
+        category_id = _intern_category(cursor, name)
+        cursor.executemany('''
+            INSERT OR IGNORE INTO category_aliases (openid, alias, category_id)
+            VALUES ('', ?, ?)
+        ''', [(alias, category_id) for alias in aliases])
+    global _global_category_aliases
+    _global_category_aliases = None
+
+
+def _init_shard_tables(cursor, global_cursor):
+    """
+    创建分库表：记账记录、固定开支、预算、月累计、全文索引，并补齐旧数据
+
+    Args:
+        cursor: 分库游标
+        global_cursor: 全局库游标（解析分类用）
+    """
+    # 创建记账记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            openid TEXT NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            category TEXT,
+            description TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            category_id INTEGER REFERENCES categories(id),
+            FOREIGN KEY (openid) REFERENCES users(openid)
+        )
+    ''')
+    _ensure_column(cursor, 'expenses', 'category_id', 'INTEGER REFERENCES categories(id)')
+
+    # 创建固定开支/贷款表（支持总额+月数计算）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recurring_expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            openid TEXT NOT NULL,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            total_amount REAL,
+            total_months INTEGER,
+            monthly_amount REAL NOT NULL,
+            start_date DATE,
+            end_date DATE,
+            is_active INTEGER DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (openid) REFERENCES users(openid)
+        )
+    ''')
+
+    # 创建预算表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS budgets (
+            openid TEXT PRIMARY KEY,
+            monthly_amount REAL NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (openid) REFERENCES users(openid)
+        )
+    ''')
+
+    # 创建月累计表（记账时在同一事务内累加，按月份分行，跨月自然从零开始）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS month_totals (
+            openid TEXT NOT NULL,
+            month TEXT NOT NULL,         -- 'YYYY-MM'
+            expense REAL NOT NULL DEFAULT 0,
+            income REAL NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,  -- 本月记账笔数（查询成本估算用）
+            PRIMARY KEY (openid, month)
+        )
+    ''')
+    _ensure_column(cursor, 'month_totals', 'entries', 'INTEGER NOT NULL DEFAULT 0')
+
+    # 创建固定开支入账表：每个分期每月只入账一次，(recurring_id, period) 为主键，
+    # 入账时先在这里认领，再在同一事务内写入记账记录
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recurring_postings (
+            recurring_id INTEGER NOT NULL,
+            period TEXT NOT NULL,        -- 'YYYY-MM'
+            openid TEXT NOT NULL,
+            amount REAL NOT NULL,
+            expense_id INTEGER,          -- 对应的记账记录
+            posted_at REAL NOT NULL,
+            PRIMARY KEY (recurring_id, period)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_recurring_postings_openid ON recurring_postings(openid, period)
+    ''')
+
+    # 创建记账全文索引（rowid 对应 expenses.id，分别存放单字和双字词元）
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+            unigrams, bigrams
+        )
+    ''')
+
+    # 旧记录的分类文本转换为 category_id（按全局别名归并）
+    cursor.execute('''
+        SELECT DISTINCT category FROM expenses
+        WHERE category_id IS NULL AND category IS NOT NULL
+    ''')
+    for name in [row['category'] for row in cursor.fetchall()]:
+        category_id = _resolve_category(global_cursor, '', name)
+        if _category_name(global_cursor, category_id) != name:
+            # 归并后分类名变化，删除旧索引以便下面按新名称重建
+            cursor.execute('''
+                DELETE FROM expenses_fts WHERE rowid IN (
+                    SELECT id FROM expenses WHERE category_id IS NULL AND category = ?
+                )
+            ''', (name,))
+        cursor.execute('''
+            UPDATE expenses SET category_id = ?, category = NULL
+            WHERE category_id IS NULL AND category = ?
+        ''', (category_id, name))
+
+    # 为尚未建立索引的历史记录补建全文索引
+    cursor.execute('''
+        SELECT id, category, category_id, description FROM expenses
+        WHERE id NOT IN (SELECT rowid FROM expenses_fts)
+    ''')
+    for row in cursor.fetchall():
+        category = row['category'] or _category_name(global_cursor, row['category_id'])
+        _index_expense(cursor, row['id'], category, row['description'])
+
+
+def _ensure_column(cursor, table: str, column: str, definition: str):
+    """为已有表补充新增列（CREATE TABLE IF NOT EXISTS 不会修改旧表结构）"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _intern_category(cursor, name: str) -> int:
+    """
+    获取分类 id，不存在时创建（结果驻留在进程缓存中）
+
+    本事务新建的分类先记在 _uncommitted_categories，由 _commit() 提交后再写入缓存，
+    事务回滚时缓存里不会留下不存在的 id。
+    """
+    category_id = _category_ids.get(name)
+    if category_id is None:
+        cursor.execute('INSERT OR IGNORE INTO categories (name) VALUES (?)', (name,))
+        created = cursor.rowcount > 0
+        cursor.execute('SELECT id FROM categories WHERE name = ?', (name,))
+        category_id = cursor.fetchone()['id']
+        key = id(cursor.connection)
+        if created or category_id in _uncommitted_categories.get(key, {}):
+            _uncommitted_categories.setdefault(key, {})[category_id] = name
+        else:
+            _category_ids[name] = category_id
+            _category_names[category_id] = name
+    return category_id
+
+
+def _commit(conn):
+    """提交事务，再把本事务新建的分类写入进程缓存，并追加新建分类和学习别名的变更日志"""
+    conn.commit()
+    created = _uncommitted_categories.pop(id(conn), {})
+    for category_id, name in created.items():
+        _category_ids[name] = category_id
+        _category_names[category_id] = name
+    if created:
+        journal.append_many('add_category', list(created.items()))
+    for op, values in _pending_journal.pop(id(conn), []):
+        journal.append(op, *values)
+
+
+def _category_name(cursor, category_id: int) -> str:
+    """根据分类 id 获取名称（cursor 为全局库游标，为 None 时缓存未命中才建立连接）"""
+    if category_id is None:
+        return None
+    name = _category_names.get(category_id)
+    if name is None:
+        if cursor is None:
+            with get_connection() as conn:
+                return _category_name(conn.cursor(), category_id)
+        uncommitted = _uncommitted_categories.get(id(cursor.connection), {})
+        if category_id in uncommitted:
+            return uncommitted[category_id]
+        cursor.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
+        row = cursor.fetchone()
+        if row:
+            name = row['name']
+            _category_ids[name] = category_id
+            _category_names[category_id] = name
+    return name
+
+
+def _find_category(cursor, openid: str, name: str):
+    """按 用户别名 > 全局别名 > 分类原名 的顺序查找已有的分类 id，找不到时为 None（不新建分类）"""
+    cursor.execute('''
+        SELECT category_id FROM category_aliases WHERE openid = ? AND alias = ?
+    ''', (openid, name))
+    row = cursor.fetchone()
+    if row:
+        return row['category_id']
+
+    category_id = _get_global_aliases(cursor).get(name)
+    if category_id is not None:
+        return category_id
+
+    category_id = _category_ids.get(name)
+    if category_id is None:
+        cursor.execute('SELECT id FROM categories WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        category_id = row['id'] if row else None
+    return category_id
+
+
+def _resolve_category(cursor, openid: str, name: str) -> int:
+    """按 用户别名 > 全局别名 > 分类原名 的顺序解析分类 id，都没有时新建分类"""
+    name = (name or '').strip() or '其他'
+    category_id = _find_category(cursor, openid, name)
+    return _intern_category(cursor, name) if category_id is None else category_id
+
+
+def _get_global_aliases(cursor) -> dict:
+    """全局别名 {别名: 分类 id}（进程内缓存）"""
+    global _global_category_aliases
+    if _global_category_aliases is None:
+        cursor.execute("SELECT alias, category_id FROM category_aliases WHERE openid = ''")
+        _global_category_aliases = {row['alias']: row['category_id'] for row in cursor.fetchall()}
+    return _global_category_aliases
+
+
+def _learnable(text: str) -> bool:
+    """备注是否适合学习为别名（单个较短的词，而不是一句话）"""
+    return bool(text) and re.fullmatch(r'[^\W_]{2,12}', text) is not None
+
+
+def _infer_category(cursor, openid: str, name: str, text: str = None) -> tuple:
+    """
+    记账分类推断（cursor 为全局库游标）
+
+    顺序：别名精确匹配 > 用户别名（子串）> 关键词词典 > 分类原名；
+    没写分类时从备注推断，推断不出为「其他」。明确写了分类时，把较短的备注学习为用户别名，
+    以后只写这个词也能归到同一分类。
+
+    Returns:
+        (分类 id, 是否为推断结果)
+    """
+    name = (name or '').strip()
+    cursor.execute('SELECT alias, category_id FROM category_aliases WHERE openid = ?', (openid,))
+    user_aliases = {row['alias']: row['category_id'] for row in cursor.fetchall()}
+
+    inferred = None
+    if name not in user_aliases and name not in _get_global_aliases(cursor):
+        learned = {alias: _category_name(cursor, category_id)
+                   for alias, category_id in user_aliases.items()}
+        inferred = category_matcher.infer_category(name or text, learned)
+    category_id = _resolve_category(cursor, openid, inferred or name)
+
+    if name and inferred in (None, name) and _learnable(text) and user_aliases.get(text) != category_id:
+        cursor.execute('''
+            INSERT OR REPLACE INTO category_aliases (openid, alias, category_id) VALUES (?, ?, ?)
+        ''', (openid, text, category_id))
+        # 提交后由 _commit() 写入变更日志
+        _pending_journal.setdefault(id(cursor.connection), []).append(
+            ('learn_alias', (openid, text, category_id))
+        )
+    return category_id, inferred not in (None, name)
+
+
+def infer_category(openid: str, name: str, text: str = None) -> tuple:
+    """
+    推断记账分类（见 _infer_category）
+
+    Returns:
+        (分类 id, 标准分类名称, 是否为推断结果)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        category_id, inferred = _infer_category(cursor, openid, name, text)
+        category = _category_name(cursor, category_id)
+        _commit(conn)
+        return category_id, category, inferred
+
+
+def _attach_category_names(records: list) -> list:
+    """根据记录中的 category_id 填充 category 名称（原地修改并返回）"""
+    for record in records:
+        if record.get('category_id') is not None:
+            record['category'] = _category_name(None, record['category_id'])
+    return records
+
+
+def resolve_category(openid: str, name: str) -> tuple:
+    """
+    解析用户输入的分类
+
+    Returns:
+        (分类 id, 标准分类名称)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        category_id = _resolve_category(cursor, openid, name)
+        category = _category_name(cursor, category_id)
+        _commit(conn)
+        return category_id, category
+
+
+def merge_category(openid: str, source: str, target: str) -> int:
+    """
+    合并分类：把用户的 source 分类记录全部归入 target，并记住别名供以后记账使用
+
+    Returns:
+        被迁移的记录条数，source 不是已有的分类时为 None
+    """
+    # 分类别名在全局库，记录在用户所在分库：先迁移记录，再提交别名。
+    # 迁移失败时别名没有变，重试时 source 仍解析到原来的分类，记录可以继续迁移
+    source = source.strip()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        source_id = _find_category(cursor, openid, source)
+        if source_id is None:
+            return None
+        target_id = _resolve_category(cursor, openid, target)
+        source_name = _category_name(cursor, source_id)
+        target_name = _category_name(cursor, target_id)
+        # 新建的目标分类先提交，分库中的记录才能引用它
+        _commit(conn)
+    if source_id == target_id:
+        return 0
+
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, description FROM expenses WHERE openid = ? AND category_id = ?
+        ''', (openid, source_id))
+        rows = cursor.fetchall()
+        cursor.execute('''
+            UPDATE expenses SET category_id = ? WHERE openid = ? AND category_id = ?
+        ''', (target_id, openid, source_id))
+
+        for row in rows:
+            _index_expense(cursor, row['id'], target_name, row['description'])
+
+        conn.commit()
+    journal.append('merge_category', openid, source_id, target_id)
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # 用户输入的名称和被合并分类的标准名称都指向目标分类
+        cursor.executemany('''
+            INSERT OR REPLACE INTO category_aliases (openid, alias, category_id)
+            VALUES (?, ?, ?)
+        ''', [(openid, alias, target_id) for alias in {source, source_name}])
+        cursor.execute('''
+            UPDATE category_aliases SET category_id = ?
+            WHERE openid = ? AND category_id = ?
+        ''', (target_id, openid, source_id))
+        _commit(conn)
+    return len(rows)
+
+
+def get_user_categories(openid: str) -> list:
+    """
+    获取用户使用过的分类及其别名映射
+
+    Returns:
+        [{'category_id': 1, 'category': '餐饮', 'count': 12, 'aliases': ['吃饭']}, ...]
+    """
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT category_id, COUNT(*) as count
+            FROM expenses
+            WHERE openid = ? AND category_id IS NOT NULL
+            GROUP BY category_id
+            ORDER BY count DESC
+        ''', (openid,))
+        categories = _attach_category_names([dict(row) for row in cursor.fetchall()])
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT alias, category_id FROM category_aliases WHERE openid = ? ORDER BY alias
+        ''', (openid,))
+        aliases = {}
+        for row in cursor.fetchall():
+            aliases.setdefault(row['category_id'], []).append(row['alias'])
+
+        for c in categories:
+            c['aliases'] = aliases.get(c['category_id'], [])
+        return categories
+
+
 def add_user(openid: str, nickname: str = None):
     """添加用户（如果不存在）"""
     with get_connection() as conn:
         cursor = conn.cursor()
         # 只在用户不存在时插入，不覆盖已有记录
+        next_push_at = _next_push_at()
         cursor.execute('''
-            INSERT OR IGNORE INTO users (openid, nickname, created_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', (openid, nickname))
+            INSERT OR IGNORE INTO users (openid, nickname, created_at, push_bucket, next_push_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
+        ''', (openid, nickname, get_user_bucket(openid), next_push_at))
+        created = cursor.rowcount > 0
+        if created:
+            _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+    if created:
+        journal.append('add_user', openid, nickname)
+
+
+def record_interaction(openid: str):
+    """
+    记录用户主动互动（发消息、关注、点菜单），用于判断客服消息 48 小时窗口
+
+    取消关注后重新互动、或因超出窗口被移出推送队列的用户，会重新排入推送队列。
+    一分钟内的重复互动不写库。
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT push_time, push_enabled, last_push_date, next_push_at,
+                   subscribed, last_interaction_at
+            FROM users WHERE openid = ?
+        ''', (openid,))
+        row = cursor.fetchone()
+        if row is None:
+            next_push_at = _next_push_at()
+            cursor.execute('''
+                INSERT OR IGNORE INTO users
+                    (openid, created_at, push_bucket, next_push_at, last_interaction_at)
+                VALUES (?, CURRENT_TIMESTAMP, ?, ?, ?)
+            ''', (openid, get_user_bucket(openid), next_push_at, now))
+            created = cursor.rowcount > 0
+            _wake_push_task(cursor, openid, next_push_at)
+            conn.commit()
+            if created:
+                journal.append('add_user', openid, None)
+            return
+
+        next_push_at = row['next_push_at']
+        requeue = next_push_at is None and row['push_enabled']
+        if (row['subscribed'] and not requeue and row['last_interaction_at']
+                and now - row['last_interaction_at'] < 60):
+            return
+        if requeue:
+            next_push_at = _next_push_at(row['push_time'], row['last_push_date'])
+        cursor.execute('''
+            UPDATE users SET subscribed = 1, last_interaction_at = ?, next_push_at = ?
+            WHERE openid = ?
+        ''', (now, next_push_at, openid))
+        if requeue:
+            _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+    # 与 unsubscribe_user 成对记入日志，回放后关注状态一致
+    if not row['subscribed']:
+        journal.append('resubscribe_user', openid)
+
+
+def unsubscribe_user(openid: str):
+    """用户取消关注：移出推送队列，不再出现在用户列表中"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET subscribed = 0, next_push_at = NULL WHERE openid = ?
+        ''', (openid,))
+        conn.commit()
+    journal.append('unsubscribe_user', openid)
+
+
+def suspend_push(openid: str, until: float = None):
+    """
+    暂停推送
+
+    Args:
+        until: 推迟到该时间戳再推送；为 None 时移出推送队列（无法触达），
+            用户下次互动时由 record_interaction 恢复
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET next_push_at = ? WHERE openid = ?', (until, openid))
         conn.commit()
 
 
@@ -136,11 +872,28 @@ def update_nickname(openid: str, nickname: str) -> bool:
             UPDATE users SET nickname = ? WHERE openid = ?
         ''', (nickname, openid))
         conn.commit()
-        return cursor.rowcount > 0
+        updated = cursor.rowcount > 0
+    if updated:
+        journal.append('update_nickname', openid, nickname)
+    return updated
+
+
+def get_user(openid: str) -> dict:
+    """获取用户信息，不存在时返回 None"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT openid, nickname, created_at, push_time, push_enabled, next_push_at,
+                   subscribed, last_interaction_at
+            FROM users WHERE openid = ?
+        ''', (openid,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
 
 
 def add_expense(openid: str, expense_type: str, amount: float, 
-                category: str = None, description: str = None) -> int:
+                category: str = None, description: str = None,
+                category_id: int = None) -> int:
     """
     添加记账记录
     
@@ -148,20 +901,372 @@ def add_expense(openid: str, expense_type: str, amount: float,
         openid: 用户 OpenID
         expense_type: 类型 ('income' 或 'expense')
         amount: 金额
-        category: 分类
+        category: 分类（按别名解析为 category_id 存储）
         description: 备注
+        category_id: 已解析的分类 id（提供时忽略 category）
     
     Returns:
         记录 ID
     """
+    return add_expenses(openid, [{
+        'type': expense_type, 'amount': amount, 'category': category,
+        'category_id': category_id, 'description': description,
+    }])[0]['id']
+
+
+def add_expenses(openid: str, entries: list) -> list:
+    """
+    在一个事务内批量添加记账记录（多行记账）
+
+    Args:
+        openid: 用户 OpenID
+        entries: [{'type', 'amount', 'category', 'description'}]，可带已解析的 category_id；
+            带 'infer': True 时按 _infer_category 推断分类，推断出的分类词并入备注
+
+    Returns:
+        写入的记录（按 entries 顺序），补充了 id、category_id 和标准分类名称 category
+    """
+    records = [dict({'category': None, 'category_id': None, 'description': None}, **entry)
+               for entry in entries]
+    if not records:
+        return []
+    unresolved = [r for r in records if r['category_id'] is None
+                  and (r['category'] is not None or r.get('infer'))]
+    if unresolved:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            for record in unresolved:
+                if record.pop('infer', False):
+                    _infer_record_category(cursor, openid, record)
+                else:
+                    record['category_id'] = _resolve_category(cursor, openid, record['category'])
+            _commit(conn)
+    for record in records:
+        record['category'] = _category_name(None, record['category_id'])
+    expense = sum(r['amount'] for r in records if r['type'] == 'expense')
+    income = sum(r['amount'] for r in records if r['type'] == 'income')
+
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        for record in records:
+            cursor.execute('''
+                INSERT INTO expenses (openid, type, amount, category_id, description)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (openid, record['type'], record['amount'], record['category_id'], record['description']))
+            record['id'] = cursor.lastrowid
+        cursor.execute(f'''
+            SELECT id, CAST(strftime('%s', created_at) AS INTEGER) as ts
+            FROM expenses WHERE id IN ({_placeholders(records)})
+        ''', [r['id'] for r in records])
+        timestamps = {row['id']: row['ts'] for row in cursor.fetchall()}
+        created = [timestamps[r['id']] for r in records]
+        cursor.executemany('''
+            INSERT INTO expenses_fts (rowid, unigrams, bigrams) VALUES (?, ?, ?)
+        ''', [(r['id'], *_search_tokens(f'{r["category"] or ""} {r["description"] or ""}'))
+              for r in records])
+        spent_before = _add_month_total(cursor, openid, expense, income, len(records))
+        budget = _budget_amount(cursor, openid) if expense else None
+        conn.commit()
+
+    journal.append_many('add_expense', [
+        (r['id'], openid, r['type'], r['amount'], r['category_id'], r['description'], ts)
+        for r, ts in zip(records, created)
+    ])
+    if expense:
+        _check_budget_alerts(openid, spent_before, expense, budget)
+    return records
+
+
+def _infer_record_category(cursor, openid: str, record: dict):
+    """为待写入的记录推断分类；分类词被推断为其他分类时（如商户名）保留到备注里"""
+    name = record['category']
+    record['category_id'], inferred = _infer_category(cursor, openid, name, record['description'])
+    if inferred and name:
+        record['description'] = ' '.join(filter(None, [name, record['description']]))
+
+
+def _ledger_today() -> date:
+    """
+    账本时钟的今天（UTC 日期）
+
+    created_at 存的是 UTC 时间（CURRENT_TIMESTAMP），月份键、按日/按月统计和定时入账都用这个日期，
+    否则服务器本地时间已经跨月而 UTC 还没有时，月累计会与明细对不上
+    """
+    return hot_cache.utc_today()
+
+
+def _month_key(day: date = None) -> str:
+    """月累计的月份键 'YYYY-MM'（默认账本时钟的本月）"""
+    return (day or _ledger_today()).strftime('%Y-%m')
+
+
+def _month_range(month: str = None) -> tuple:
+    """月份键对应的 (月初, 下月初)，默认本月"""
+    start = date.fromisoformat(f'{month or _month_key()}-01')
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def _sum_month(cursor, openid: str, month: str = None) -> dict:
+    """从记账明细汇总某月（默认本月）收支（月累计缺失时补算）"""
+    month_start, next_month = _month_range(month)
+    cursor.execute('''
+        SELECT
+            COALESCE(SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END), 0) as expense,
+            COALESCE(SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END), 0) as income,
+            COUNT(*) as entries
+        FROM expenses
+        WHERE openid = ? AND date(created_at) >= ? AND date(created_at) < ?
+    ''', (openid, month_start.isoformat(), next_month.isoformat()))
+    return dict(cursor.fetchone())
+
+
+def _get_month_total(cursor, openid: str, month: str = None) -> dict:
+    """读取某月（默认本月）累计收支 {'expense', 'income'}，还没有累计行时从明细补算"""
+    month = month or _month_key()
+    cursor.execute('''
+        SELECT expense, income FROM month_totals WHERE openid = ? AND month = ?
+    ''', (openid, month))
+    row = cursor.fetchone()
+    return dict(row) if row else _sum_month(cursor, openid, month)
+
+
+def _add_month_total(cursor, openid: str, expense: float, income: float, entries: int,
+                     month: str = None) -> float:
+    """
+    把刚插入的记账计入月累计（与插入在同一事务内）
+
+    Args:
+        month: 计入的月份键，默认本月；定时入账传入认领时的月份，避免跨月时与入账月份不一致
+
+    Returns:
+        计入前的月累计支出
+    """
+    month = month or _month_key()
+    cursor.execute('''
+        SELECT expense FROM month_totals WHERE openid = ? AND month = ?
+    ''', (openid, month))
+    row = cursor.fetchone()
+    if row is None:
+        # 本月第一笔或升级前已有记录：从明细补算一次（已包含本次写入）
+        totals = _sum_month(cursor, openid, month)
+        cursor.execute('''
+            INSERT INTO month_totals (openid, month, expense, income, entries) VALUES (?, ?, ?, ?, ?)
+        ''', (openid, month, totals['expense'], totals['income'], totals['entries']))
+        return totals['expense'] - expense
+
+    cursor.execute('''
+        UPDATE month_totals SET expense = expense + ?, income = income + ?, entries = entries + ?
+        WHERE openid = ? AND month = ?
+    ''', (expense, income, entries, openid, month))
+    return row['expense']
+
+
+def get_month_activity(openid: str) -> dict:
+    """
+    本月记账活跃度（读取月累计，用于估算查询成本）
+
+    Returns:
+        {'entries': 本月记账笔数, 'days': 本月已过天数}
+    """
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT expense, income, entries FROM month_totals WHERE openid = ? AND month = ?
+        ''', (openid, _month_key()))
+        row = cursor.fetchone()
+        # 没有累计行，或升级前的累计行还没有笔数时从明细补算
+        if row is None or (not row['entries'] and (row['expense'] or row['income'])):
+            row = _sum_month(cursor, openid)
+        return {'entries': row['entries'], 'days': _ledger_today().day}
+
+
+def _budget_amount(cursor, openid: str) -> float:
+    """获取月预算金额，未设置时为 None"""
+    cursor.execute('SELECT monthly_amount FROM budgets WHERE openid = ?', (openid,))
+    row = cursor.fetchone()
+    return row['monthly_amount'] if row else None
+
+
+def _crossed_thresholds(before: float, after: float, budget: float) -> list:
+    """本次支出跨过的预警阈值（百分比）"""
+    if not budget or budget <= 0:
+        return []
+    return [t for t in BUDGET_ALERT_THRESHOLDS if before < budget * t / 100 <= after]
+
+
+def _member_month_expense(cursor, openids: list, month: str = None) -> list:
+    """_fan_out 查询：成员某月（默认本月）累计支出"""
+    return [{'openid': openid, 'expense': _get_month_total(cursor, openid, month)['expense']}
+            for openid in openids]
+
+
+def _family_month_spent(cursor, family_id: int, month: str = None) -> float:
+    """从成员月累计汇总家庭某月（默认本月）支出（cursor 为全局库游标）"""
+    cursor.execute('SELECT openid FROM family_members WHERE family_id = ?', (family_id,))
+    openids = [row['openid'] for row in cursor.fetchall()]
+    rows = _fan_out(openids, lambda shard_cursor, ids: _member_month_expense(shard_cursor, ids, month))
+    return sum(row['expense'] for row in rows)
+
+
+def _check_budget_alerts(openid: str, spent_before: float, amount: float, budget: float, month: str = None):
+    """
+    支出入账后检查个人和家庭预算，跨过阈值时写入预警（每月每个阈值只写一次）
+
+    只比较入账前后的月累计，不重新汇总明细；家庭月累计在全局库中同步累加。
+    month 与 _add_month_total 计入的月份一致，默认本月。
+    """
+    month = month or _month_key()
+    alerts = [('user', openid, t, spent_before + amount, budget)
+              for t in _crossed_thresholds(spent_before, spent_before + amount, budget)]
+
     with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO expenses (openid, type, amount, category, description)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (openid, expense_type, amount, category, description))
+            SELECT fm.family_id, fb.monthly_amount, ft.expense
+            FROM family_members fm
+            LEFT JOIN family_budgets fb ON fb.family_id = fm.family_id
+            LEFT JOIN family_month_totals ft ON ft.family_id = fm.family_id AND ft.month = ?
+            WHERE fm.openid = ?
+        ''', (month, openid))
+        family = cursor.fetchone()
+
+        if family:
+            family_id = family['family_id']
+            if family['expense'] is None:
+                # 本月第一笔或成员变动后：按成员月累计重算（已包含本笔）
+                family_before = _family_month_spent(cursor, family_id, month) - amount
+                cursor.execute('''
+                    INSERT OR REPLACE INTO family_month_totals (family_id, month, expense)
+                    VALUES (?, ?, ?)
+                ''', (family_id, month, family_before + amount))
+            else:
+                family_before = family['expense']
+                cursor.execute('''
+                    UPDATE family_month_totals SET expense = expense + ?
+                    WHERE family_id = ? AND month = ?
+                ''', (amount, family_id, month))
+            family_budget = family['monthly_amount']
+            alerts += [('family', str(family_id), t, family_before + amount, family_budget)
+                       for t in _crossed_thresholds(family_before, family_before + amount, family_budget)]
+
+        cursor.executemany('''
+            INSERT OR IGNORE INTO budget_alerts
+                (scope, scope_id, month, threshold, spent, budget, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(scope, scope_id, month, threshold, spent, amount_budget, time.time())
+              for scope, scope_id, threshold, spent, amount_budget in alerts])
         conn.commit()
-        return cursor.lastrowid
+
+
+def _search_segments(text: str) -> list:
+    """将文本按非字母数字字符切分为小写片段"""
+    return re.findall(r'[^\W_]+', (text or '').lower())
+
+
+def _search_tokens(text: str) -> tuple:
+    """
+    生成全文索引词元
+
+    中文没有空格分词，这里把每个片段拆成单字和相邻双字，
+    查询时用双字短语匹配即可实现任意子串搜索。
+
+    Returns:
+        (单字词元串, 双字词元串)
+    """
+    unigrams = []
+    bigrams = []
+    for segment in _search_segments(text):
+        unigrams.extend(segment)
+        bigrams.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return ' '.join(unigrams), ' '.join(bigrams)
+
+
+def _search_query(keyword: str) -> str:
+    """把搜索关键词转换为 FTS5 MATCH 表达式，多个片段之间为 AND 关系"""
+    phrases = []
+    for segment in _search_segments(keyword):
+        if len(segment) == 1:
+            phrases.append(f'unigrams : "{segment}"')
+        else:
+            grams = ' '.join(segment[i:i + 2] for i in range(len(segment) - 1))
+            phrases.append(f'bigrams : "{grams}"')
+    return ' AND '.join(phrases)
+
+
+def _index_expense(cursor, expense_id: int, category: str = None, description: str = None):
+    """写入（或重建）一条记账记录的全文索引，需与记录写入处于同一事务"""
+    unigrams, bigrams = _search_tokens(f'{category or ""} {description or ""}')
+    cursor.execute('DELETE FROM expenses_fts WHERE rowid = ?', (expense_id,))
+    cursor.execute('''
+        INSERT INTO expenses_fts (rowid, unigrams, bigrams) VALUES (?, ?, ?)
+    ''', (expense_id, unigrams, bigrams))
+
+
+def search_expenses(openid: str, keyword: str, days: int = 365, limit: int = 20) -> dict:
+    """
+    按关键词搜索分类和备注
+
+    通过全文索引一次查询同时返回匹配记录和合计（窗口函数在 LIMIT 之前计算）
+
+    Returns:
+        {
+            'count': 匹配条数,
+            'expense': 匹配支出合计,
+            'income': 匹配收入合计,
+            'records': 最近的匹配记录（最多 limit 条）
+        }
+    """
+    query = _search_query(keyword)
+    result = {'count': 0, 'expense': 0, 'income': 0, 'records': []}
+    if not query:
+        return result
+
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT e.id, e.type, e.amount, e.category, e.category_id, e.description,
+                   date(e.created_at) as date,
+                   COUNT(*) OVER () as match_count,
+                   SUM(CASE WHEN e.type = 'expense' THEN e.amount ELSE 0 END) OVER () as expense_total,
+                   SUM(CASE WHEN e.type = 'income' THEN e.amount ELSE 0 END) OVER () as income_total
+            FROM expenses_fts
+            JOIN expenses e ON e.id = expenses_fts.rowid
+            WHERE expenses_fts MATCH ? AND e.openid = ?
+            AND date(e.created_at) >= date('now', ?)
+            ORDER BY e.created_at DESC
+            LIMIT ?
+        ''', (query, openid, f'-{days} days', limit))
+        rows = cursor.fetchall()
+
+        if rows:
+            result['count'] = rows[0]['match_count']
+            result['expense'] = rows[0]['expense_total']
+            result['income'] = rows[0]['income_total']
+            records = [
+                {k: row[k] for k in ('id', 'type', 'amount', 'category', 'category_id', 'description', 'date')}
+                for row in rows
+            ]
+            result['records'] = _attach_category_names(records)
+        return result
+
+
+def _load_hot_rows(openid: str, since: int) -> list:
+    """热点缓存未命中时加载用户缓存窗口内的记录（按时间升序）"""
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, type, amount, category, category_id, description,
+                   CAST(strftime('%s', created_at) AS INTEGER) as ts
+            FROM expenses
+            WHERE openid = ? AND created_at >= datetime(?, 'unixepoch')
+            ORDER BY created_at, id
+        ''', (openid, since))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def _days_ago_start(days: int) -> int:
+    """date('now', '-N days') 对应的时间戳（UTC）"""
+    return hot_cache.utc_day_start(hot_cache.utc_today() - timedelta(days=days))
 
 
 def get_today_summary(openid: str) -> dict:
@@ -173,12 +1278,35 @@ def get_today_summary(openid: str) -> dict:
             'income': 总收入,
             'expense': 总支出,
             'balance': 结余,
+            'recurring': 支出中固定开支/贷款自动入账的金额,
             'records': 记录列表
         }
     """
-    today = date.today().isoformat()
+    today = _ledger_today().isoformat()
+
+    # 热点缓存命中时直接扫描内存中的列
+    start = hot_cache.utc_day_start(_ledger_today())
+    cached = hot_cache.query(openid, start, _load_hot_rows, lambda entry: (
+        hot_cache.totals(entry, start, start + 86400),
+        hot_cache.records(entry, start, start + 86400),
+    ))
+    if cached:
+        totals, records = cached
+        recurring = 0
+        if totals['expense']:
+            with get_connection(openid) as conn:
+                recurring = _recurring_posted(conn.cursor(), openid, today)
+        for record in records:
+            del record['id']
+        return {
+            'income': totals['income'],
+            'expense': totals['expense'],
+            'balance': totals['income'] - totals['expense'],
+            'recurring': recurring,
+            'records': _attach_category_names(records)
+        }
     
-    with get_connection() as conn:
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         
         # 获取今日收入总额
@@ -201,21 +1329,36 @@ def get_today_summary(openid: str) -> dict:
         
         # 获取今日记录详情
         cursor.execute('''
-            SELECT type, amount, category, description, created_at
+            SELECT type, amount, category, category_id, description, created_at
             FROM expenses
             WHERE openid = ? AND date(created_at) = ?
             ORDER BY created_at DESC
         ''', (openid, today))
-        records = [dict(row) for row in cursor.fetchall()]
+        records = _attach_category_names([dict(row) for row in cursor.fetchall()])
+        
+        # 今日支出中自动入账的固定开支/贷款
+        recurring = _recurring_posted(cursor, openid, today)
         
         return {
             'income': income,
             'expense': expense,
             'balance': income - expense,
+            'recurring': recurring,
             'records': records
         }
 
 
+def _recurring_posted(cursor, openid: str, day: str) -> float:
+    """某天（'YYYY-MM-DD'）的支出中由固定开支/贷款自动入账的金额（按 recurring_postings.expense_id 关联账本）"""
+    cursor.execute('''
+        SELECT COALESCE(SUM(e.amount), 0) as total
+        FROM recurring_postings p
+        JOIN expenses e ON e.id = p.expense_id
+        WHERE p.openid = ? AND date(e.created_at) = ?
+    ''', (openid, day))
+    return cursor.fetchone()['total']
+
+
 def get_month_summary(openid: str) -> dict:
     """
     获取用户本月收支统计
@@ -228,10 +1371,21 @@ def get_month_summary(openid: str) -> dict:
             'days': 记账天数
         }
     """
-    today = date.today()
+    today = _ledger_today()
     month_start = today.replace(day=1).isoformat()
+
+    start = hot_cache.utc_day_start(today.replace(day=1))
+    cached = hot_cache.query(openid, start, _load_hot_rows,
+                             lambda entry: hot_cache.totals(entry, start))
+    if cached:
+        return {
+            'income': cached['income'],
+            'expense': cached['expense'],
+            'balance': cached['income'] - cached['expense'],
+            'days': cached['days']
+        }
     
-    with get_connection() as conn:
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         
         # 获取本月收入总额
@@ -269,34 +1423,53 @@ def get_month_summary(openid: str) -> dict:
 
 
 def get_expense_history(openid: str, days: int = 30) -> list:
-    """获取用户历史记录"""
-    with get_connection() as conn:
+    """获取用户历史记录（最近 50 条）"""
+    start = _days_ago_start(days)
+    cached = hot_cache.query(openid, start, _load_hot_rows,
+                             lambda entry: hot_cache.records(entry, start, limit=50))
+    if cached is not None:
+        for record in cached:
+            created_at = record.pop('created_at')
+            record['date'], record['time'] = created_at[:10], created_at[11:]
+        return _attach_category_names(cached)
+
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT id, type, amount, category, description, 
+            SELECT id, type, amount, category, category_id, description, 
                    date(created_at) as date, time(created_at) as time
             FROM expenses
             WHERE openid = ? AND date(created_at) >= date('now', ?)
             ORDER BY created_at DESC
             LIMIT 50
         ''', (openid, f'-{days} days'))
-        return [dict(row) for row in cursor.fetchall()]
+        return _attach_category_names([dict(row) for row in cursor.fetchall()])
 
 
 def get_category_stats(openid: str, days: int = 30) -> dict:
-    """获取分类统计"""
-    with get_connection() as conn:
+    """获取分类统计（按整数 category_id 分组，名称从分类字典填充）"""
+    start = _days_ago_start(days)
+    categories = hot_cache.query(openid, start, _load_hot_rows,
+                                 lambda entry: hot_cache.category_totals(entry, start))
+    if categories is not None:
+        categories = _attach_category_names(categories)
+        return {
+            'total': sum(c['total'] for c in categories),
+            'categories': categories
+        }
+
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT category, SUM(amount) as total, COUNT(*) as count
+            SELECT category_id, category, SUM(amount) as total, COUNT(*) as count
             FROM expenses
             WHERE openid = ? AND type = 'expense'
             AND date(created_at) >= date('now', ?)
-            GROUP BY category
+            GROUP BY category_id, category
             ORDER BY total DESC
         ''', (openid, f'-{days} days'))
         
-        categories = [dict(row) for row in cursor.fetchall()]
+        categories = _attach_category_names([dict(row) for row in cursor.fetchall()])
         total = sum(c['total'] for c in categories)
         
         return {
@@ -307,51 +1480,73 @@ def get_category_stats(openid: str, days: int = 30) -> dict:
 
 def set_budget(openid: str, amount: float) -> bool:
     """设置月预算"""
-    with get_connection() as conn:
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT OR REPLACE INTO budgets (openid, monthly_amount, updated_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
         ''', (openid, amount))
         conn.commit()
-        return True
+    journal.append('set_budget', openid, amount)
+    return True
 
 
 def get_budget(openid: str) -> dict:
-    """获取预算及使用情况"""
-    today = date.today()
-    month_start = today.replace(day=1).isoformat()
-    
+    """获取预算及使用情况（本月支出读取月累计）"""
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        budget = _budget_amount(cursor, openid)
+        spent = _get_month_total(cursor, openid)['expense']
+        return _budget_usage(budget, spent)
+
+
+def _budget_usage(budget: float, spent: float) -> dict:
+    """计算预算使用情况"""
+    if budget:
+        remaining = budget - spent
+        percent = round(spent / budget * 100, 1) if budget > 0 else 0
+    else:
+        remaining = None
+        percent = None
+
+    return {
+        'budget': budget,
+        'spent': spent,
+        'remaining': remaining,
+        'percent': percent
+    }
+
+
+def set_family_budget(family_id: int, amount: float) -> bool:
+    """设置家庭月预算"""
     with get_connection() as conn:
         cursor = conn.cursor()
-        
-        # 获取预算
-        cursor.execute('SELECT monthly_amount FROM budgets WHERE openid = ?', (openid,))
-        row = cursor.fetchone()
-        budget = row['monthly_amount'] if row else None
-        
-        # 获取本月支出
         cursor.execute('''
-            SELECT COALESCE(SUM(amount), 0) as total
-            FROM expenses
-            WHERE openid = ? AND type = 'expense'
-            AND date(created_at) >= ?
-        ''', (openid, month_start))
-        spent = cursor.fetchone()['total']
-        
-        if budget:
-            remaining = budget - spent
-            percent = round(spent / budget * 100, 1) if budget > 0 else 0
-        else:
-            remaining = None
-            percent = None
-        
-        return {
-            'budget': budget,
-            'spent': spent,
-            'remaining': remaining,
-            'percent': percent
-        }
+            INSERT OR REPLACE INTO family_budgets (family_id, monthly_amount, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (family_id, amount))
+        conn.commit()
+    journal.append('set_family_budget', family_id, amount)
+    return True
+
+
+def get_family_budget(family_id: int) -> dict:
+    """获取家庭预算及使用情况（本月支出为全部成员的月累计之和）"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT fb.monthly_amount, ft.expense
+            FROM families f
+            LEFT JOIN family_budgets fb ON fb.family_id = f.id
+            LEFT JOIN family_month_totals ft ON ft.family_id = f.id AND ft.month = ?
+            WHERE f.id = ?
+        ''', (_month_key(), family_id))
+        row = cursor.fetchone()
+        budget = row['monthly_amount'] if row else None
+        spent = row['expense'] if row and row['expense'] is not None else None
+        if spent is None:
+            spent = _family_month_spent(cursor, family_id)
+        return _budget_usage(budget, spent)
 
 
 def is_family_creator(openid: str) -> bool:
@@ -365,10 +1560,10 @@ def is_family_creator(openid: str) -> bool:
         return row and row['role'] == 'creator'
 
 def get_all_users() -> list:
-    """获取所有用户的 OpenID 列表（用于每日推送）"""
+    """获取所有仍在关注的用户的 OpenID 列表"""
     with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT openid FROM users')
+        cursor.execute('SELECT openid FROM users WHERE subscribed = 1')
         return [row['openid'] for row in cursor.fetchall()]
 
 
@@ -400,20 +1595,41 @@ def add_recurring_expense(openid: str, expense_type: str, name: str,
     if monthly_amount is None:
         raise ValueError("必须提供 monthly_amount 或 (total_amount + total_months)")
     
-    with get_connection() as conn:
+    start_date = _ledger_today()
+    end_date = _term_end(start_date, total_months, expense_type)
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO recurring_expenses 
-            (openid, type, name, total_amount, total_months, monthly_amount, start_date)
-            VALUES (?, ?, ?, ?, ?, ?, date('now'))
-        ''', (openid, expense_type, name, total_amount, total_months, monthly_amount))
+            (openid, type, name, total_amount, total_months, monthly_amount, start_date, end_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (openid, expense_type, name, total_amount, total_months, monthly_amount,
+              start_date.isoformat(), end_date and end_date.isoformat()))
         conn.commit()
-        return cursor.lastrowid
+        recurring_id = cursor.lastrowid
+    journal.append('add_recurring_expense', recurring_id, openid, expense_type, name,
+                   total_amount, total_months, monthly_amount, end_date and end_date.isoformat())
+    return recurring_id
+
+
+def _term_end(start: date, total_months: int, expense_type: str):
+    """
+    分期的最后一天：起始日加 total_months 个月的前一天（目标月没有这一天时取月末）
+
+    Returns:
+        date，不是有期限的类型或没有期数时为 None
+    """
+    if expense_type not in TERM_TYPES or not total_months:
+        return None
+    month = start.month - 1 + total_months
+    year, month = start.year + month // 12, month % 12 + 1
+    day = min(start.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day) - timedelta(days=1)
 
 
 def get_recurring_expenses(openid: str) -> list:
     """获取用户的所有固定开支/贷款"""
-    with get_connection() as conn:
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT id, type, name, total_amount, total_months, monthly_amount, start_date, end_date
@@ -426,7 +1642,7 @@ def get_recurring_expenses(openid: str) -> list:
 
 def delete_recurring_expense(openid: str, expense_id: int) -> bool:
     """删除（停用）固定开支/贷款"""
-    with get_connection() as conn:
+    with get_connection(openid) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE recurring_expenses 
@@ -434,7 +1650,260 @@ def delete_recurring_expense(openid: str, expense_id: int) -> bool:
             WHERE id = ? AND openid = ?
         ''', (expense_id, openid))
         conn.commit()
-        return cursor.rowcount > 0
+        deleted = cursor.rowcount > 0
+    if deleted:
+        journal.append('delete_recurring_expense', openid, expense_id)
+    return deleted
+
+
+def expire_recurring_expenses(today: date = None) -> list:
+    """
+    停用已过结束日期的贷款/负债（夜间任务调用，逐条更新，多个进程同时执行时每条只由一个进程停用）
+
+    Returns:
+        本次停用的记录 [{'id', 'openid', 'type', 'name', 'total_amount', 'total_months', 'end_date'}]
+    """
+    today = (today or _ledger_today()).isoformat()
+    expired = []
+    for shard in range(DATABASE_SHARDS):
+        with get_connection(shard=shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, openid, type, name, total_amount, total_months, end_date
+                FROM recurring_expenses
+                WHERE is_active = 1 AND end_date < ?
+            ''', (today,))
+            for row in cursor.fetchall():
+                cursor.execute('''
+                    UPDATE recurring_expenses SET is_active = 0 WHERE id = ? AND is_active = 1
+                ''', (row['id'],))
+                if cursor.rowcount:
+                    expired.append(dict(row))
+            conn.commit()
+    for row in expired:
+        journal.append('expire_recurring_expense', row['openid'], row['id'])
+    return expired
+
+
+def _due_date(start: date, month_start: date) -> date:
+    """分期在某月的还款日：与起始日同一天，该月没有这一天时取月末"""
+    return month_start.replace(day=min(start.day, calendar.monthrange(month_start.year, month_start.month)[1]))
+
+
+def _to_date(value):
+    """数据库中的日期（SQLite 为 'YYYY-MM-DD' 字符串）转为 date，None 保持不变"""
+    return date.fromisoformat(value[:10]) if isinstance(value, str) else value
+
+
+def _due_installments(rows: list, today: date) -> list:
+    """
+    列出已到还款日、尚在还款期内且还没有入账的分期，包括漏掉的往月
+
+    从上次入账的下一个月开始（从未入账时从起始日和添加日中较晚的那个月开始），
+    最多追溯 BILLING_CATCHUP_MONTHS 个月（含本月）。
+
+    Args:
+        rows: 生效中且本月尚未入账的固定开支 [{'start_date', 'end_date', 'created_date', 'last_period', ...}]
+
+    Returns:
+        到期的分期（行的副本，补充了 'period' 和还款日 'due_date'），同一行按月份先后排列
+    """
+    current = today.replace(day=1)
+    floor = current
+    for _ in range(max(BILLING_CATCHUP_MONTHS, 1) - 1):
+        floor = (floor - timedelta(days=1)).replace(day=1)
+    due = []
+    for row in rows:
+        start, end = _to_date(row['start_date']), _to_date(row['end_date'])
+        if row['last_period']:
+            month = _month_range(row['last_period'])[1]
+        else:
+            month = max(start, _to_date(row['created_date'])).replace(day=1)
+        month = max(month, floor)
+        while month <= current:
+            day = _due_date(start, month)
+            if start <= day <= today and (end is None or day <= end):
+                due.append(dict(row, period=_month_key(month), due_date=day))
+            month = _month_range(_month_key(month))[1]
+    return due
+
+
+def _posting_time(item: dict, today: date) -> str:
+    """
+    分期入账记录的 created_at（与 period 同一个账本时钟）：
+    本月的记在入账当天的当前时刻（UTC），往月补记的记在那个月的还款日
+    """
+    if item['period'] != _month_key(today):
+        return f"{item['due_date']} 00:00:00"
+    return f"{today.isoformat()} {datetime.now(timezone.utc):%H:%M:%S}"
+
+
+def post_recurring_charges(today: date = None, chunk: int = None) -> list:
+    """
+    把已到还款日的固定开支/贷款写入账本（调度器定时执行）
+
+    每批最多 chunk 条，一个事务内用 executemany 认领 (recurring_id, period)、写入记账记录和入账记录；
+    已被认领的分期不会重复入账，多个进程同时执行、重复执行或中途失败重跑都只入账一次。
+    入账记录与手动记账一样计入月累计、全文索引、变更日志和预算预警。
+    停机等原因漏掉的往月分期一并补记（见 _due_installments）：记在所属月份的还款日、计入那个月的月累计，
+    那个月已经结束，不再触发预算预警。
+
+    Returns:
+        本次入账的记录 [{'recurring_id', 'openid', 'type', 'name', 'amount', 'period', 'expense_id'}]
+    """
+    today = today or _ledger_today()
+    chunk = chunk or BILLING_CHUNK
+    current = _month_key(today)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        category_ids = {t: _intern_category(cursor, name) for t, name in RECURRING_CATEGORIES.items()}
+        _commit(conn)
+
+    posted = []
+    for shard in range(DATABASE_SHARDS):
+        with get_connection(shard=shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT r.id, r.openid, r.type, r.name, r.monthly_amount,
+                       COALESCE(r.start_date, date(r.created_at)) as start_date, r.end_date,
+                       date(r.created_at) as created_date,
+                       (SELECT MAX(period) FROM recurring_postings WHERE recurring_id = r.id) as last_period
+                FROM recurring_expenses r
+                LEFT JOIN recurring_postings p ON p.recurring_id = r.id AND p.period = ?
+                WHERE r.is_active = 1 AND p.recurring_id IS NULL AND r.monthly_amount > 0
+                ORDER BY r.id
+            ''', (current,))
+            due = _due_installments([dict(row) for row in cursor.fetchall()], today)
+            for i in range(0, len(due), chunk):
+                posted += _post_installments(conn, due[i:i + chunk], today, category_ids)
+    return posted
+
+
+def _post_installments(conn, items: list, today: date, category_ids: dict) -> list:
+    """在一个事务内入账一批分期，返回本批实际入账的记录（已被其他进程认领的跳过）"""
+    current = _month_key(today)
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT OR IGNORE INTO recurring_postings (recurring_id, period, openid, amount, posted_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(item['id'], item['period'], item['openid'], item['monthly_amount'], time.time()) for item in items])
+    # 写锁已在本事务中，其他进程提交的认领都已写好 expense_id，没有 expense_id 的就是本批认领的
+    cursor.execute(f'''
+        SELECT recurring_id, period FROM recurring_postings
+        WHERE expense_id IS NULL AND recurring_id IN ({_placeholders(items)})
+    ''', [item['id'] for item in items])
+    claimed = {(row['recurring_id'], row['period']) for row in cursor.fetchall()}
+    items = [item for item in items if (item['id'], item['period']) in claimed]
+    if not items:
+        conn.commit()
+        return []
+
+    records = []
+    for item in items:
+        category_id = category_ids.get(item['type'], category_ids['fixed'])
+        cursor.execute('''
+            INSERT INTO expenses (openid, type, amount, category_id, description, created_at)
+            VALUES (?, 'expense', ?, ?, ?, ?)
+        ''', (item['openid'], item['monthly_amount'], category_id, item['name'], _posting_time(item, today)))
+        records.append({
+            'recurring_id': item['id'], 'openid': item['openid'], 'type': item['type'], 'name': item['name'],
+            'amount': item['monthly_amount'], 'period': item['period'], 'expense_id': cursor.lastrowid,
+            'category_id': category_id,
+        })
+    cursor.execute(f'''
+        SELECT id, CAST(strftime('%s', created_at) AS INTEGER) as ts
+        FROM expenses WHERE id IN ({_placeholders(records)})
+    ''', [r['expense_id'] for r in records])
+    timestamps = {row['id']: row['ts'] for row in cursor.fetchall()}
+    for r in records:
+        r['ts'] = timestamps[r['expense_id']]
+    cursor.executemany('''
+        UPDATE recurring_postings SET expense_id = ? WHERE recurring_id = ? AND period = ?
+    ''', [(r['expense_id'], r['recurring_id'], r['period']) for r in records])
+    cursor.executemany('''
+        INSERT INTO expenses_fts (rowid, unigrams, bigrams) VALUES (?, ?, ?)
+    ''', [(r['expense_id'], *_search_tokens(f'{_category_name(None, r["category_id"])} {r["name"]}'))
+          for r in records])
+
+    groups = {}
+    for r in records:
+        groups.setdefault((r['openid'], r['period']), []).append(r)
+    budgets = {}
+    for (openid, period), group in groups.items():
+        amount = sum(r['amount'] for r in group)
+        spent_before = _add_month_total(cursor, openid, amount, 0, len(group), period)
+        if period == current:
+            budgets[openid] = (spent_before, amount, _budget_amount(cursor, openid))
+    conn.commit()
+
+    journal.append_many('add_expense', [
+        (r['expense_id'], r['openid'], 'expense', r['amount'], r['category_id'], r['name'], r['ts'])
+        for r in records
+    ])
+    journal.append_many('post_recurring_charge', [
+        (r['openid'], r['recurring_id'], r['period'], r['expense_id']) for r in records
+    ])
+    for openid, (spent_before, amount, budget) in budgets.items():
+        _check_budget_alerts(openid, spent_before, amount, budget, current)
+    for r in records:
+        del r['category_id'], r['ts']
+    return records
+
+
+def get_recurring_postings(openid: str, period: str = None) -> list:
+    """
+    某月已自动入账的固定开支/贷款
+
+    Args:
+        period: 'YYYY-MM'，默认本月
+
+    Returns:
+        [{'recurring_id', 'type', 'name', 'amount', 'expense_id', 'posted_at'}]，按入账先后
+    """
+    with get_connection(openid) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT p.recurring_id, r.type, r.name, p.amount, p.expense_id, p.posted_at
+            FROM recurring_postings p
+            JOIN recurring_expenses r ON r.id = p.recurring_id
+            WHERE p.openid = ? AND p.period = ? AND p.expense_id IS NOT NULL
+            ORDER BY p.posted_at, p.recurring_id
+        ''', (openid, period or _month_key()))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def _active_debt_rows(cursor, openids: list) -> list:
+    """查询一组用户（同一分库）当前生效的固定开支/贷款"""
+    cursor.execute(f'''
+        SELECT openid, type, name, monthly_amount
+        FROM recurring_expenses
+        WHERE openid IN ({_placeholders(openids)}) AND is_active = 1
+        AND (end_date IS NULL OR end_date >= date('now'))
+    ''', openids)
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def _summarize_debt(rows: list, owners: dict = None) -> dict:
+    """汇总固定开支行为每日/每月欠款，owners 提供时在明细中附带归属人"""
+    details = []
+    monthly_total = 0
+    
+    for row in rows:
+        monthly = row['monthly_amount']
+        daily = round(monthly / 30, 2)  # 按30天计算日均
+        monthly_total += monthly
+        detail = {'type': row['type'], 'name': row['name']}
+        if owners is not None:
+            detail['owner'] = owners[row['openid']]
+        detail['monthly'] = monthly
+        detail['daily'] = daily
+        details.append(detail)
+    
+    return {
+        'daily_total': round(monthly_total / 30, 2),
+        'monthly_total': monthly_total,
+        'details': details
+    }
 
 
 def get_daily_debt(openid: str) -> dict:
@@ -451,52 +1920,28 @@ def get_daily_debt(openid: str) -> dict:
             ]
         }
     """
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT type, name, monthly_amount
-            FROM recurring_expenses
-            WHERE openid = ? AND is_active = 1
-            AND (end_date IS NULL OR end_date >= date('now'))
-        ''', (openid,))
-        
-        rows = cursor.fetchall()
-        
-        details = []
-        monthly_total = 0
-        
-        for row in rows:
-            monthly = row['monthly_amount']
-            daily = round(monthly / 30, 2)  # 按30天计算日均
-            monthly_total += monthly
-            details.append({
-                'type': row['type'],
-                'name': row['name'],
-                'monthly': monthly,
-                'daily': daily
-            })
-        
-        return {
-            'daily_total': round(monthly_total / 30, 2),
-            'monthly_total': monthly_total,
-            'details': details
-        }
+    with get_connection(openid) as conn:
+        return _summarize_debt(_active_debt_rows(conn.cursor(), [openid]))
 
 
 def get_family_recurring_expenses(family_id: int) -> list:
-    """获取家庭所有成员的固定开支/贷款（共享账单）"""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT r.id, r.openid, r.type, r.name, r.total_amount, r.total_months, 
-                   r.monthly_amount, r.start_date, r.end_date, u.nickname
-            FROM recurring_expenses r
-            JOIN family_members fm ON r.openid = fm.openid
-            LEFT JOIN users u ON r.openid = u.openid
-            WHERE fm.family_id = ? AND r.is_active = 1
-            ORDER BY r.type, r.monthly_amount DESC
-        ''', (family_id,))
+    """获取家庭所有成员的固定开支/贷款（共享账单，跨分库并行查询后合并）"""
+    nicknames = {m['openid']: m['nickname'] for m in get_family_members_detail(family_id)}
+    
+    def query(cursor, openids):
+        cursor.execute(f'''
+            SELECT id, openid, type, name, total_amount, total_months,
+                   monthly_amount, start_date, end_date
+            FROM recurring_expenses
+            WHERE openid IN ({_placeholders(openids)}) AND is_active = 1
+        ''', openids)
         return [dict(row) for row in cursor.fetchall()]
+    
+    expenses = _fan_out(nicknames, query)
+    for e in expenses:
+        e['nickname'] = nicknames[e['openid']]
+    expenses.sort(key=lambda e: (e['type'], -e['monthly_amount']))
+    return expenses
 
 
 def get_family_daily_debt(family_id: int) -> dict:
@@ -513,40 +1958,11 @@ def get_family_daily_debt(family_id: int) -> dict:
             ]
         }
     """
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT r.type, r.name, r.monthly_amount, u.nickname, r.openid
-            FROM recurring_expenses r
-            JOIN family_members fm ON r.openid = fm.openid
-            LEFT JOIN users u ON r.openid = u.openid
-            WHERE fm.family_id = ? AND r.is_active = 1
-            AND (r.end_date IS NULL OR r.end_date >= date('now'))
-        ''', (family_id,))
-        
-        rows = cursor.fetchall()
-        
-        details = []
-        monthly_total = 0
-        
-        for row in rows:
-            monthly = row['monthly_amount']
-            daily = round(monthly / 30, 2)
-            monthly_total += monthly
-            nickname = row['nickname'] or f"用户{row['openid'][-4:]}"
-            details.append({
-                'type': row['type'],
-                'name': row['name'],
-                'owner': nickname,
-                'monthly': monthly,
-                'daily': daily
-            })
-        
-        return {
-            'daily_total': round(monthly_total / 30, 2),
-            'monthly_total': monthly_total,
-            'details': details
-        }
+    owners = {
+        m['openid']: m['nickname'] or f"用户{m['openid'][-4:]}"
+        for m in get_family_members_detail(family_id)
+    }
+    return _summarize_debt(_fan_out(owners, _active_debt_rows), owners)
 
 
 def create_family(openid: str, name: str) -> str:
@@ -570,6 +1986,7 @@ def create_family(openid: str, name: str) -> str:
             ''', (family_id, openid))
             
             conn.commit()
+            journal.append('create_family', family_id, openid, name)
             return invite_code
         except sqlite3.IntegrityError:
             # 邀请码重复则重试一次
@@ -591,7 +2008,9 @@ def join_family(openid: str, invite_code: str) -> bool:
                 INSERT INTO family_members (family_id, openid, role)
                 VALUES (?, ?, 'member')
             ''', (family_id, openid))
+            _reset_family_month_totals(cursor, family_id)
             conn.commit()
+            journal.append('join_family', family_id, openid)
             return True
         except sqlite3.IntegrityError:
             return True # 已经在家庭中了
@@ -623,9 +2042,20 @@ def leave_family(openid: str) -> bool:
     """退出家庭组"""
     with get_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute('SELECT family_id FROM family_members WHERE openid = ?', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return False
         cursor.execute('DELETE FROM family_members WHERE openid = ?', (openid,))
+        _reset_family_month_totals(cursor, row['family_id'])
         conn.commit()
-        return cursor.rowcount > 0
+    journal.append('leave_family', row['family_id'], openid)
+    return True
+
+
+def _reset_family_month_totals(cursor, family_id: int):
+    """成员变动后清除家庭月累计，下次记账时按新成员重算"""
+    cursor.execute('DELETE FROM family_month_totals WHERE family_id = ?', (family_id,))
 
 
 def get_family_members_detail(family_id: int) -> list:
@@ -644,22 +2074,22 @@ def get_family_members_detail(family_id: int) -> list:
 
 def get_family_debt_ranking(family_id: int) -> dict:
     """获取家庭成员欠款排行"""
-    members = get_family_members(family_id)
+    members = get_family_members_detail(family_id)
+    rows_by_member = {m['openid']: [] for m in members}
+    for row in _fan_out(rows_by_member, _active_debt_rows):
+        rows_by_member[row['openid']].append(row)
+    
     ranking = []
     total_daily = 0
     total_monthly = 0
     
-    for openid in members:
-        debt = get_daily_debt(openid)
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT nickname FROM users WHERE openid = ?', (openid,))
-            row = cursor.fetchone()
-            nickname = row['nickname'] if row and row['nickname'] else openid[:8]
+    for m in members:
+        openid = m['openid']
+        debt = _summarize_debt(rows_by_member[openid])
         
         ranking.append({
             'openid': openid,
-            'nickname': nickname,
+            'nickname': m['nickname'] or openid[:8],
             'daily': debt['daily_total'],
             'monthly': debt['monthly_total'],
             'details': debt['details']
@@ -677,6 +2107,332 @@ def get_family_debt_ranking(family_id: int) -> dict:
     }
 
 
+# =============================================
+# 调度协调（租约与推送分区任务，均在全局库）
+# =============================================
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """
+    获取或续约租约
+
+    租约不存在、已过期或本来就由 holder 持有时成功，并把到期时间延后 ttl 秒
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO scheduler_leases (name, holder, expires_at)
+            VALUES (?, ?, ?)
+        ''', (name, holder, now + ttl))
+        cursor.execute('''
+            UPDATE scheduler_leases SET holder = ?, expires_at = ?
+            WHERE name = ? AND (holder = ? OR expires_at < ?)
+        ''', (holder, now + ttl, name, holder, now))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def release_lease(name: str, holder: str):
+    """释放自己持有的租约"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM scheduler_leases WHERE name = ? AND holder = ?
+        ''', (name, holder))
+        conn.commit()
+
+
+def create_push_tasks(run_key: str, partitions: int) -> int:
+    """
+    创建推送分区任务（重复调用不会重复创建），并删除其他分区布局下空闲的旧任务
+
+    Returns:
+        新创建的分区数
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO push_tasks (run_key, partition_no, partitions, due_at)
+            VALUES (?, ?, ?, 0)
+        ''', [(run_key, i, partitions) for i in range(partitions)])
+        created = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM push_tasks
+            WHERE run_key != ? AND (status != 'running' OR lease_until < ?)
+        ''', (run_key, time.time()))
+        conn.commit()
+        return created
+
+
+def claim_push_task(holder: str, lease_seconds: float) -> dict:
+    """
+    领取一个已到期或租约已过期的分区任务（按到期时间先后）
+
+    Returns:
+        {'run_key', 'partition_no', 'partitions'}，没有可领取的任务时返回 None
+    """
+    now = time.time()
+    with get_connection() as conn:
+        # 显式 BEGIN IMMEDIATE，保证查询和占用之间不会被其他进程抢先
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('''
+                SELECT run_key, partition_no, partitions FROM push_tasks
+                WHERE (status = 'pending' AND due_at <= ?)
+                   OR (status = 'running' AND lease_until < ?)
+                ORDER BY due_at, partition_no
+                LIMIT 1
+            ''', (now, now))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('''
+                    UPDATE push_tasks SET status = 'running', holder = ?, lease_until = ?
+                    WHERE run_key = ? AND partition_no = ?
+                ''', (holder, now + lease_seconds, row['run_key'], row['partition_no']))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return dict(row) if row else None
+
+
+def renew_push_task(run_key: str, partition_no: int, holder: str, lease_seconds: float) -> bool:
+    """续约分区任务，返回 False 表示租约已被其他进程接手"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE push_tasks SET lease_until = ?
+            WHERE run_key = ? AND partition_no = ? AND holder = ? AND status = 'running'
+        ''', (time.time() + lease_seconds, run_key, partition_no, holder))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def release_push_task(run_key: str, partition_no: int, holder: str) -> bool:
+    """
+    处理完一批后交还分区任务，到期时间更新为分区内最早一位用户的推送时间
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE push_tasks SET status = 'pending', holder = NULL, finished_at = ?,
+                due_at = (
+                    SELECT MIN(next_push_at) FROM users
+                    WHERE push_bucket >= partition_no * ? / partitions
+                    AND push_bucket < (partition_no + 1) * ? / partitions
+                )
+            WHERE run_key = ? AND partition_no = ? AND holder = ?
+        ''', (time.time(), USER_BUCKETS, USER_BUCKETS, run_key, partition_no, holder))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def _wake_push_task(cursor, openid: str, due_at: float):
+    """用户推送时间提前时，把所在分区的到期时间一并提前"""
+    if due_at is None:
+        return
+    cursor.execute('''
+        UPDATE push_tasks SET due_at = ?
+        WHERE status = 'pending' AND (due_at IS NULL OR due_at > ?)
+        AND partition_no = ((? + 1) * partitions - 1) / ?
+    ''', (due_at, due_at, get_user_bucket(openid), USER_BUCKETS))
+
+
+def get_push_targets(partition_no: int, partitions: int, due_before: float, limit: int = None) -> list:
+    """
+    获取分区内已到期的推送用户（分区对应一段连续的哈希桶区间），按到期时间排序
+
+    取消关注和无法触达的用户 next_push_at 为 NULL，不会出现在索引扫描中。
+
+    Returns:
+        [{'openid', 'next_push_at', 'last_interaction_at'}]
+    """
+    low = partition_no * USER_BUCKETS // partitions
+    high = (partition_no + 1) * USER_BUCKETS // partitions
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT openid, next_push_at, last_interaction_at FROM users
+            WHERE next_push_at <= ? AND push_bucket >= ? AND push_bucket < ?
+            ORDER BY next_push_at
+            LIMIT ?
+        ''', (due_before, low, high, limit if limit else -1))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def mark_user_pushed(openid: str, push_date: str):
+    """记录用户当天已推送，并排好下一次推送时间"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT push_time, push_enabled, subscribed FROM users WHERE openid = ?
+        ''', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return
+        next_push_at = None
+        if row['push_enabled'] and row['subscribed']:
+            next_push_at = _next_push_at(row['push_time'], push_date)
+        cursor.execute('''
+            UPDATE users SET last_push_date = ?, next_push_at = ? WHERE openid = ?
+        ''', (push_date, next_push_at, openid))
+        conn.commit()
+
+
+def _next_push_at(push_time: str = None, last_push_date: str = None) -> float:
+    """
+    计算下一次推送的时间戳
+
+    未设置推送时间的用户在默认时间后 PUSH_JITTER_SECONDS 秒内随机错开，
+    自定义时间的用户也加一分钟内的抖动，避免同一时刻集中推送；当天已推送过的从次日算起
+    """
+    now = datetime.now()
+    if push_time:
+        hour, minute = map(int, push_time.split(':'))
+        jitter = random.uniform(0, 60)
+    else:
+        hour, minute = DAILY_PUSH_HOUR, DAILY_PUSH_MINUTE
+        jitter = random.uniform(0, PUSH_JITTER_SECONDS)
+    day = now.date()
+    if last_push_date and last_push_date >= day.isoformat():
+        day = date.fromisoformat(last_push_date) + timedelta(days=1)
+    due = datetime.combine(day, datetime.min.time()).replace(hour=hour, minute=minute)
+    due += timedelta(seconds=jitter)
+    if due < now:
+        due += timedelta(days=1)
+    return due.timestamp()
+
+
+def set_push_time(openid: str, push_time: str = None, enabled: bool = True) -> float:
+    """
+    设置每日推送时间
+
+    Args:
+        push_time: 'HH:MM'，为 None 时使用默认推送时间
+        enabled: False 表示关闭推送
+
+    Returns:
+        下一次推送的时间戳，关闭推送时返回 None
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT last_push_date, subscribed FROM users WHERE openid = ?', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        next_push_at = None
+        if enabled and row['subscribed']:
+            next_push_at = _next_push_at(push_time, row['last_push_date'])
+        cursor.execute('''
+            UPDATE users SET push_time = ?, push_enabled = ?, next_push_at = ?
+            WHERE openid = ?
+        ''', (push_time, 1 if enabled else 0, next_push_at, openid))
+        _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+    journal.append('set_push_time', openid, push_time, enabled)
+    return next_push_at
+
+
+# =============================================
+# 家庭通知发件箱（全局库）
+# =============================================
+
+def enqueue_family_notification(family_id: int, openid: str, category: str,
+                                amount: float, description: str = None):
+    """把一笔家庭成员支出放入发件箱，等待合并发送"""
+    enqueue_family_notifications(family_id, openid, [
+        {'category': category, 'amount': amount, 'description': description}
+    ])
+
+
+def enqueue_family_notifications(family_id: int, openid: str, items: list):
+    """把多笔家庭成员支出一次写入发件箱（items: [{'category', 'amount', 'description'}]）"""
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO family_notify_outbox (family_id, openid, category, amount, description, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(family_id, openid, item['category'], item['amount'], item.get('description'), now)
+              for item in items])
+        conn.commit()
+
+
+def get_due_family_digests(before: float) -> list:
+    """获取最早一条待发通知早于 before 的家庭 id 列表"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT family_id FROM family_notify_outbox
+            GROUP BY family_id
+            HAVING MIN(created_at) <= ?
+        ''', (before,))
+        return [row['family_id'] for row in cursor.fetchall()]
+
+
+def take_family_notifications(family_id: int) -> list:
+    """
+    取出并删除家庭的全部待发通知（同一批只会被一个进程取到）
+
+    Returns:
+        [{'openid', 'category', 'amount', 'description', 'created_at'}]，按记账先后排序
+    """
+    with get_connection() as conn:
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('''
+                SELECT id, openid, category, amount, description, created_at
+                FROM family_notify_outbox WHERE family_id = ?
+                ORDER BY id
+            ''', (family_id,))
+            rows = [dict(row) for row in cursor.fetchall()]
+            if rows:
+                cursor.execute('''
+                    DELETE FROM family_notify_outbox WHERE family_id = ? AND id <= ?
+                ''', (family_id, rows[-1]['id']))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return rows
+
+
+# =============================================
+# 预算预警（全局库）
+# =============================================
+
+def take_budget_alerts(limit: int = 100) -> list:
+    """
+    取出待发送的预算预警并标记为已发送（同一条只会被一个进程取到）
+
+    Returns:
+        [{'id', 'scope', 'scope_id', 'month', 'threshold', 'spent', 'budget'}]
+    """
+    with get_connection() as conn:
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('''
+                SELECT id, scope, scope_id, month, threshold, spent, budget
+                FROM budget_alerts WHERE sent_at IS NULL
+                ORDER BY id LIMIT ?
+            ''', (limit,))
+            rows = [dict(row) for row in cursor.fetchall()]
+            cursor.executemany('UPDATE budget_alerts SET sent_at = ? WHERE id = ?', [
+                (time.time(), row['id']) for row in rows
+            ])
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return rows
+
+
 if __name__ == '__main__':
     # 测试代码
     init_db()
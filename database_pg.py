@@ -0,0 +1,1621 @@
+"""
+PostgreSQL 数据库操作模块
+
+与 database.py 提供相同的函数接口（见 repository.REPOSITORY_API），
+在 DATABASE_BACKEND=postgres 时使用：
+- 每个进程首次访问时创建 ThreadedConnectionPool，连接串来自 DATABASE_URL
+- 收支汇总、预算、欠款等统计在服务端一次聚合完成
+- 单库即可承载并发写入，不使用 SQLite 的分库
+
+依赖 psycopg2（pip install psycopg2-binary）。
+"""
+
+import random
+import string
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+import category_matcher
+from config import DATABASE_URL, DATABASE_POOL_SIZE, BILLING_CHUNK
+from database import (
+    DEFAULT_CATEGORY_ALIASES, RECURRING_CATEGORIES, USER_BUCKETS, get_user_bucket, _next_push_at,
+    _search_segments, _summarize_debt, _ledger_today, _month_key, _month_range, _crossed_thresholds,
+    _budget_usage, _learnable, _term_end, _due_installments, _posting_time
+)
+
+try:
+    import psycopg2
+    import psycopg2.errors
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+
+# 进程内连接池（延迟创建，gunicorn fork 之后各 worker 各自建立连接）
+_pool = None
+_pool_lock = threading.Lock()
+
+# 分类驻留缓存：名称 -> id（分类只增不改）
+_category_ids = {}
+# 事务中新建、尚未提交的分类 {id(连接): {名称: 分类 id}}：提交后才写入上面的缓存，回滚时丢弃
+_uncommitted_categories = {}
+
+# 与 SQLite 后端的 CURRENT_TIMESTAMP 保持一致，时间统一按 UTC 存储
+UTC_NOW = "(now() AT TIME ZONE 'UTC')"
+
+
+def _get_pool():
+    """获取（必要时创建）连接池"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if psycopg2 is None:
+                    raise RuntimeError("PostgreSQL 后端需要安装 psycopg2：pip install psycopg2-binary")
+                if not DATABASE_URL:
+                    raise RuntimeError("请通过环境变量 DATABASE_URL 配置 PostgreSQL 连接串")
+                _pool = psycopg2.pool.ThreadedConnectionPool(1, DATABASE_POOL_SIZE, DATABASE_URL)
+    return _pool
+
+
+def close_pool():
+    """关闭连接池（进程 fork 之后或退出前调用）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def warm_up():
+    """建立连接池并预热分类缓存，在 worker 启动后、处理第一个请求前调用"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT id, name FROM categories')
+        for row in cursor.fetchall():
+            _category_ids[row['name']] = row['id']
+
+
+@contextmanager
+def get_connection():
+    """从连接池借出连接的上下文管理器，归还前回滚未提交的事务"""
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        _uncommitted_categories.pop(id(conn), None)
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(conn, close=broken)
+
+
+def _cursor(conn):
+    """返回字典行游标"""
+    return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+def init_db():
+    """初始化数据库表"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS users (
+                openid TEXT PRIMARY KEY,
+                nickname TEXT,
+                created_at TIMESTAMP DEFAULT {UTC_NOW},
+                push_bucket INTEGER,
+                last_push_date TEXT,
+                push_time TEXT,
+                push_enabled INTEGER DEFAULT 1,
+                next_push_at DOUBLE PRECISION,
+                subscribed INTEGER DEFAULT 1,
+                last_interaction_at DOUBLE PRECISION
+            )
+        ''')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS push_bucket INTEGER')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS last_push_date TEXT')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS push_time TEXT')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS push_enabled INTEGER DEFAULT 1')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS next_push_at DOUBLE PRECISION')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS subscribed INTEGER DEFAULT 1')
+        cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS last_interaction_at DOUBLE PRECISION')
+        cursor.execute('SELECT openid FROM users WHERE push_bucket IS NULL')
+        cursor.executemany('UPDATE users SET push_bucket = %s WHERE openid = %s', [
+            (get_user_bucket(row['openid']), row['openid']) for row in cursor.fetchall()
+        ])
+        cursor.execute('''
+            SELECT openid, push_time, last_push_date FROM users
+            WHERE next_push_at IS NULL AND push_enabled = 1 AND subscribed = 1
+        ''')
+        cursor.executemany('UPDATE users SET next_push_at = %s WHERE openid = %s', [
+            (_next_push_at(row['push_time'], row['last_push_date']), row['openid'])
+            for row in cursor.fetchall()
+        ])
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_next_push ON users (next_push_at, push_bucket)
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS push_tasks (
+                run_key TEXT NOT NULL,
+                partition_no INTEGER NOT NULL,
+                partitions INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                holder TEXT,
+                lease_until DOUBLE PRECISION,
+                finished_at DOUBLE PRECISION,
+                due_at DOUBLE PRECISION,
+                PRIMARY KEY (run_key, partition_no)
+            )
+        ''')
+        cursor.execute('ALTER TABLE push_tasks ADD COLUMN IF NOT EXISTS due_at DOUBLE PRECISION')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                id SERIAL PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS category_aliases (
+                openid TEXT NOT NULL DEFAULT '',
+                alias TEXT NOT NULL,
+                category_id INTEGER NOT NULL REFERENCES categories(id),
+                PRIMARY KEY (openid, alias)
+            )
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS expenses (
+                id BIGSERIAL PRIMARY KEY,
+                openid TEXT NOT NULL,
+                type TEXT NOT NULL,
+                amount DOUBLE PRECISION NOT NULL,
+                category TEXT,
+                description TEXT,
+                created_at TIMESTAMP DEFAULT {UTC_NOW},
+                category_id INTEGER REFERENCES categories(id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_expenses_openid_created
+            ON expenses (openid, created_at)
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS recurring_expenses (
+                id BIGSERIAL PRIMARY KEY,
+                openid TEXT NOT NULL,
+                type TEXT NOT NULL,
+                name TEXT NOT NULL,
+                total_amount DOUBLE PRECISION,
+                total_months INTEGER,
+                monthly_amount DOUBLE PRECISION NOT NULL,
+                start_date DATE,
+                end_date DATE,
+                is_active INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT {UTC_NOW}
+            )
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS families (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                invite_code TEXT UNIQUE NOT NULL,
+                creator_openid TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT {UTC_NOW}
+            )
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS family_members (
+                id SERIAL PRIMARY KEY,
+                family_id INTEGER NOT NULL REFERENCES families(id),
+                openid TEXT NOT NULL,
+                role TEXT DEFAULT 'member',
+                joined_at TIMESTAMP DEFAULT {UTC_NOW},
+                UNIQUE (family_id, openid)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS family_notify_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                family_id INTEGER NOT NULL,
+                openid TEXT NOT NULL,
+                category TEXT,
+                amount DOUBLE PRECISION NOT NULL,
+                description TEXT,
+                created_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_family_outbox_family
+            ON family_notify_outbox (family_id, created_at)
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS budgets (
+                openid TEXT PRIMARY KEY,
+                monthly_amount DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMP DEFAULT {UTC_NOW}
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS month_totals (
+                openid TEXT NOT NULL,
+                month TEXT NOT NULL,
+                expense DOUBLE PRECISION NOT NULL DEFAULT 0,
+                income DOUBLE PRECISION NOT NULL DEFAULT 0,
+                entries INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (openid, month)
+            )
+        ''')
+        cursor.execute('ALTER TABLE month_totals ADD COLUMN IF NOT EXISTS entries INTEGER NOT NULL DEFAULT 0')
+
+        # 固定开支入账：每个分期每月只入账一次
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recurring_postings (
+                recurring_id BIGINT NOT NULL,
+                period TEXT NOT NULL,
+                openid TEXT NOT NULL,
+                amount DOUBLE PRECISION NOT NULL,
+                expense_id BIGINT,
+                posted_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (recurring_id, period)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_recurring_postings_openid ON recurring_postings (openid, period)
+        ''')
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS family_budgets (
+                family_id INTEGER PRIMARY KEY REFERENCES families(id),
+                monthly_amount DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMP DEFAULT {UTC_NOW}
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS family_month_totals (
+                family_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                expense DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (family_id, month)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS budget_alerts (
+                id BIGSERIAL PRIMARY KEY,
+                scope TEXT NOT NULL,
+                scope_id TEXT NOT NULL,
+                month TEXT NOT NULL,
+                threshold INTEGER NOT NULL,
+                spent DOUBLE PRECISION NOT NULL,
+                budget DOUBLE PRECISION NOT NULL,
+                created_at DOUBLE PRECISION NOT NULL,
+                sent_at DOUBLE PRECISION,
+                UNIQUE (scope, scope_id, month, threshold)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_budget_alerts_pending
+            ON budget_alerts (id) WHERE sent_at IS NULL
+        ''')
+
+        for name, aliases in DEFAULT_CATEGORY_ALIASES.items():
+            category_id = _intern_category(cursor, name)
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO category_aliases (openid, alias, category_id) VALUES %s
+                ON CONFLICT DO NOTHING
+            ''', [('', alias, category_id) for alias in aliases])
+        _commit(conn)
+
+        # 备注的三元组索引用于关键词搜索，需要 pg_trgm 扩展（无权限时跳过）
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_expenses_description_trgm
+                ON expenses USING gin (description gin_trgm_ops)
+            ''')
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"[数据库] 跳过 pg_trgm 索引: {e}")
+
+        print("数据库初始化完成")
+
+
+def drop_tables():
+    """删除所有表（仅用于测试）"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DROP TABLE IF EXISTS budgets, family_members, families, recurring_expenses,
+                                 expenses, category_aliases, categories, users,
+                                 scheduler_leases, push_tasks, family_notify_outbox,
+                                 month_totals, family_budgets, family_month_totals,
+                                 budget_alerts, recurring_postings, schema_version, backfill_progress CASCADE
+        ''')
+        conn.commit()
+    _category_ids.clear()
+
+
+# =============================================
+# 用户
+# =============================================
+
+def add_user(openid: str, nickname: str = None):
+    """添加用户（如果不存在）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        next_push_at = _next_push_at()
+        cursor.execute('''
+            INSERT INTO users (openid, nickname, push_bucket, next_push_at) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (openid) DO NOTHING
+        ''', (openid, nickname, get_user_bucket(openid), next_push_at))
+        if cursor.rowcount:
+            _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+
+
+def record_interaction(openid: str):
+    """记录用户主动互动（48 小时客服消息窗口），必要时重新排入推送队列"""
+    now = time.time()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT push_time, push_enabled, last_push_date, next_push_at,
+                   subscribed, last_interaction_at
+            FROM users WHERE openid = %s
+        ''', (openid,))
+        row = cursor.fetchone()
+        if row is None:
+            next_push_at = _next_push_at()
+            cursor.execute('''
+                INSERT INTO users (openid, push_bucket, next_push_at, last_interaction_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (openid) DO NOTHING
+            ''', (openid, get_user_bucket(openid), next_push_at, now))
+            _wake_push_task(cursor, openid, next_push_at)
+            conn.commit()
+            return
+
+        next_push_at = row['next_push_at']
+        requeue = next_push_at is None and row['push_enabled']
+        if (row['subscribed'] and not requeue and row['last_interaction_at']
+                and now - row['last_interaction_at'] < 60):
+            return
+        if requeue:
+            next_push_at = _next_push_at(row['push_time'], row['last_push_date'])
+        cursor.execute('''
+            UPDATE users SET subscribed = 1, last_interaction_at = %s, next_push_at = %s
+            WHERE openid = %s
+        ''', (now, next_push_at, openid))
+        if requeue:
+            _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+
+
+def unsubscribe_user(openid: str):
+    """用户取消关注：移出推送队列"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE users SET subscribed = 0, next_push_at = NULL WHERE openid = %s
+        ''', (openid,))
+        conn.commit()
+
+
+def suspend_push(openid: str, until: float = None):
+    """暂停推送：推迟到 until，为 None 时移出推送队列（用户下次互动时恢复）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('UPDATE users SET next_push_at = %s WHERE openid = %s', (until, openid))
+        conn.commit()
+
+
+def update_nickname(openid: str, nickname: str) -> bool:
+    """更新用户昵称"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('UPDATE users SET nickname = %s WHERE openid = %s', (nickname, openid))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def get_user(openid: str) -> dict:
+    """获取用户信息，不存在时返回 None"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT openid, nickname, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') as created_at,
+                   push_time, push_enabled, next_push_at, subscribed, last_interaction_at
+            FROM users WHERE openid = %s
+        ''', (openid,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def get_all_users() -> list:
+    """获取所有仍在关注的用户的 OpenID 列表"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT openid FROM users WHERE subscribed = 1')
+        return [row['openid'] for row in cursor.fetchall()]
+
+
+# =============================================
+# 分类
+# =============================================
+
+def _intern_category(cursor, name: str) -> int:
+    """获取分类 id，不存在时创建（本事务新建的分类由 _commit() 提交后再写入缓存）"""
+    category_id = _category_ids.get(name)
+    if category_id is None:
+        # xmax = 0 表示本语句新插入的行
+        cursor.execute('''
+            INSERT INTO categories (name) VALUES (%s)
+            ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+            RETURNING id, xmax = 0 as created
+        ''', (name,))
+        row = cursor.fetchone()
+        category_id = row['id']
+        key = id(cursor.connection)
+        if row['created'] or name in _uncommitted_categories.get(key, {}):
+            _uncommitted_categories.setdefault(key, {})[name] = category_id
+        else:
+            _category_ids[name] = category_id
+    return category_id
+
+
+def _commit(conn):
+    """提交事务，再把本事务新建的分类写入进程缓存"""
+    conn.commit()
+    _category_ids.update(_uncommitted_categories.pop(id(conn), {}))
+
+
+def _find_category(cursor, openid: str, name: str):
+    """按 用户别名 > 全局别名 > 分类原名 的顺序查找已有的分类 id，找不到时为 None（不新建分类）"""
+    cursor.execute('''
+        SELECT category_id FROM category_aliases
+        WHERE alias = %s AND openid IN (%s, '')
+        ORDER BY openid DESC
+        LIMIT 1
+    ''', (name, openid))
+    row = cursor.fetchone()
+    if row:
+        return row['category_id']
+    category_id = _category_ids.get(name)
+    if category_id is None:
+        cursor.execute('SELECT id FROM categories WHERE name = %s', (name,))
+        row = cursor.fetchone()
+        category_id = row['id'] if row else None
+    return category_id
+
+
+def _resolve_category(cursor, openid: str, name: str) -> int:
+    """按 用户别名 > 全局别名 > 分类原名 的顺序解析分类 id，都没有时新建分类"""
+    name = (name or '').strip() or '其他'
+    category_id = _find_category(cursor, openid, name)
+    return _intern_category(cursor, name) if category_id is None else category_id
+
+
+def _category_name(cursor, category_id: int) -> str:
+    if category_id is None:
+        return None
+    cursor.execute('SELECT name FROM categories WHERE id = %s', (category_id,))
+    row = cursor.fetchone()
+    return row['name'] if row else None
+
+
+def _infer_category(cursor, openid: str, name: str, text: str = None) -> tuple:
+    """
+    记账分类推断：别名精确匹配 > 用户别名（子串）> 关键词词典 > 分类原名，
+    明确写了分类时把较短的备注学习为用户别名
+
+    Returns:
+        (分类 id, 是否为推断结果)
+    """
+    name = (name or '').strip()
+    cursor.execute('''
+        SELECT a.alias, a.category_id, c.name FROM category_aliases a
+        JOIN categories c ON c.id = a.category_id
+        WHERE a.openid = %s
+    ''', (openid,))
+    user_aliases = {row['alias']: (row['category_id'], row['name']) for row in cursor.fetchall()}
+
+    inferred = None
+    if name not in user_aliases:
+        cursor.execute("SELECT 1 FROM category_aliases WHERE openid = '' AND alias = %s", (name,))
+        if cursor.fetchone() is None:
+            learned = {alias: category for alias, (_, category) in user_aliases.items()}
+            inferred = category_matcher.infer_category(name or text, learned)
+    category_id = _resolve_category(cursor, openid, inferred or name)
+
+    if (name and inferred in (None, name) and _learnable(text)
+            and user_aliases.get(text, (None,))[0] != category_id):
+        cursor.execute('''
+            INSERT INTO category_aliases (openid, alias, category_id) VALUES (%s, %s, %s)
+            ON CONFLICT (openid, alias) DO UPDATE SET category_id = EXCLUDED.category_id
+        ''', (openid, text, category_id))
+    return category_id, inferred not in (None, name)
+
+
+def infer_category(openid: str, name: str, text: str = None) -> tuple:
+    """推断记账分类，返回 (分类 id, 标准分类名称, 是否为推断结果)"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        category_id, inferred = _infer_category(cursor, openid, name, text)
+        category = _category_name(cursor, category_id)
+        _commit(conn)
+        return category_id, category, inferred
+
+
+def resolve_category(openid: str, name: str) -> tuple:
+    """
+    解析用户输入的分类
+
+    Returns:
+        (分类 id, 标准分类名称)
+    """
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        category_id = _resolve_category(cursor, openid, name)
+        category = _category_name(cursor, category_id)
+        _commit(conn)
+        return category_id, category
+
+
+def merge_category(openid: str, source: str, target: str) -> int:
+    """
+    合并分类：把用户的 source 分类记录全部归入 target，并记住别名供以后记账使用
+
+    Returns:
+        被迁移的记录条数，source 不是已有的分类时为 None
+    """
+    source = source.strip()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        source_id = _find_category(cursor, openid, source)
+        if source_id is None:
+            return None
+        target_id = _resolve_category(cursor, openid, target)
+        if source_id == target_id:
+            _commit(conn)
+            return 0
+
+        aliases = {source, _category_name(cursor, source_id)}
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO category_aliases (openid, alias, category_id) VALUES %s
+            ON CONFLICT (openid, alias) DO UPDATE SET category_id = EXCLUDED.category_id
+        ''', [(openid, alias, target_id) for alias in aliases])
+        cursor.execute('''
+            UPDATE category_aliases SET category_id = %s
+            WHERE openid = %s AND category_id = %s
+        ''', (target_id, openid, source_id))
+        cursor.execute('''
+            UPDATE expenses SET category_id = %s WHERE openid = %s AND category_id = %s
+        ''', (target_id, openid, source_id))
+        moved = cursor.rowcount
+        _commit(conn)
+        return moved
+
+
+def get_user_categories(openid: str) -> list:
+    """获取用户使用过的分类及其别名映射"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT e.category_id, c.name as category, COUNT(*) as count,
+                   COALESCE((
+                       SELECT array_agg(a.alias ORDER BY a.alias) FROM category_aliases a
+                       WHERE a.openid = %s AND a.category_id = e.category_id
+                   ), '{}') as aliases
+            FROM expenses e
+            JOIN categories c ON c.id = e.category_id
+            WHERE e.openid = %s
+            GROUP BY e.category_id, c.name
+            ORDER BY count DESC
+        ''', (openid, openid))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+# =============================================
+# 记账
+# =============================================
+
+def add_expense(openid: str, expense_type: str, amount: float,
+                category: str = None, description: str = None,
+                category_id: int = None) -> int:
+    """添加记账记录，返回记录 ID"""
+    return add_expenses(openid, [{
+        'type': expense_type, 'amount': amount, 'category': category,
+        'category_id': category_id, 'description': description,
+    }])[0]['id']
+
+
+def add_expenses(openid: str, entries: list) -> list:
+    """在一个事务内批量添加记账记录，返回补充了 id、category_id、category 的记录"""
+    records = [dict({'category': None, 'category_id': None, 'description': None}, **entry)
+               for entry in entries]
+    if not records:
+        return []
+    expense = sum(r['amount'] for r in records if r['type'] == 'expense')
+    income = sum(r['amount'] for r in records if r['type'] == 'income')
+
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        for record in records:
+            if record['category_id'] is None and record.pop('infer', False):
+                name = record['category']
+                record['category_id'], inferred = _infer_category(
+                    cursor, openid, name, record['description'])
+                if inferred and name:
+                    # 分类词被推断为其他分类（如商户名）时保留到备注里
+                    record['description'] = ' '.join(filter(None, [name, record['description']]))
+            elif record['category_id'] is None and record['category'] is not None:
+                record['category_id'] = _resolve_category(cursor, openid, record['category'])
+            record['category'] = _category_name(cursor, record['category_id'])
+        rows = psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO expenses (openid, type, amount, category_id, description) VALUES %s
+            RETURNING id
+        ''', [(openid, r['type'], r['amount'], r['category_id'], r['description'])
+              for r in records], fetch=True)
+        # 同一条 INSERT 中序列按 VALUES 顺序分配
+        for record, expense_id in zip(records, sorted(row['id'] for row in rows)):
+            record['id'] = expense_id
+        spent_before = _add_month_total(cursor, openid, expense, income, len(records))
+        if expense:
+            _check_budget_alerts(cursor, openid, spent_before, expense)
+        _commit(conn)
+        return records
+
+
+def _sum_month(cursor, openids: list, month: str = None) -> dict:
+    """从记账明细汇总某月（默认本月）收支（月累计缺失时补算）"""
+    cursor.execute('''
+        SELECT
+            COALESCE(SUM(amount) FILTER (WHERE type = 'expense'), 0) as expense,
+            COALESCE(SUM(amount) FILTER (WHERE type = 'income'), 0) as income,
+            COUNT(*) as entries
+        FROM expenses
+        WHERE openid = ANY(%s) AND created_at >= %s AND created_at < %s
+    ''', (list(openids), *_month_range(month)))
+    return dict(cursor.fetchone())
+
+
+def _add_month_total(cursor, openid: str, expense: float, income: float, entries: int,
+                     month: str = None) -> float:
+    """
+    把刚插入的记账计入月累计（与插入在同一事务内）
+
+    Args:
+        month: 计入的月份键，默认本月；定时入账传入认领时的月份
+
+    Returns:
+        计入前的月累计支出
+    """
+    month = month or _month_key()
+    cursor.execute('''
+        UPDATE month_totals SET expense = expense + %s, income = income + %s, entries = entries + %s
+        WHERE openid = %s AND month = %s
+        RETURNING expense
+    ''', (expense, income, entries, openid, month))
+    row = cursor.fetchone()
+    if row is None:
+        # 本月第一笔或升级前已有记录：从明细补算一次（已包含本次写入）；
+        # 并发补算冲突时对方已计入它自己写入的记录，这里只需再加上本次的金额
+        totals = _sum_month(cursor, [openid], month)
+        cursor.execute('''
+            INSERT INTO month_totals (openid, month, expense, income, entries) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (openid, month) DO UPDATE
+            SET expense = month_totals.expense + %s, income = month_totals.income + %s,
+                entries = month_totals.entries + %s
+            RETURNING expense
+        ''', (openid, month, totals['expense'], totals['income'], totals['entries'], expense, income, entries))
+        row = cursor.fetchone()
+    return row['expense'] - expense
+
+
+def _check_budget_alerts(cursor, openid: str, spent_before: float, amount: float, month: str = None):
+    """
+    支出入账后检查个人和家庭预算，跨过阈值时写入预警（每月每个阈值只写一次）
+
+    只比较入账前后的月累计，不重新汇总明细；家庭月累计在同一事务内同步累加。
+    month 与 _add_month_total 计入的月份一致，默认本月。
+    """
+    month = month or _month_key()
+    cursor.execute('''
+        SELECT (SELECT monthly_amount FROM budgets WHERE openid = %s) as budget,
+               fm.family_id, fb.monthly_amount as family_budget
+        FROM (SELECT 1) one
+        LEFT JOIN family_members fm ON fm.openid = %s
+        LEFT JOIN family_budgets fb ON fb.family_id = fm.family_id
+    ''', (openid, openid))
+    row = cursor.fetchone()
+    alerts = [('user', openid, t, spent_before + amount, row['budget'])
+              for t in _crossed_thresholds(spent_before, spent_before + amount, row['budget'])]
+
+    family_id = row['family_id']
+    if family_id is not None:
+        cursor.execute('''
+            UPDATE family_month_totals SET expense = expense + %s
+            WHERE family_id = %s AND month = %s
+            RETURNING expense
+        ''', (amount, family_id, month))
+        total = cursor.fetchone()
+        if total is None:
+            # 本月第一笔或成员变动后：按成员明细重算（已包含本笔）
+            cursor.execute('SELECT openid FROM family_members WHERE family_id = %s', (family_id,))
+            spent = _sum_month(cursor, [r['openid'] for r in cursor.fetchall()], month)['expense']
+            cursor.execute('''
+                INSERT INTO family_month_totals (family_id, month, expense) VALUES (%s, %s, %s)
+                ON CONFLICT (family_id, month) DO UPDATE
+                SET expense = family_month_totals.expense + %s
+                RETURNING expense
+            ''', (family_id, month, spent, amount))
+            total = cursor.fetchone()
+        family_after = total['expense']
+        alerts += [('family', str(family_id), t, family_after, row['family_budget'])
+                   for t in _crossed_thresholds(family_after - amount, family_after, row['family_budget'])]
+
+    now = time.time()
+    for scope, scope_id, threshold, spent, budget in alerts:
+        cursor.execute('''
+            INSERT INTO budget_alerts (scope, scope_id, month, threshold, spent, budget, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (scope, scope_id, month, threshold) DO NOTHING
+        ''', (scope, scope_id, month, threshold, spent, budget, now))
+
+
+def search_expenses(openid: str, keyword: str, days: int = 365, limit: int = 20) -> dict:
+    """按关键词搜索分类和备注，一次查询返回匹配记录和合计"""
+    result = {'count': 0, 'expense': 0, 'income': 0, 'records': []}
+    segments = _search_segments(keyword)
+    if not segments:
+        return result
+
+    conditions = []
+    params = [openid, days]
+    for segment in segments:
+        pattern = f'%{segment}%'
+        conditions.append('''(
+            e.description ILIKE %s OR e.category ILIKE %s
+            OR e.category_id IN (SELECT id FROM categories WHERE name ILIKE %s)
+        )''')
+        params.extend([pattern, pattern, pattern])
+    params.append(limit)
+
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT e.id, e.type, e.amount, COALESCE(c.name, e.category) as category,
+                   e.category_id, e.description,
+                   to_char(e.created_at, 'YYYY-MM-DD') as date,
+                   COUNT(*) OVER () as match_count,
+                   SUM(e.amount) FILTER (WHERE e.type = 'expense') OVER () as expense_total,
+                   SUM(e.amount) FILTER (WHERE e.type = 'income') OVER () as income_total
+            FROM expenses e
+            LEFT JOIN categories c ON c.id = e.category_id
+            WHERE e.openid = %s
+            AND e.created_at >= ({UTC_NOW})::date - %s
+            AND {' AND '.join(conditions)}
+            ORDER BY e.created_at DESC
+            LIMIT %s
+        ''', params)
+        rows = cursor.fetchall()
+
+    if rows:
+        result['count'] = rows[0]['match_count']
+        result['expense'] = rows[0]['expense_total'] or 0
+        result['income'] = rows[0]['income_total'] or 0
+        result['records'] = [
+            {k: row[k] for k in ('id', 'type', 'amount', 'category', 'category_id', 'description', 'date')}
+            for row in rows
+        ]
+    return result
+
+
+def get_today_summary(openid: str) -> dict:
+    """获取用户今日收支统计（收入、支出在一次查询中聚合）"""
+    today = _ledger_today()
+
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        # 自动入账的固定开支/贷款按 recurring_postings.expense_id 关联
+        cursor.execute('''
+            SELECT COALESCE(SUM(e.amount) FILTER (WHERE e.type = 'income'), 0) as income,
+                   COALESCE(SUM(e.amount) FILTER (WHERE e.type = 'expense'), 0) as expense,
+                   COALESCE(SUM(e.amount) FILTER (WHERE p.expense_id IS NOT NULL), 0) as recurring
+            FROM expenses e
+            LEFT JOIN recurring_postings p ON p.expense_id = e.id
+            WHERE e.openid = %s AND e.created_at >= %s AND e.created_at < %s::date + 1
+        ''', (openid, today, today))
+        totals = cursor.fetchone()
+
+        cursor.execute('''
+            SELECT e.type, e.amount, COALESCE(c.name, e.category) as category, e.category_id,
+                   e.description, to_char(e.created_at, 'YYYY-MM-DD HH24:MI:SS') as created_at
+            FROM expenses e
+            LEFT JOIN categories c ON c.id = e.category_id
+            WHERE e.openid = %s AND e.created_at >= %s AND e.created_at < %s::date + 1
+            ORDER BY e.created_at DESC
+        ''', (openid, today, today))
+        records = [dict(row) for row in cursor.fetchall()]
+
+    return {
+        'income': totals['income'],
+        'expense': totals['expense'],
+        'balance': totals['income'] - totals['expense'],
+        'recurring': totals['recurring'],
+        'records': records
+    }
+
+
+def get_month_summary(openid: str) -> dict:
+    """获取用户本月收支统计（单次服务端聚合）"""
+    month_start = _ledger_today().replace(day=1)
+
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT COALESCE(SUM(amount) FILTER (WHERE type = 'income'), 0) as income,
+                   COALESCE(SUM(amount) FILTER (WHERE type = 'expense'), 0) as expense,
+                   COUNT(DISTINCT created_at::date) as days
+            FROM expenses
+            WHERE openid = %s AND created_at >= %s
+        ''', (openid, month_start))
+        row = cursor.fetchone()
+
+    return {
+        'income': row['income'],
+        'expense': row['expense'],
+        'balance': row['income'] - row['expense'],
+        'days': row['days']
+    }
+
+
+def get_expense_history(openid: str, days: int = 30) -> list:
+    """获取用户历史记录"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT e.id, e.type, e.amount, COALESCE(c.name, e.category) as category,
+                   e.category_id, e.description,
+                   to_char(e.created_at, 'YYYY-MM-DD') as date,
+                   to_char(e.created_at, 'HH24:MI:SS') as time
+            FROM expenses e
+            LEFT JOIN categories c ON c.id = e.category_id
+            WHERE e.openid = %s AND e.created_at >= ({UTC_NOW})::date - %s
+            ORDER BY e.created_at DESC
+            LIMIT 50
+        ''', (openid, days))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_category_stats(openid: str, days: int = 30) -> dict:
+    """获取分类统计（按 category_id 分组，合计由窗口函数一并返回）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT e.category_id, COALESCE(c.name, e.category) as category,
+                   SUM(e.amount) as total, COUNT(*) as count
+            FROM expenses e
+            LEFT JOIN categories c ON c.id = e.category_id
+            WHERE e.openid = %s AND e.type = 'expense'
+            AND e.created_at >= ({UTC_NOW})::date - %s
+            GROUP BY e.category_id, COALESCE(c.name, e.category)
+            ORDER BY total DESC
+        ''', (openid, days))
+        categories = [dict(row) for row in cursor.fetchall()]
+
+    return {
+        'total': sum(c['total'] for c in categories),
+        'categories': categories
+    }
+
+
+# =============================================
+# 预算
+# =============================================
+
+def set_budget(openid: str, amount: float) -> bool:
+    """设置月预算"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            INSERT INTO budgets (openid, monthly_amount, updated_at)
+            VALUES (%s, %s, {UTC_NOW})
+            ON CONFLICT (openid) DO UPDATE
+            SET monthly_amount = EXCLUDED.monthly_amount, updated_at = EXCLUDED.updated_at
+        ''', (openid, amount))
+        conn.commit()
+        return True
+
+
+def get_month_activity(openid: str) -> dict:
+    """本月记账活跃度 {'entries': 本月记账笔数, 'days': 本月已过天数}（读取月累计）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT expense, income, entries FROM month_totals WHERE openid = %s AND month = %s
+        ''', (openid, _month_key()))
+        row = cursor.fetchone()
+        if row is None or (not row['entries'] and (row['expense'] or row['income'])):
+            row = _sum_month(cursor, [openid])
+    return {'entries': row['entries'], 'days': _ledger_today().day}
+
+
+def get_budget(openid: str) -> dict:
+    """获取预算及使用情况（本月支出读取月累计）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT (SELECT monthly_amount FROM budgets WHERE openid = %s) as budget,
+                   (SELECT expense FROM month_totals WHERE openid = %s AND month = %s) as spent
+        ''', (openid, openid, _month_key()))
+        row = cursor.fetchone()
+        spent = row['spent']
+        if spent is None:
+            spent = _sum_month(cursor, [openid])['expense']
+    return _budget_usage(row['budget'], spent)
+
+
+def set_family_budget(family_id: int, amount: float) -> bool:
+    """设置家庭月预算"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            INSERT INTO family_budgets (family_id, monthly_amount, updated_at)
+            VALUES (%s, %s, {UTC_NOW})
+            ON CONFLICT (family_id) DO UPDATE
+            SET monthly_amount = EXCLUDED.monthly_amount, updated_at = EXCLUDED.updated_at
+        ''', (family_id, amount))
+        conn.commit()
+        return True
+
+
+def get_family_budget(family_id: int) -> dict:
+    """获取家庭预算及使用情况（本月支出为全部成员的月累计之和）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT (SELECT monthly_amount FROM family_budgets WHERE family_id = %s) as budget,
+                   (SELECT expense FROM family_month_totals
+                    WHERE family_id = %s AND month = %s) as spent
+        ''', (family_id, family_id, _month_key()))
+        row = cursor.fetchone()
+        spent = row['spent']
+        if spent is None:
+            cursor.execute('SELECT openid FROM family_members WHERE family_id = %s', (family_id,))
+            spent = _sum_month(cursor, [r['openid'] for r in cursor.fetchall()])['expense']
+    return _budget_usage(row['budget'], spent)
+
+
+# =============================================
+# 固定开支/贷款
+# =============================================
+
+def add_recurring_expense(openid: str, expense_type: str, name: str,
+                          total_amount: float = None, total_months: int = None,
+                          monthly_amount: float = None) -> int:
+    """添加固定开支/贷款，返回记录 ID"""
+    if total_amount is not None and total_months is not None:
+        monthly_amount = round(total_amount / total_months, 2)
+
+    if monthly_amount is None:
+        raise ValueError("必须提供 monthly_amount 或 (total_amount + total_months)")
+
+    start_date = _ledger_today()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            INSERT INTO recurring_expenses
+            (openid, type, name, total_amount, total_months, monthly_amount, start_date, end_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (openid, expense_type, name, total_amount, total_months, monthly_amount,
+              start_date, _term_end(start_date, total_months, expense_type)))
+        recurring_id = cursor.fetchone()['id']
+        conn.commit()
+        return recurring_id
+
+
+_RECURRING_COLUMNS = '''
+    r.id, r.openid, r.type, r.name, r.total_amount, r.total_months, r.monthly_amount,
+    to_char(r.start_date, 'YYYY-MM-DD') as start_date,
+    to_char(r.end_date, 'YYYY-MM-DD') as end_date
+'''
+
+_ACTIVE_DEBT_CONDITION = f'''
+    r.is_active = 1 AND (r.end_date IS NULL OR r.end_date >= ({UTC_NOW})::date)
+'''
+
+
+def get_recurring_expenses(openid: str) -> list:
+    """获取用户的所有固定开支/贷款"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT {_RECURRING_COLUMNS}
+            FROM recurring_expenses r
+            WHERE r.openid = %s AND r.is_active = 1
+            ORDER BY r.type, r.monthly_amount DESC
+        ''', (openid,))
+        rows = [dict(row) for row in cursor.fetchall()]
+    for row in rows:
+        del row['openid']
+    return rows
+
+
+def delete_recurring_expense(openid: str, expense_id: int) -> bool:
+    """删除（停用）固定开支/贷款"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE recurring_expenses SET is_active = 0 WHERE id = %s AND openid = %s
+        ''', (expense_id, openid))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def expire_recurring_expenses(today: date = None) -> list:
+    """停用已过结束日期的贷款/负债，返回本次停用的记录（UPDATE … RETURNING，每条只由一个进程停用）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE recurring_expenses r SET is_active = 0
+            WHERE r.is_active = 1 AND r.end_date < %s
+            RETURNING r.id, r.openid, r.type, r.name, r.total_amount, r.total_months,
+                      to_char(r.end_date, 'YYYY-MM-DD') as end_date
+        ''', (today or _ledger_today(),))
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.commit()
+        return rows
+
+
+def post_recurring_charges(today: date = None, chunk: int = None) -> list:
+    """
+    把已到还款日的固定开支/贷款写入账本
+
+    每批一个事务：认领 (recurring_id, period)（ON CONFLICT DO NOTHING RETURNING，只为认领成功的分期入账）、
+    写入记账记录、回填入账记录，并计入月累计和预算预警。重复执行或多个进程同时执行都只入账一次。
+    漏掉的往月分期一并补记，记在所属月份的还款日、计入那个月的月累计，不再触发预算预警。
+    """
+    today = today or _ledger_today()
+    chunk = chunk or BILLING_CHUNK
+    current = _month_key(today)
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        category_ids = {t: _intern_category(cursor, name) for t, name in RECURRING_CATEGORIES.items()}
+        cursor.execute('''
+            SELECT r.id, r.openid, r.type, r.name, r.monthly_amount,
+                   COALESCE(r.start_date, r.created_at::date) as start_date, r.end_date,
+                   r.created_at::date as created_date,
+                   (SELECT MAX(period) FROM recurring_postings WHERE recurring_id = r.id) as last_period
+            FROM recurring_expenses r
+            WHERE r.is_active = 1 AND r.monthly_amount > 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM recurring_postings p WHERE p.recurring_id = r.id AND p.period = %s
+              )
+            ORDER BY r.id
+        ''', (current,))
+        due = _due_installments([dict(row) for row in cursor.fetchall()], today)
+        _commit(conn)
+
+        posted = []
+        for i in range(0, len(due), chunk):
+            posted += _post_installments(conn, due[i:i + chunk], today, category_ids)
+        return posted
+
+
+def _post_installments(conn, items: list, today: date, category_ids: dict) -> list:
+    """在一个事务内入账一批分期，返回本批实际入账的记录"""
+    current = _month_key(today)
+    cursor = _cursor(conn)
+    claimed = psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO recurring_postings (recurring_id, period, openid, amount, posted_at) VALUES %s
+        ON CONFLICT (recurring_id, period) DO NOTHING
+        RETURNING recurring_id, period
+    ''', [(item['id'], item['period'], item['openid'], item['monthly_amount'], time.time()) for item in items],
+        fetch=True)
+    claimed = {(row['recurring_id'], row['period']) for row in claimed}
+    items = [item for item in items if (item['id'], item['period']) in claimed]
+    if not items:
+        conn.commit()
+        return []
+
+    rows = psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO expenses (openid, type, amount, category_id, description, created_at) VALUES %s
+        RETURNING id
+    ''', [(item['openid'], 'expense', item['monthly_amount'], category_ids.get(item['type'], category_ids['fixed']),
+           item['name'], _posting_time(item, today)) for item in items],
+        template='(%s, %s, %s, %s, %s, %s::timestamp)', fetch=True)
+    # 同一条 INSERT 中序列按 VALUES 顺序分配
+    records = [{
+        'recurring_id': item['id'], 'openid': item['openid'], 'type': item['type'], 'name': item['name'],
+        'amount': item['monthly_amount'], 'period': item['period'], 'expense_id': expense_id,
+    } for item, expense_id in zip(items, sorted(row['id'] for row in rows))]
+    cursor.executemany('''
+        UPDATE recurring_postings SET expense_id = %s WHERE recurring_id = %s AND period = %s
+    ''', [(r['expense_id'], r['recurring_id'], r['period']) for r in records])
+
+    groups = {}
+    for r in records:
+        groups.setdefault((r['openid'], r['period']), []).append(r['amount'])
+    for (openid, period), amounts in groups.items():
+        spent_before = _add_month_total(cursor, openid, sum(amounts), 0, len(amounts), period)
+        if period == current:
+            _check_budget_alerts(cursor, openid, spent_before, sum(amounts), current)
+    conn.commit()
+    return records
+
+
+def get_recurring_postings(openid: str, period: str = None) -> list:
+    """某月已自动入账的固定开支/贷款（默认本月），按入账先后"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT p.recurring_id, r.type, r.name, p.amount, p.expense_id, p.posted_at
+            FROM recurring_postings p
+            JOIN recurring_expenses r ON r.id = p.recurring_id
+            WHERE p.openid = %s AND p.period = %s AND p.expense_id IS NOT NULL
+            ORDER BY p.posted_at, p.recurring_id
+        ''', (openid, period or _month_key()))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_daily_debt(openid: str) -> dict:
+    """计算每日欠款（所有固定开支和贷款的日均值总和）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT r.openid, r.type, r.name, r.monthly_amount
+            FROM recurring_expenses r
+            WHERE r.openid = %s AND {_ACTIVE_DEBT_CONDITION}
+        ''', (openid,))
+        return _summarize_debt(cursor.fetchall())
+
+
+# =============================================
+# 家庭组
+# =============================================
+
+def create_family(openid: str, name: str) -> str:
+    """创建家庭组，返回邀请码"""
+    invite_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        try:
+            cursor.execute('''
+                INSERT INTO families (name, invite_code, creator_openid)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            ''', (name, invite_code, openid))
+            family_id = cursor.fetchone()['id']
+            cursor.execute('''
+                INSERT INTO family_members (family_id, openid, role)
+                VALUES (%s, %s, 'creator')
+            ''', (family_id, openid))
+            conn.commit()
+            return invite_code
+        except psycopg2.errors.UniqueViolation:
+            conn.rollback()
+
+    # 邀请码重复则重试
+    return create_family(openid, name)
+
+
+def join_family(openid: str, invite_code: str) -> bool:
+    """加入家庭组"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT id FROM families WHERE invite_code = %s', (invite_code,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        cursor.execute('''
+            INSERT INTO family_members (family_id, openid, role)
+            VALUES (%s, %s, 'member')
+            ON CONFLICT (family_id, openid) DO NOTHING
+        ''', (row['id'], openid))
+        if cursor.rowcount:
+            _reset_family_month_totals(cursor, row['id'])
+        conn.commit()
+        return True
+
+
+def leave_family(openid: str) -> bool:
+    """退出家庭组"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('DELETE FROM family_members WHERE openid = %s RETURNING family_id', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        _reset_family_month_totals(cursor, row['family_id'])
+        conn.commit()
+        return True
+
+
+def _reset_family_month_totals(cursor, family_id: int):
+    """成员变动后清除家庭月累计，下次记账时按新成员重算"""
+    cursor.execute('DELETE FROM family_month_totals WHERE family_id = %s', (family_id,))
+
+
+def get_user_family(openid: str) -> dict:
+    """获取用户所属的家庭信息"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT f.id, f.name, f.invite_code, fm.role
+            FROM families f
+            JOIN family_members fm ON f.id = fm.family_id
+            WHERE fm.openid = %s
+        ''', (openid,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def is_family_creator(openid: str) -> bool:
+    """检查用户是否为家庭创建人"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT role FROM family_members WHERE openid = %s', (openid,))
+        row = cursor.fetchone()
+        return bool(row) and row['role'] == 'creator'
+
+
+def get_family_members(family_id: int) -> list:
+    """获取家庭所有成员的 openid"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT openid FROM family_members WHERE family_id = %s', (family_id,))
+        return [row['openid'] for row in cursor.fetchall()]
+
+
+def get_family_members_detail(family_id: int) -> list:
+    """获取家庭所有成员的详细信息"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT fm.openid, fm.role,
+                   to_char(fm.joined_at, 'YYYY-MM-DD HH24:MI:SS') as joined_at, u.nickname
+            FROM family_members fm
+            LEFT JOIN users u ON fm.openid = u.openid
+            WHERE fm.family_id = %s
+            ORDER BY fm.role DESC, fm.joined_at
+        ''', (family_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_family_recurring_expenses(family_id: int) -> list:
+    """获取家庭所有成员的固定开支/贷款（共享账单）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT {_RECURRING_COLUMNS}, u.nickname
+            FROM recurring_expenses r
+            JOIN family_members fm ON r.openid = fm.openid
+            LEFT JOIN users u ON r.openid = u.openid
+            WHERE fm.family_id = %s AND r.is_active = 1
+            ORDER BY r.type, r.monthly_amount DESC
+        ''', (family_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_family_daily_debt(family_id: int) -> dict:
+    """计算家庭每日总欠款（所有成员的固定开支和贷款汇总）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT r.openid, r.type, r.name, r.monthly_amount,
+                   COALESCE(u.nickname, '用户' || right(r.openid, 4)) as owner
+            FROM recurring_expenses r
+            JOIN family_members fm ON r.openid = fm.openid
+            LEFT JOIN users u ON r.openid = u.openid
+            WHERE fm.family_id = %s AND {_ACTIVE_DEBT_CONDITION}
+        ''', (family_id,))
+        rows = cursor.fetchall()
+    return _summarize_debt(rows, {row['openid']: row['owner'] for row in rows})
+
+
+def get_family_debt_ranking(family_id: int) -> dict:
+    """获取家庭成员欠款排行（成员、昵称和欠款明细一次查询取回）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute(f'''
+            SELECT fm.openid, u.nickname, r.openid as debt_openid,
+                   r.type, r.name, r.monthly_amount
+            FROM family_members fm
+            LEFT JOIN users u ON fm.openid = u.openid
+            LEFT JOIN recurring_expenses r ON r.openid = fm.openid AND {_ACTIVE_DEBT_CONDITION}
+            WHERE fm.family_id = %s
+            ORDER BY fm.id, r.id
+        ''', (family_id,))
+        rows = cursor.fetchall()
+
+    members = {}
+    for row in rows:
+        member = members.setdefault(row['openid'], {'nickname': row['nickname'], 'rows': []})
+        if row['debt_openid'] is not None:
+            member['rows'].append(row)
+
+    ranking = []
+    total_daily = 0
+    total_monthly = 0
+    for openid, member in members.items():
+        debt = _summarize_debt(member['rows'])
+        ranking.append({
+            'openid': openid,
+            'nickname': member['nickname'] or openid[:8],
+            'daily': debt['daily_total'],
+            'monthly': debt['monthly_total'],
+            'details': debt['details']
+        })
+        total_daily += debt['daily_total']
+        total_monthly += debt['monthly_total']
+
+    ranking.sort(key=lambda x: x['daily'], reverse=True)
+
+    return {
+        'ranking': ranking,
+        'total_daily': round(total_daily, 2),
+        'total_monthly': round(total_monthly, 2)
+    }
+
+
+# =============================================
+# 调度协调（租约与推送分区任务）
+# =============================================
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """获取或续约租约（不存在、已过期或本来就由 holder 持有时成功）"""
+    now = time.time()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            INSERT INTO scheduler_leases (name, holder, expires_at) VALUES (%s, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+            WHERE scheduler_leases.holder = EXCLUDED.holder OR scheduler_leases.expires_at < %s
+            RETURNING holder
+        ''', (name, holder, now + ttl, now))
+        acquired = cursor.fetchone() is not None
+        conn.commit()
+        return acquired
+
+
+def release_lease(name: str, holder: str):
+    """释放自己持有的租约"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('DELETE FROM scheduler_leases WHERE name = %s AND holder = %s', (name, holder))
+        conn.commit()
+
+
+def create_push_tasks(run_key: str, partitions: int) -> int:
+    """创建推送分区任务（幂等），并删除其他分区布局下空闲的旧任务，返回新创建的分区数"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            INSERT INTO push_tasks (run_key, partition_no, partitions, due_at)
+            SELECT %s, p, %s, 0 FROM generate_series(0, %s - 1) AS p
+            ON CONFLICT DO NOTHING
+        ''', (run_key, partitions, partitions))
+        created = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM push_tasks
+            WHERE run_key != %s AND (status != 'running' OR lease_until < %s)
+        ''', (run_key, time.time()))
+        conn.commit()
+        return created
+
+
+def claim_push_task(holder: str, lease_seconds: float) -> dict:
+    """领取一个已到期或租约已过期的分区任务（SKIP LOCKED，多进程互不阻塞）"""
+    now = time.time()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE push_tasks SET status = 'running', holder = %s, lease_until = %s
+            WHERE (run_key, partition_no) = (
+                SELECT run_key, partition_no FROM push_tasks
+                WHERE (status = 'pending' AND due_at <= %s)
+                   OR (status = 'running' AND lease_until < %s)
+                ORDER BY due_at, partition_no
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING run_key, partition_no, partitions
+        ''', (holder, now + lease_seconds, now, now))
+        row = cursor.fetchone()
+        conn.commit()
+        return dict(row) if row else None
+
+
+def renew_push_task(run_key: str, partition_no: int, holder: str, lease_seconds: float) -> bool:
+    """续约分区任务，返回 False 表示租约已被其他进程接手"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE push_tasks SET lease_until = %s
+            WHERE run_key = %s AND partition_no = %s AND holder = %s AND status = 'running'
+        ''', (time.time() + lease_seconds, run_key, partition_no, holder))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def release_push_task(run_key: str, partition_no: int, holder: str) -> bool:
+    """交还分区任务，到期时间更新为分区内最早一位用户的推送时间"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE push_tasks t SET status = 'pending', holder = NULL, finished_at = %s,
+                due_at = (
+                    SELECT MIN(next_push_at) FROM users
+                    WHERE push_bucket >= t.partition_no * %s / t.partitions
+                    AND push_bucket < (t.partition_no + 1) * %s / t.partitions
+                )
+            WHERE run_key = %s AND partition_no = %s AND holder = %s
+        ''', (time.time(), USER_BUCKETS, USER_BUCKETS, run_key, partition_no, holder))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def _wake_push_task(cursor, openid: str, due_at: float):
+    """用户推送时间提前时，把所在分区的到期时间一并提前"""
+    if due_at is None:
+        return
+    cursor.execute('''
+        UPDATE push_tasks SET due_at = %s
+        WHERE status = 'pending' AND (due_at IS NULL OR due_at > %s)
+        AND partition_no = ((%s + 1) * partitions - 1) / %s
+    ''', (due_at, due_at, get_user_bucket(openid), USER_BUCKETS))
+
+
+def get_push_targets(partition_no: int, partitions: int, due_before: float, limit: int = None) -> list:
+    """获取分区内已到期的推送用户，按到期时间排序"""
+    low = partition_no * USER_BUCKETS // partitions
+    high = (partition_no + 1) * USER_BUCKETS // partitions
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT openid, next_push_at, last_interaction_at FROM users
+            WHERE next_push_at <= %s AND push_bucket >= %s AND push_bucket < %s
+            ORDER BY next_push_at
+            LIMIT %s
+        ''', (due_before, low, high, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def mark_user_pushed(openid: str, push_date: str):
+    """记录用户当天已推送，并排好下一次推送时间"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT push_time, push_enabled, subscribed FROM users WHERE openid = %s', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return
+        next_push_at = None
+        if row['push_enabled'] and row['subscribed']:
+            next_push_at = _next_push_at(row['push_time'], push_date)
+        cursor.execute('''
+            UPDATE users SET last_push_date = %s, next_push_at = %s WHERE openid = %s
+        ''', (push_date, next_push_at, openid))
+        conn.commit()
+
+
+def set_push_time(openid: str, push_time: str = None, enabled: bool = True) -> float:
+    """设置每日推送时间，返回下一次推送的时间戳（关闭推送时返回 None）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('SELECT last_push_date, subscribed FROM users WHERE openid = %s', (openid,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        next_push_at = None
+        if enabled and row['subscribed']:
+            next_push_at = _next_push_at(push_time, row['last_push_date'])
+        cursor.execute('''
+            UPDATE users SET push_time = %s, push_enabled = %s, next_push_at = %s
+            WHERE openid = %s
+        ''', (push_time, 1 if enabled else 0, next_push_at, openid))
+        _wake_push_task(cursor, openid, next_push_at)
+        conn.commit()
+        return next_push_at
+
+
+# =============================================
+# 家庭通知发件箱
+# =============================================
+
+def enqueue_family_notification(family_id: int, openid: str, category: str,
+                                amount: float, description: str = None):
+    """把一笔家庭成员支出放入发件箱，等待合并发送"""
+    enqueue_family_notifications(family_id, openid, [
+        {'category': category, 'amount': amount, 'description': description}
+    ])
+
+
+def enqueue_family_notifications(family_id: int, openid: str, items: list):
+    """把多笔家庭成员支出一次写入发件箱"""
+    now = time.time()
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO family_notify_outbox (family_id, openid, category, amount, description, created_at)
+            VALUES %s
+        ''', [(family_id, openid, item['category'], item['amount'], item.get('description'), now)
+              for item in items])
+        conn.commit()
+
+
+def get_due_family_digests(before: float) -> list:
+    """获取最早一条待发通知早于 before 的家庭 id 列表"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            SELECT family_id FROM family_notify_outbox
+            GROUP BY family_id
+            HAVING MIN(created_at) <= %s
+        ''', (before,))
+        return [row['family_id'] for row in cursor.fetchall()]
+
+
+def take_family_notifications(family_id: int) -> list:
+    """取出并删除家庭的全部待发通知（DELETE ... RETURNING，同一批只会被一个进程取到）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            DELETE FROM family_notify_outbox WHERE family_id = %s
+            RETURNING id, openid, category, amount, description, created_at
+        ''', (family_id,))
+        rows = sorted((dict(row) for row in cursor.fetchall()), key=lambda row: row['id'])
+        conn.commit()
+        return rows
+
+
+# =============================================
+# 预算预警
+# =============================================
+
+def take_budget_alerts(limit: int = 100) -> list:
+    """取出待发送的预算预警并标记为已发送（SKIP LOCKED，同一条只会被一个进程取到）"""
+    with get_connection() as conn:
+        cursor = _cursor(conn)
+        cursor.execute('''
+            UPDATE budget_alerts SET sent_at = %s
+            WHERE id IN (
+                SELECT id FROM budget_alerts WHERE sent_at IS NULL
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, scope, scope_id, month, threshold, spent, budget
+        ''', (time.time(), limit))
+        rows = sorted((dict(row) for row in cursor.fetchall()), key=lambda row: row['id'])
+        conn.commit()
+        return rows
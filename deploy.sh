@@ -87,17 +87,19 @@ setup_venv() {
 # 初始化数据库
 init_database() {
     print_info "初始化数据库..."
-    python3 -c "from database import init_db; init_db()"
+    python3 -c "from repository import init_db; init_db()"
     print_success "数据库初始化完成"
 }
 
-# 数据库迁移（创建新表）
+# 数据库迁移（创建新表，执行 migrations/ 中待完成的迁移）
 migrate_database() {
     print_info "执行数据库迁移..."
     source venv/bin/activate 2>/dev/null || true
     # init_db 使用 CREATE TABLE IF NOT EXISTS，会创建新表但不影响已有数据
-    python3 -c "from database import init_db; init_db()"
-    print_success "数据库迁移完成"
+    python3 -c "from repository import init_db; init_db()"
+    # 建索引、回填等迁移分批执行，不必停服；中断后再次执行会从上次的进度继续
+    python3 migrate.py
+    print_success "数据库迁移完成（python3 migrate.py --status 查看各数据库的迁移状态）"
 }
 
 # 配置 systemd 服务
@@ -113,7 +115,7 @@ Type=simple
 User=$USER
 WorkingDirectory=$(pwd)
 Environment="PATH=$(pwd)/venv/bin"
-ExecStart=$(pwd)/venv/bin/gunicorn -w 2 -b 0.0.0.0:5000 app:app
+ExecStart=$(pwd)/venv/bin/gunicorn -c gunicorn.conf.py app:app
 Restart=always
 RestartSec=5
 
@@ -152,20 +154,14 @@ show_logs() {
     sudo journalctl -u wechat-tracker -f
 }
 
-# 备份数据库
+# 备份数据库（SQLite 在线备份，不必停服）
 backup_database() {
-    SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
-    DB_FILE="$SCRIPT_DIR/data/tracker.db"
-    BACKUP_DIR="$SCRIPT_DIR/backups"
-    
-    mkdir -p "$BACKUP_DIR"
-    BACKUP_FILE="$BACKUP_DIR/tracker_$(date +%Y%m%d_%H%M%S).db"
-    
-    if [ -f "$DB_FILE" ]; then
-        cp "$DB_FILE" "$BACKUP_FILE"
-        print_success "数据库已备份到: $BACKUP_FILE"
+    print_info "备份数据库..."
+    source venv/bin/activate 2>/dev/null || true
+    if python3 backup.py; then
+        print_success "数据库已备份到 data/backups/"
     else
-        print_warning "数据库文件不存在: $DB_FILE"
+        print_error "备份失败，请查看上面的输出"
     fi
 }
 
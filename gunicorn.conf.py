@@ -0,0 +1,47 @@
+"""
+gunicorn 配置：gunicorn -c gunicorn.conf.py app:app
+
+- 主进程：启动时建表/迁移一次，随后预加载应用代码，worker fork 后共享，缩短冷启动
+- worker：fork 之后预热本进程资源（数据库连接池、微信客户端、分类自动机、加解密上下文），
+  再争抢后台任务锁，只有一个 worker 运行调度器；退出时释放租约、锁和连接
+- 启动耗时写入日志，也可通过 /health 查看（cold_start_ms、first_request_ms）
+"""
+
+import os
+
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+preload_app = True
+
+
+def on_starting(server):
+    """主进程：建表一次；PostgreSQL 连接池随即关闭，避免 worker 继承主进程的连接"""
+    import repository
+    repository.init_db()
+    repository.close_pool()
+
+
+def post_fork(server, worker):
+    """worker fork 之后：重新开始计时"""
+    import app
+    app.after_fork()
+
+
+def post_worker_init(worker):
+    """worker 初始化完成、开始接收请求之前：预热并争抢后台任务"""
+    import app
+    app.warm_up()
+    app.start_background()
+
+
+def worker_exit(server, worker):
+    """worker 退出：关闭调度器（释放租约和后台任务锁）、重查询线程池和连接池"""
+    import app
+    import cost_guard
+    import repository
+    app.stop_background()
+    cost_guard.shutdown()
+    repository.close_pool()
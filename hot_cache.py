@@ -0,0 +1,293 @@
+"""
+热点缓存模块（可选）
+
+最近活跃用户近 HOT_CACHE_DAYS 天的记账记录以列式数组常驻内存，今日/本月汇总、历史记录和分类统计
+直接扫描数组得出，不再每次查询数据库：
+- 每位用户一组列：id / 时间戳（UTC 秒）/ 金额（分）用 array('q')，分类 id / 类型用 array('i')，
+  备注用列表；记录按时间戳升序，按时间范围查询时二分定位起点后只扫描尾部
+- 用户首次查询时从数据库加载（一次查询），按最近使用顺序（LRU）保存，
+  估算占用超过 HOT_CACHE_MAX_BYTES 时淘汰最久未用的用户
+- 写入不直接改缓存：每次读取前从变更日志（journal.py）回放新记录，
+  本进程和其他工作进程的记账、合并分类都能同步进来，因此需要开启 JOURNAL_ENABLED
+- 本进程写日志失败时丢弃全部缓存；其他进程写失败的记录回放不到，
+  每位用户加载超过 HOT_CACHE_TTL_SECONDS 秒后重新从数据库加载
+
+只用于 SQLite 后端；PostgreSQL 由数据库端聚合。数据库始终是唯一的事实来源。
+"""
+
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+import journal
+from config import HOT_CACHE_ENABLED, HOT_CACHE_DAYS, HOT_CACHE_MAX_BYTES, HOT_CACHE_TTL_SECONDS, JOURNAL_ENABLED
+
+
+# 类型列的取值
+TYPE_EXPENSE = 0
+TYPE_INCOME = 1
+TYPE_CODES = {'expense': TYPE_EXPENSE, 'income': TYPE_INCOME}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# 分类 id 为空（未迁移的旧记录）时的占位
+NO_CATEGORY = -1
+
+# 每条记录在数组中占用的字节数，以及每位用户的固定开销（估算值）
+ROW_BYTES = 8 * 3 + 4 * 2
+ENTRY_BYTES = 1024
+
+_entries = OrderedDict()
+_state = {'position': None, 'bytes': 0, 'failures': 0}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """缓存依赖变更日志同步写入，日志关闭时不启用"""
+    return HOT_CACHE_ENABLED and JOURNAL_ENABLED
+
+
+def utc_day_start(day: date) -> int:
+    """某天 00:00（UTC）的时间戳，与 SQLite 中 date(created_at) 的比较方式一致"""
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def utc_today() -> date:
+    """当前 UTC 日期（SQLite 中 date('now') 的取值）"""
+    return datetime.now(timezone.utc).date()
+
+
+def window_start() -> int:
+    """缓存能覆盖的最早时间"""
+    return utc_day_start(utc_today() - timedelta(days=HOT_CACHE_DAYS))
+
+
+def _to_fen(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+def _new_entry(since: int) -> dict:
+    return {
+        'since': since,
+        'loaded_at': time.monotonic(),
+        'last_id': 0,
+        'ids': array('q'),
+        'ts': array('q'),
+        'fen': array('q'),
+        'category_id': array('i'),
+        'type': array('i'),
+        'description': [],
+        'legacy': {},  # 分类 id 为空的旧记录 {记录 id: 分类文本}
+        'bytes': ENTRY_BYTES,
+    }
+
+
+def _append_row(entry: dict, row_id: int, ts: int, expense_type: str, amount: float,
+                category_id, description, category: str = None) -> int:
+    """追加一条记录（保持时间戳升序），返回增加的字节数"""
+    index = len(entry['ts'])
+    if index and entry['ts'][-1] > ts:
+        index = bisect_left(entry['ts'], ts + 1)
+    entry['ids'].insert(index, row_id)
+    entry['ts'].insert(index, ts)
+    entry['fen'].insert(index, _to_fen(amount))
+    entry['category_id'].insert(index, NO_CATEGORY if category_id is None else category_id)
+    entry['type'].insert(index, TYPE_CODES.get(expense_type, TYPE_EXPENSE))
+    entry['description'].insert(index, description)
+    if category_id is None and category:
+        entry['legacy'][row_id] = category
+    entry['last_id'] = max(entry['last_id'], row_id)
+    size = ROW_BYTES + (sys.getsizeof(description) if description else 0)
+    entry['bytes'] += size
+    return size
+
+
+def _build_entry(rows: list, since: int) -> dict:
+    """用数据库查询结果建立用户的列"""
+    entry = _new_entry(since)
+    for row in rows:
+        _append_row(entry, row['id'], row['ts'], row['type'], row['amount'],
+                    row['category_id'], row['description'], row['category'])
+    return entry
+
+
+def _apply(op: str, values: tuple, ts: float):
+    """把一条变更日志记录应用到已缓存的用户"""
+    if op == 'add_expense':
+        row_id, openid, expense_type, amount, category_id, description = values[:6]
+        entry = _entries.get(openid)
+        if entry is None or row_id <= entry['last_id']:
+            return
+        created = values[6] if len(values) > 6 else int(ts)
+        _state['bytes'] += _append_row(entry, row_id, created, expense_type, amount,
+                                       category_id, description)
+    elif op == 'merge_category':
+        openid, source_id, target_id = values
+        entry = _entries.get(openid)
+        if entry is None:
+            return
+        column = entry['category_id']
+        for i, category_id in enumerate(column):
+            if category_id == source_id:
+                column[i] = target_id
+
+
+def _drop(openid: str):
+    _state['bytes'] -= _entries.pop(openid)['bytes']
+
+
+def _sync():
+    """回放上次读取之后的变更日志；本进程有写入失败时丢弃全部缓存"""
+    failures = journal.write_failures()
+    if failures != _state['failures']:
+        print(f"[热点缓存] 变更日志写入失败，丢弃 {len(_entries)} 位用户的缓存")
+        _state['failures'] = failures
+        _entries.clear()
+        _state['bytes'] = 0
+    if _state['position'] is None:
+        _state['position'] = journal.end_position()
+        return
+    for position, ts, op, values in journal.replay(_state['position']):
+        _apply(op, values, ts)
+        _state['position'] = position
+
+
+def _evict():
+    while _state['bytes'] > HOT_CACHE_MAX_BYTES and len(_entries) > 1:
+        _, entry = _entries.popitem(last=False)
+        _state['bytes'] -= entry['bytes']
+
+
+def query(openid: str, since: int, loader, scan):
+    """
+    在用户的缓存列上执行查询（持锁执行，扫描期间不会有记录插入）
+
+    Args:
+        since: 查询需要覆盖的最早时间戳，早于缓存窗口时返回 None（由调用方查数据库）
+        loader: 未缓存时的加载函数 (openid, 起始时间戳) -> 记录行列表，
+                每行包含 id, ts, type, amount, category, category_id, description
+        scan: 查询函数 (缓存条目) -> 结果
+
+    Returns:
+        scan 的结果，未启用或无法覆盖时返回 None
+    """
+    if not enabled():
+        return None
+    with _lock:
+        _sync()
+        entry = _entries.get(openid)
+        if entry is not None and time.monotonic() - entry['loaded_at'] > HOT_CACHE_TTL_SECONDS:
+            _drop(openid)
+            entry = None
+        if entry is not None:
+            _entries.move_to_end(openid)
+        else:
+            start = window_start()
+            entry = _build_entry(loader(openid, start), start)
+            _entries[openid] = entry
+            _state['bytes'] += entry['bytes']
+            _evict()
+        return scan(entry) if since >= entry['since'] else None
+
+
+def invalidate(openid: str = None):
+    """丢弃某位用户（不传时丢弃全部）的缓存"""
+    with _lock:
+        if openid is None:
+            _entries.clear()
+            _state['bytes'] = 0
+        elif openid in _entries:
+            _drop(openid)
+
+
+def stats() -> dict:
+    """缓存的用户数、记录数和估算字节数"""
+    with _lock:
+        return {
+            'users': len(_entries),
+            'rows': sum(len(entry['ts']) for entry in _entries.values()),
+            'bytes': _state['bytes'],
+        }
+
+
+def _range(entry: dict, start: int, end: int = None) -> tuple:
+    """时间范围 [start, end) 对应的下标区间"""
+    ts = entry['ts']
+    lo = bisect_left(ts, start)
+    hi = len(ts) if end is None else bisect_left(ts, end, lo)
+    return lo, hi
+
+
+def totals(entry: dict, start: int, end: int = None) -> dict:
+    """
+    时间范围内的收支合计
+
+    Returns:
+        {'income': 元, 'expense': 元, 'days': 有记录的天数（按 UTC 日期）}
+    """
+    lo, hi = _range(entry, start, end)
+    fen = entry['fen'][lo:hi]
+    types = entry['type'][lo:hi]
+    income = sum(f for f, t in zip(fen, types) if t == TYPE_INCOME)
+    return {
+        'income': income / 100,
+        'expense': (sum(fen) - income) / 100,
+        'days': len({ts // 86400 for ts in entry['ts'][lo:hi]}),
+    }
+
+
+def _record(entry: dict, i: int) -> dict:
+    category_id = entry['category_id'][i]
+    row_id = entry['ids'][i]
+    return {
+        'id': row_id,
+        'type': TYPE_NAMES[entry['type'][i]],
+        'amount': entry['fen'][i] / 100,
+        'category': entry['legacy'].get(row_id),
+        'category_id': None if category_id == NO_CATEGORY else category_id,
+        'description': entry['description'][i],
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(entry['ts'][i])),
+    }
+
+
+def records(entry: dict, start: int, end: int = None, limit: int = None) -> list:
+    """时间范围内的记录（最新的在前），字段与 expenses 表一致，created_at 为 UTC 文本"""
+    lo, hi = _range(entry, start, end)
+    if limit is not None:
+        lo = max(lo, hi - limit)
+    return [_record(entry, i) for i in range(hi - 1, lo - 1, -1)]
+
+
+def category_totals(entry: dict, start: int) -> list:
+    """
+    时间范围内按分类汇总的支出（金额从高到低）
+
+    Returns:
+        [{'category_id', 'category', 'total', 'count'}]
+    """
+    lo, hi = _range(entry, start)
+    groups = {}
+    legacy = entry['legacy']
+    for row_id, category_id, fen, expense_type in zip(
+            entry['ids'][lo:hi], entry['category_id'][lo:hi], entry['fen'][lo:hi], entry['type'][lo:hi]):
+        if expense_type != TYPE_EXPENSE:
+            continue
+        key = (category_id, legacy.get(row_id) if category_id == NO_CATEGORY else None)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [fen, 1]
+        else:
+            group[0] += fen
+            group[1] += 1
+    return sorted(
+        ({
+            'category_id': None if category_id == NO_CATEGORY else category_id,
+            'category': category,
+            'total': fen / 100,
+            'count': count,
+        } for (category_id, category), (fen, count) in groups.items()),
+        key=lambda c: c['total'], reverse=True,
+    )
@@ -0,0 +1,258 @@
+"""
+变更日志模块（仅追加）
+
+database.py 中每个修改账本数据的函数在提交后追加一条紧凑的二进制记录，
+派生数据（月累计、欠款缓存、搜索索引、热点缓存等）重建时从检查点开始回放日志，
+不必全表扫描 expenses / recurring_expenses。
+
+文件布局：JOURNAL_DIR 下按序号分段（00000001.journal …），当前分段超过 JOURNAL_SEGMENT_BYTES
+后写入下一段。每条记录：
+
+    <II 长度, crc32> + <dB 时间戳, 操作码> + 字段...
+    字段带类型标记：0 空、1 整数 <q、2 浮点 <d、3 字符串 <H 长度 + UTF-8
+
+- 写入：每条（或一批）记录用一次 O_APPEND write 写入，多进程同时追加不会交错
+- 读取：mmap 按分段顺序解析，遇到不完整或校验失败的记录跳到下一段
+- 位置：(分段序号, 偏移量)；检查点以 JSON 保存在 JOURNAL_DIR/checkpoints/
+
+调度协调、推送队列、发件箱等运行状态不记入日志，数据库始终是唯一的事实来源。
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from config import JOURNAL_ENABLED, JOURNAL_DIR, JOURNAL_SEGMENT_BYTES
+
+
+# 操作码（只能追加新操作，不能修改已有编号）
+OPS = {
+    'add_user': 1,
+    'update_nickname': 2,
+    'unsubscribe_user': 3,
+    'set_push_time': 4,
+    'add_expense': 5,
+    'merge_category': 6,
+    'set_budget': 7,
+    'add_recurring_expense': 8,
+    'delete_recurring_expense': 9,
+    'create_family': 10,
+    'join_family': 11,
+    'leave_family': 12,
+    'set_family_budget': 13,
+    'expire_recurring_expense': 14,
+    'post_recurring_charge': 15,
+    'learn_alias': 16,
+    'add_category': 17,
+    'resubscribe_user': 18,
+}
+OP_NAMES = {code: name for name, code in OPS.items()}
+
+FRAME = struct.Struct('<II')
+HEADER = struct.Struct('<dB')
+TAG = struct.Struct('<B')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+STR_LEN = struct.Struct('<H')
+
+SEGMENT_PATTERN = re.compile(r'^(\d{8})\.journal$')
+
+# 进程内的写入状态（fork 之后按进程号重新打开）
+_writer = {'pid': None, 'fd': None, 'segment': None}
+_writer_lock = threading.Lock()
+
+# 本进程写入失败的次数：失败的记录不会出现在日志中，依赖回放的热点缓存据此判断已经过期
+_failures = {'count': 0}
+
+
+def _segment_path(segment: int) -> str:
+    return os.path.join(JOURNAL_DIR, f'{segment:08d}.journal')
+
+
+def list_segments() -> list:
+    """已有分段序号（升序）"""
+    if not os.path.isdir(JOURNAL_DIR):
+        return []
+    return sorted(int(m.group(1)) for m in map(SEGMENT_PATTERN.match, os.listdir(JOURNAL_DIR)) if m)
+
+
+def encode(op: str, values: tuple, ts: float = None) -> bytes:
+    """编码一条记录（含长度和校验）"""
+    parts = [HEADER.pack(time.time() if ts is None else ts, OPS[op])]
+    for value in values:
+        if value is None:
+            parts.append(TAG.pack(0))
+        elif isinstance(value, (bool, int)):
+            parts.append(TAG.pack(1) + INT.pack(int(value)))
+        elif isinstance(value, float):
+            parts.append(TAG.pack(2) + FLOAT.pack(value))
+        else:
+            data = str(value).encode('utf-8')[:0xFFFF]
+            parts.append(TAG.pack(3) + STR_LEN.pack(len(data)) + data)
+    body = b''.join(parts)
+    return FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode_body(buf, start: int, end: int) -> tuple:
+    """解析记录体，返回 (时间戳, 操作名, 字段元组)"""
+    ts, code = HEADER.unpack_from(buf, start)
+    pos = start + HEADER.size
+    values = []
+    while pos < end:
+        tag = buf[pos]
+        pos += 1
+        if tag == 0:
+            values.append(None)
+        elif tag == 1:
+            values.append(INT.unpack_from(buf, pos)[0])
+            pos += INT.size
+        elif tag == 2:
+            values.append(FLOAT.unpack_from(buf, pos)[0])
+            pos += FLOAT.size
+        else:
+            length = STR_LEN.unpack_from(buf, pos)[0]
+            pos += STR_LEN.size
+            values.append(bytes(buf[pos:pos + length]).decode('utf-8'))
+            pos += length
+    return ts, OP_NAMES.get(code, f'op#{code}'), tuple(values)
+
+
+def _open_segment(segment: int):
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    fd = os.open(_segment_path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if _writer['fd'] is not None and _writer['pid'] == os.getpid():
+        os.close(_writer['fd'])
+    _writer.update(pid=os.getpid(), fd=fd, segment=segment)
+
+
+def _write(data: bytes):
+    """一次 write 追加到最新分段，必要时切换到下一段"""
+    with _writer_lock:
+        if _writer['pid'] != os.getpid():
+            _writer.update(pid=None, fd=None)
+            segments = list_segments()
+            _open_segment(segments[-1] if segments else 1)
+        # 其他进程已切换分段时跟上，保持记录在分段间的先后顺序
+        elif os.path.exists(_segment_path(_writer['segment'] + 1)):
+            _open_segment(list_segments()[-1])
+        if os.fstat(_writer['fd']).st_size >= JOURNAL_SEGMENT_BYTES:
+            _open_segment(_writer['segment'] + 1)
+        os.write(_writer['fd'], data)
+
+
+def append(op: str, *values):
+    """追加一条记录（在数据库提交之后调用；写入失败只打印，不影响业务）"""
+    append_many(op, [values])
+
+
+def append_many(op: str, rows: list):
+    """同一操作的多条记录一次写入"""
+    if not JOURNAL_ENABLED or not rows:
+        return
+    try:
+        now = time.time()
+        _write(b''.join(encode(op, values, now) for values in rows))
+    except OSError as e:
+        _failures['count'] += 1
+        print(f"[变更日志] 写入失败: {e}")
+
+
+def write_failures() -> int:
+    """本进程启动以来写入失败的次数"""
+    return _failures['count']
+
+
+def end_position() -> tuple:
+    """日志当前末尾的位置"""
+    segments = list_segments()
+    if not segments:
+        return (0, 0)
+    return (segments[-1], os.path.getsize(_segment_path(segments[-1])))
+
+
+def replay(start: tuple = (0, 0)):
+    """
+    从指定位置开始按顺序读取记录
+
+    Yields:
+        (下一条记录的位置, 时间戳, 操作名, 字段元组)
+    """
+    start_segment, start_offset = start
+    for segment in list_segments():
+        if segment < start_segment:
+            continue
+        offset = start_offset if segment == start_segment else 0
+        with open(_segment_path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                while offset + FRAME.size <= size:
+                    length, crc = FRAME.unpack_from(buf, offset)
+                    body_start = offset + FRAME.size
+                    body_end = body_start + length
+                    if body_end > size or zlib.crc32(buf[body_start:body_end]) != crc:
+                        print(f"[变更日志] 分段 {segment} 在偏移 {offset} 处不完整，跳到下一段")
+                        break
+                    ts, op, values = _decode_body(buf, body_start, body_end)
+                    offset = body_end
+                    yield (segment, offset), ts, op, values
+
+
+def _checkpoint_path(name: str) -> str:
+    return os.path.join(JOURNAL_DIR, 'checkpoints', f'{name}.json')
+
+
+def load_checkpoint(name: str) -> tuple:
+    """读取检查点，不存在时从头开始"""
+    try:
+        with open(_checkpoint_path(name), encoding='utf-8') as f:
+            return tuple(json.load(f)['position'])
+    except FileNotFoundError:
+        return (0, 0)
+
+
+def save_checkpoint(name: str, position: tuple):
+    """保存检查点（先写临时文件再替换）"""
+    path = _checkpoint_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'position': list(position), 'saved_at': time.time()}, f)
+    os.replace(tmp, path)
+
+
+def catch_up(name: str, apply) -> int:
+    """
+    把名为 name 的派生数据从检查点回放到日志末尾
+
+    Args:
+        apply: 回调 (操作名, 字段元组, 时间戳)
+
+    Returns:
+        回放的记录数
+    """
+    position = load_checkpoint(name)
+    count = 0
+    for position, ts, op, values in replay(position):
+        apply(op, values, ts)
+        count += 1
+    if count:
+        save_checkpoint(name, position)
+    return count
+
+
+if __name__ == '__main__':
+    # 统计各分段的记录数
+    counts = {}
+    for (segment, _), _, op, _ in replay():
+        counts.setdefault(segment, {}).setdefault(op, 0)
+        counts[segment][op] += 1
+    for segment, ops in counts.items():
+        print(f"{_segment_path(segment)}: {ops}")
+    print(f"末尾位置: {end_position()}")
@@ -0,0 +1,232 @@
+"""
+数据库维护模块（SQLite）
+
+长期运行后有两个问题：查询规划器没有统计信息（sqlite_stat1），新加的索引不一定被选中；
+删除家庭成员、停用固定开支后留下的空闲页不会归还，库文件只增不减。后台任务进程定期对全局库和各分库执行：
+- optimize()：每 MAINTENANCE_OPTIMIZE_HOURS 小时执行 PRAGMA optimize，只重新分析统计信息过时的表，通常瞬间完成
+- nightly()：每天低峰期（MAINTENANCE_HOUR 点）执行
+  - ANALYZE：analysis_limit 限制每个索引扫描的行数，大表也只需很短时间
+  - PRAGMA incremental_vacuum：分步归还空闲页，每步最多 MAINTENANCE_VACUUM_PAGES 页并单独提交，
+    步间暂停让出写锁，超过 MAINTENANCE_SECONDS 秒停止，剩下的留到第二天
+  - 尚未启用增量回收的旧库（auto_vacuum 为 none）不超过 MAINTENANCE_VACUUM_MAX_MB 时 VACUUM 一次以启用；
+    更大的库 VACUUM 期间会长时间阻塞写入，请停服后执行 python3 maintenance.py --vacuum
+  - PRAGMA wal_checkpoint(TRUNCATE)：把 WAL 写回库文件并截断
+每次执行记录各库的页数、空闲页数、文件大小和各步骤耗时，打印日志并追加到 MAINTENANCE_LOG_PATH
+（保留最近 HISTORY_SIZE 次，各 worker 共享），可在 /admin/maintenance 查看。
+
+PostgreSQL 由 autovacuum 负责，本模块不执行任何操作。
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import database
+from config import (
+    DATABASE_BACKEND, MAINTENANCE_VACUUM_PAGES, MAINTENANCE_PAUSE_MS, MAINTENANCE_SECONDS,
+    MAINTENANCE_ANALYSIS_LIMIT, MAINTENANCE_VACUUM_MAX_MB, MAINTENANCE_LOG_PATH
+)
+
+
+# 记录文件中保留的执行次数
+HISTORY_SIZE = 60
+
+# PRAGMA auto_vacuum 的取值
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+AUTO_VACUUM_INCREMENTAL = 2
+
+_history_lock = threading.Lock()
+
+
+def _connect(path: str):
+    # 自动提交：VACUUM 不能在事务中执行，增量回收每步单独提交
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute(f'PRAGMA analysis_limit = {int(MAINTENANCE_ANALYSIS_LIMIT)}')
+    return conn
+
+
+def _pragma(conn, name: str):
+    return conn.execute(f'PRAGMA {name}').fetchone()[0]
+
+
+def file_stats(conn, path: str) -> dict:
+    """库文件的页数、空闲页数、大小和存储方式"""
+    wal = path + '-wal'
+    return {
+        'pages': _pragma(conn, 'page_count'),
+        'freelist': _pragma(conn, 'freelist_count'),
+        'page_size': _pragma(conn, 'page_size'),
+        'bytes': os.path.getsize(path),
+        'wal_bytes': os.path.getsize(wal) if os.path.exists(wal) else 0,
+        'auto_vacuum': AUTO_VACUUM_MODES.get(_pragma(conn, 'auto_vacuum'), '?'),
+        'journal_mode': _pragma(conn, 'journal_mode'),
+    }
+
+
+def _timed(timings: dict, step: str, fn):
+    """执行一个步骤并记录耗时（毫秒）"""
+    started = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        timings[step] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def _incremental_vacuum(conn, deadline: float) -> int:
+    """
+    分步归还空闲页，直到没有空闲页或超过截止时间
+
+    Returns:
+        归还的页数
+    """
+    freed = 0
+    pause = MAINTENANCE_PAUSE_MS / 1000
+    free = _pragma(conn, 'freelist_count')
+    while free:
+        conn.execute(f'PRAGMA incremental_vacuum({min(free, MAINTENANCE_VACUUM_PAGES)})').fetchall()
+        remaining = _pragma(conn, 'freelist_count')
+        if remaining >= free:
+            break
+        freed += free - remaining
+        free = remaining
+        if not free or time.monotonic() + pause >= deadline:
+            break
+        time.sleep(pause)
+    return freed
+
+
+def _enable_incremental(conn, path: str, limit_bytes) -> bool:
+    """旧库切换为增量回收（需要 VACUUM 一次），超过大小上限时跳过"""
+    if _pragma(conn, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL:
+        return False
+    if limit_bytes is not None and os.path.getsize(path) > limit_bytes:
+        print(f"[数据库维护] {os.path.basename(path)} 未启用增量回收，文件超过 {MAINTENANCE_VACUUM_MAX_MB} MB，"
+              f"请停服后执行 python3 maintenance.py --vacuum")
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
+
+
+def _maintain(path: str, full: bool, limit_bytes) -> dict:
+    """维护一个库文件，返回执行前后的统计和各步骤耗时"""
+    result = {'database': os.path.basename(path), 'ms': {}}
+    timings = result['ms']
+    started = time.monotonic()
+    conn = _connect(path)
+    try:
+        result['before'] = file_stats(conn, path)
+        if not full:
+            _timed(timings, 'optimize', lambda: conn.execute('PRAGMA optimize').fetchall())
+        else:
+            _timed(timings, 'analyze', lambda: conn.execute('ANALYZE'))
+            result['vacuumed'] = _timed(timings, 'vacuum', lambda: _enable_incremental(conn, path, limit_bytes))
+            result['freed_pages'] = _timed(
+                timings, 'incremental_vacuum',
+                lambda: _incremental_vacuum(conn, started + MAINTENANCE_SECONDS)
+            )
+            if result['before']['journal_mode'] == 'wal':
+                busy, log, checkpointed = _timed(
+                    timings, 'checkpoint', lambda: conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+                )
+                result['checkpoint'] = {'busy': busy, 'log': log, 'checkpointed': checkpointed}
+        result['after'] = file_stats(conn, path)
+    except sqlite3.Error as e:
+        # 写锁被长时间占用等情况：记录后继续维护其他库，第二天再试
+        result['error'] = str(e)
+    finally:
+        conn.close()
+    timings['total'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+
+def _run(kind: str, full: bool, limit_bytes=None):
+    if DATABASE_BACKEND != 'sqlite':
+        return None
+    record = {
+        'kind': kind,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'pid': os.getpid(),
+        'databases': [_maintain(path, full, limit_bytes) for path in database.get_database_files()],
+    }
+    _save(record)
+    for item in record['databases']:
+        if 'error' in item:
+            print(f"[数据库维护] {kind} {item['database']} 失败: {item['error']}")
+            continue
+        before, after = item['before'], item['after']
+        print(f"[数据库维护] {kind} {item['database']}: {before['pages']} -> {after['pages']} 页，"
+              f"空闲 {before['freelist']} -> {after['freelist']}，耗时 {item['ms']}")
+    return record
+
+
+def optimize():
+    """
+    PRAGMA optimize：重新分析统计信息过时的表（定时执行，开销很小）
+
+    Returns:
+        本次执行记录，PostgreSQL 时为 None
+    """
+    return _run('optimize', full=False)
+
+
+def nightly(vacuum_max_mb: float = MAINTENANCE_VACUUM_MAX_MB):
+    """
+    低峰期维护：ANALYZE、增量回收空闲页、截断 WAL
+
+    Args:
+        vacuum_max_mb: 自动 VACUUM 以启用增量回收的库文件大小上限，None 表示不限制（停服时使用）
+
+    Returns:
+        本次执行记录，PostgreSQL 时为 None
+    """
+    limit_bytes = None if vacuum_max_mb is None else vacuum_max_mb * 1024 * 1024
+    return _run('nightly', full=True, limit_bytes=limit_bytes)
+
+
+def _save(record: dict):
+    """追加到记录文件（先写临时文件再替换），保留最近 HISTORY_SIZE 次"""
+    with _history_lock:
+        records = history(HISTORY_SIZE)[::-1] + [record]
+        os.makedirs(os.path.dirname(MAINTENANCE_LOG_PATH) or '.', exist_ok=True)
+        tmp = f'{MAINTENANCE_LOG_PATH}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(records[-HISTORY_SIZE:], f, ensure_ascii=False)
+        os.replace(tmp, MAINTENANCE_LOG_PATH)
+
+
+def history(limit: int = 20) -> list:
+    """最近的执行记录（最新的在前）"""
+    try:
+        with open(MAINTENANCE_LOG_PATH, encoding='utf-8') as f:
+            records = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return records[::-1][:max(0, limit)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite 数据库维护（不带参数时显示最近一次记录）')
+    parser.add_argument('--optimize', action='store_true', help='执行 PRAGMA optimize')
+    parser.add_argument('--nightly', action='store_true', help='执行低峰期维护')
+    parser.add_argument('--vacuum', action='store_true', help='低峰期维护，不限大小地 VACUUM 旧库（请先停止服务）')
+    args = parser.parse_args()
+
+    if args.vacuum:
+        record = nightly(vacuum_max_mb=None)
+    elif args.nightly:
+        record = nightly()
+    elif args.optimize:
+        record = optimize()
+    else:
+        records = history(1)
+        record = records[0] if records else None
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
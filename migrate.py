@@ -0,0 +1,278 @@
+"""
+数据库迁移模块
+
+init_db 只负责建表和补列（CREATE TABLE IF NOT EXISTS），代码依赖的表结构仍写在那里；
+建索引、转换数据、填充新表等耗时的变更写成 migrations/ 目录下按编号排序的迁移文件，在服务运行期间执行：
+- 每个数据库（SQLite 的全局库和各分库，或 PostgreSQL）有自己的 schema_version 表，记录已完成的迁移
+- 迁移文件命名为 NNNN_名称.py，模块文档字符串的第一行是说明；SCOPE 为 'global' 或 'shard'
+  （SQLite 下决定在全局库还是每个分库执行）；sqlite(conn) / postgres(conn) 是各后端的升级函数，
+  没有某个后端的函数表示该后端不需要这项变更（仍记录为已完成）
+- 数据回填使用 backfill()：按键顺序每次处理一小批，每批一个事务，提交后暂停 BACKFILL_PAUSE_MS 毫秒；
+  单批耗时超过 BACKFILL_TARGET_MS 毫秒时批量减半，写锁每次只持有几毫秒。进度写入 backfill_progress 表，
+  中断后从上次的键继续
+- 迁移完成前服务照常运行，代码需要兼容迁移尚未完成的数据（例如月累计的记账笔数为 0 时从明细补算）
+
+后台任务进程启动后由调度器执行（数据库租约保证多台机器只有一个进程在迁移）。手动执行：
+python3 migrate.py            执行待完成的迁移
+python3 migrate.py --status   查看各数据库已完成的版本
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import time
+
+import database
+import repository
+from config import (
+    DATABASE_BACKEND, MIGRATIONS_DIR, BACKFILL_CHUNK, BACKFILL_TARGET_MS, BACKFILL_PAUSE_MS
+)
+
+
+# 迁移文件名：四位编号_名称.py
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+# 自动调整后的最小批量
+MIN_CHUNK = 10
+
+# 执行中的迁移的回调：每批回填提交后调用，返回 False 时中止（如失去迁移租约）
+_hooks = {'on_chunk': None}
+
+
+class MigrationError(Exception):
+    """迁移文件有误或迁移被中止"""
+    pass
+
+
+def _sql(sql: str) -> str:
+    """本模块的语句使用 ? 占位符，PostgreSQL 下替换为 %s"""
+    return sql.replace('?', '%s') if DATABASE_BACKEND == 'postgres' else sql
+
+
+def _cursor(conn):
+    if DATABASE_BACKEND == 'postgres':
+        import database_pg
+        return database_pg._cursor(conn)
+    return conn.cursor()
+
+
+def load_migrations(directory: str = None) -> list:
+    """
+    读取迁移文件（按编号排序）
+
+    Returns:
+        [{'version', 'name', 'description', 'scope', 'module'}]
+    """
+    directory = directory or MIGRATIONS_DIR
+    migrations = []
+    for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        match = MIGRATION_FILE.match(filename)
+        if not match:
+            continue
+        version, name = int(match.group(1)), match.group(2)
+        if migrations and migrations[-1]['version'] == version:
+            raise MigrationError(f"迁移编号重复: {filename}")
+        spec = importlib.util.spec_from_file_location(f'migration_{version:04d}', os.path.join(directory, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        scope = getattr(module, 'SCOPE', 'shard')
+        if scope not in ('global', 'shard'):
+            raise MigrationError(f"{filename}: SCOPE 只能是 global 或 shard")
+        migrations.append({
+            'version': version,
+            'name': name,
+            'description': (module.__doc__ or name).strip().splitlines()[0],
+            'scope': scope,
+            'module': module,
+        })
+    return migrations
+
+
+def _targets() -> list:
+    """
+    需要迁移的数据库
+
+    Returns:
+        [(名称, 适用的 SCOPE 集合, 连接的上下文管理器工厂)]
+    """
+    if DATABASE_BACKEND == 'postgres':
+        import database_pg
+        return [('postgres', {'global', 'shard'}, database_pg.get_connection)]
+    global_path = database.get_db_path()
+    targets = [('全局库', {'global'}, database.get_connection)]
+    for shard in range(database.DATABASE_SHARDS):
+        if database.get_shard_path(shard) == global_path:
+            targets[0][1].add('shard')
+        else:
+            targets.append((f'分库 {shard}', {'shard'},
+                            lambda shard=shard: database.get_connection(shard=shard)))
+    return targets
+
+
+def _ensure_tables(conn):
+    """创建版本表和回填进度表"""
+    time_type = 'DOUBLE PRECISION' if DATABASE_BACKEND == 'postgres' else 'REAL'
+    cursor = _cursor(conn)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at {time_type} NOT NULL
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            name TEXT PRIMARY KEY,
+            last_key TEXT,               -- 最后处理的键（JSON）
+            processed INTEGER NOT NULL DEFAULT 0,
+            updated_at {time_type} NOT NULL,
+            finished_at {time_type}
+        )
+    ''')
+    conn.commit()
+
+
+def applied_versions(conn) -> set:
+    """数据库中已完成的迁移编号"""
+    _ensure_tables(conn)
+    cursor = _cursor(conn)
+    cursor.execute('SELECT version FROM schema_version')
+    versions = {row['version'] for row in cursor.fetchall()}
+    conn.commit()
+    return versions
+
+
+def run(on_chunk=None, migrations: list = None) -> list:
+    """
+    在各数据库上依次执行待完成的迁移
+
+    Args:
+        on_chunk: 每批回填提交后的回调，返回 False 时中止迁移（下次从中断处继续）
+
+    Returns:
+        本次完成的迁移 [(数据库名称, 编号, 名称)]
+    """
+    migrations = load_migrations() if migrations is None else migrations
+    done = []
+    _hooks['on_chunk'] = on_chunk
+    try:
+        for label, scopes, connect in _targets():
+            with connect() as conn:
+                applied = applied_versions(conn)
+                for migration in migrations:
+                    if migration['version'] in applied or migration['scope'] not in scopes:
+                        continue
+                    start = time.perf_counter()
+                    upgrade = getattr(migration['module'], DATABASE_BACKEND, None)
+                    if upgrade is not None:
+                        upgrade(conn)
+                    cursor = _cursor(conn)
+                    cursor.execute(_sql('''
+                        INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)
+                    '''), (migration['version'], migration['name'], time.time()))
+                    conn.commit()
+                    done.append((label, migration['version'], migration['name']))
+                    print(f"[迁移] {label}: {migration['version']:04d} {migration['description']} "
+                          f"完成（{(time.perf_counter() - start) * 1000:.0f}ms）")
+    finally:
+        _hooks['on_chunk'] = None
+    return done
+
+
+def status() -> list:
+    """各数据库的迁移状态 [{'database', 'applied': [编号], 'pending': [编号]}]"""
+    migrations = load_migrations()
+    result = []
+    for label, scopes, connect in _targets():
+        with connect() as conn:
+            applied = applied_versions(conn)
+        versions = [m['version'] for m in migrations if m['scope'] in scopes]
+        result.append({
+            'database': label,
+            'applied': sorted(applied),
+            'pending': [v for v in versions if v not in applied],
+        })
+    return result
+
+
+def _save_progress(cursor, name: str, last_key, rows: int, finished: bool):
+    now = time.time()
+    cursor.execute(_sql('''
+        INSERT INTO backfill_progress (name, last_key, processed, updated_at, finished_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE
+        SET last_key = excluded.last_key, processed = excluded.processed,
+            updated_at = excluded.updated_at, finished_at = excluded.finished_at
+    '''), (name, json.dumps(last_key, ensure_ascii=False), rows, now, now if finished else None))
+
+
+def backfill(conn, name: str, fetch, apply, key, chunk: int = None) -> int:
+    """
+    分批回填（每批一个短事务，可中断后继续）
+
+    Args:
+        name: 回填名称（进度的键，同一数据库内唯一）
+        fetch: 取一批待处理的行 (cursor, 上一批最后的键（首批为 None）, 批量) -> 行列表，须按键升序
+        apply: 处理一批行 (cursor, 行列表)，在同一事务内执行
+        key: 行的键 (行) -> 可 JSON 序列化的值
+        chunk: 最大批量，默认 BACKFILL_CHUNK
+
+    Returns:
+        累计处理的行数（含中断前的批次）
+    """
+    chunk = chunk or BACKFILL_CHUNK
+    cursor = _cursor(conn)
+    cursor.execute(_sql('SELECT last_key, processed, finished_at FROM backfill_progress WHERE name = ?'), (name,))
+    row = cursor.fetchone()
+    conn.commit()
+    if row and row['finished_at']:
+        return row['processed']
+    last_key = json.loads(row['last_key']) if row and row['last_key'] else None
+    total = row['processed'] if row else 0
+    if last_key is not None:
+        print(f"[迁移] {name}: 从 {last_key} 继续（已处理 {total} 行）")
+
+    size = chunk
+    while True:
+        start = time.perf_counter()
+        rows = fetch(cursor, last_key, size)
+        if rows:
+            apply(cursor, rows)
+            last_key = key(rows[-1])
+            total += len(rows)
+        finished = len(rows) < size
+        _save_progress(cursor, name, last_key, total, finished)
+        conn.commit()
+        if finished:
+            print(f"[迁移] {name}: 回填完成，共 {total} 行")
+            return total
+
+        # 按本批耗时调整批量，写锁持有时间保持在目标以内
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > BACKFILL_TARGET_MS:
+            size = max(min(MIN_CHUNK, size), size // 2)
+        elif elapsed_ms < BACKFILL_TARGET_MS / 4:
+            size = min(chunk, size * 2)
+        if _hooks['on_chunk'] is not None and _hooks['on_chunk']() is False:
+            raise MigrationError(f"{name}: 迁移中止，已处理 {total} 行")
+        time.sleep(BACKFILL_PAUSE_MS / 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='执行数据库迁移')
+    parser.add_argument('--status', action='store_true', help='只查看各数据库的迁移状态')
+    args = parser.parse_args()
+
+    if args.status:
+        for item in status():
+            print(f"{item['database']}: 已完成 {item['applied'] or '无'}，待执行 {item['pending'] or '无'}")
+        return
+    repository.init_db()
+    done = run()
+    print(f"[迁移] 完成 {len(done)} 项")
+
+
+if __name__ == '__main__':
+    main()
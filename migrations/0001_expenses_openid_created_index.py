@@ -0,0 +1,15 @@
+"""记账记录按 (openid, created_at) 建索引
+
+今日/本月汇总、历史、统计都按用户和时间范围查询，SQLite 此前只能扫描全表。
+SQLite 没有在线建索引，建索引期间持有写锁（单个分库的记录量下通常在秒级以内）；
+PostgreSQL 在 init_db 中已经建立，这里不需要变更。
+"""
+
+SCOPE = 'shard'
+
+
+def sqlite(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_expenses_openid_created ON expenses(openid, created_at)
+    ''')
+    conn.commit()
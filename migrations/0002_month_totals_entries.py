@@ -0,0 +1,56 @@
+"""回填月累计的记账笔数
+
+entries 列加入之前的月累计行笔数为 0，查询成本估算会低估这些用户。按 (openid, month) 分批，
+从明细重新计数；回填完成前本月的行由 get_month_activity 按需补算。
+"""
+
+import migrate
+
+SCOPE = 'shard'
+
+
+def _fetch(placeholder: str):
+    def fetch(cursor, last_key, limit):
+        openid, month = last_key or ('', '')
+        cursor.execute(f'''
+            SELECT openid, month FROM month_totals
+            WHERE (openid, month) > ({placeholder}, {placeholder})
+              AND entries = 0 AND (expense != 0 OR income != 0)
+            ORDER BY openid, month
+            LIMIT {placeholder}
+        ''', (openid, month, limit))
+        return cursor.fetchall()
+    return fetch
+
+
+def _key(row):
+    return [row['openid'], row['month']]
+
+
+def sqlite(conn):
+    def apply(cursor, rows):
+        # entries = 0 的条件避免覆盖回填期间新记账累加的笔数
+        cursor.executemany('''
+            UPDATE month_totals SET entries = (
+                SELECT COUNT(*) FROM expenses e
+                WHERE e.openid = month_totals.openid AND strftime('%Y-%m', e.created_at) = month_totals.month
+            )
+            WHERE openid = ? AND month = ? AND entries = 0
+        ''', [(row['openid'], row['month']) for row in rows])
+
+    migrate.backfill(conn, 'month_totals_entries', _fetch('?'), apply, _key)
+
+
+def postgres(conn):
+    def apply(cursor, rows):
+        cursor.executemany('''
+            UPDATE month_totals SET entries = (
+                SELECT COUNT(*) FROM expenses e
+                WHERE e.openid = month_totals.openid
+                  AND e.created_at >= to_date(month_totals.month, 'YYYY-MM')
+                  AND e.created_at < to_date(month_totals.month, 'YYYY-MM') + interval '1 month'
+            )
+            WHERE openid = %s AND month = %s AND entries = 0
+        ''', [(row['openid'], row['month']) for row in rows])
+
+    migrate.backfill(conn, 'month_totals_entries', _fetch('%s'), apply, _key)
@@ -0,0 +1,49 @@
+"""回填贷款/负债的结束日期
+
+此前添加固定开支时只写 start_date，按起始日期和期数补上 end_date（规则同 database._term_end），
+到期的记录由夜间任务停用并通知还清。
+"""
+
+from datetime import date
+
+import database
+import migrate
+
+SCOPE = 'shard'
+
+
+def _backfill(conn, placeholder: str):
+    types = ', '.join(f"'{t}'" for t in database.TERM_TYPES)
+
+    def fetch(cursor, last_key, limit):
+        cursor.execute(f'''
+            SELECT id, type, start_date, total_months FROM recurring_expenses
+            WHERE id > {placeholder} AND end_date IS NULL AND type IN ({types})
+              AND start_date IS NOT NULL AND total_months > 0
+            ORDER BY id
+            LIMIT {placeholder}
+        ''', (last_key or 0, limit))
+        return cursor.fetchall()
+
+    def apply(cursor, rows):
+        updates = []
+        for row in rows:
+            start = row['start_date']
+            if isinstance(start, str):
+                start = date.fromisoformat(start[:10])
+            end = database._term_end(start, row['total_months'], row['type'])
+            updates.append((end.isoformat(), row['id']))
+        cursor.executemany(f'''
+            UPDATE recurring_expenses SET end_date = {placeholder}
+            WHERE id = {placeholder} AND end_date IS NULL
+        ''', updates)
+
+    migrate.backfill(conn, 'recurring_end_date', fetch, apply, lambda row: row['id'])
+
+
+def sqlite(conn):
+    _backfill(conn, '?')
+
+
+def postgres(conn):
+    _backfill(conn, '%s')
@@ -0,0 +1,27 @@
+"""生效中的固定开支按 openid 建部分索引
+
+欠款查询只读取 is_active = 1 的行；到期和删除的记录停用后移出索引，历史记录再多也不影响查询。
+PostgreSQL 使用 CREATE INDEX CONCURRENTLY，建索引期间不阻塞写入。
+"""
+
+SCOPE = 'shard'
+
+
+def sqlite(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_recurring_active ON recurring_expenses(openid) WHERE is_active = 1
+    ''')
+    conn.commit()
+
+
+def postgres(conn):
+    # CONCURRENTLY 不能在事务中执行
+    conn.commit()
+    conn.autocommit = True
+    try:
+        conn.cursor().execute('''
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_recurring_active
+            ON recurring_expenses (openid) WHERE is_active = 1
+        ''')
+    finally:
+        conn.autocommit = False
@@ -0,0 +1,230 @@
+"""
+采样性能剖析模块
+
+线上无法挂调试器，cProfile 开销又太大，这里用一个后台采样线程定期读取目标线程的调用栈
+（sys._current_frames），开销只与采样频率有关，可以在真实流量下短时间打开：
+- 按比例剖析 /wechat 文本消息（PROFILE_REQUEST_PERCENT，或管理接口 /admin/profile 临时调整），
+  按 parse_message 的指令分别汇总（标签如 wechat-支出）
+- 剖析下一次实际执行的每日推送（PROFILE_PUSH=1 或管理接口），包括推送线程池中的发送线程
+- 每次剖析结束后把调用栈以折叠格式（"函数;函数;函数 次数"，每行一条）追加到
+  PROFILE_DIR/<标签>.folded，可直接交给 flamegraph.pl 或 speedscope 生成火焰图
+
+采样线程只在有剖析进行时运行，没有剖析时不产生任何开销。查看某个文件中自身耗时最多的函数：
+python3 profiler.py data/profiles/wechat-支出.folded
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from config import PROFILE_DIR, PROFILE_REQUEST_PERCENT, PROFILE_PUSH, PROFILE_INTERVAL_MS
+
+
+# 运行期设置（可由管理接口修改）；管理接口写入 PROFILE_DIR/settings.json，
+# 各 worker 每秒最多检查一次文件，请求落在哪个 worker 上都对所有进程生效
+_settings = {'request_percent': PROFILE_REQUEST_PERCENT, 'push_runs': 1 if PROFILE_PUSH else 0}
+_settings_state = {'mtime': None, 'checked_at': 0.0}
+SETTINGS_CHECK_SECONDS = 1.0
+
+# 进行中的剖析 {会话 id: {'tag', 'threads': 线程 id 集合, 'prefix': 线程名前缀, 'stacks': {栈: 次数}}}
+_sessions = {}
+_lock = threading.Lock()
+_sampler = {'thread': None, 'pid': None}
+
+
+def _settings_path() -> str:
+    return os.path.join(PROFILE_DIR, 'settings.json')
+
+
+def _save_settings():
+    """写入共享设置文件（先写临时文件再替换）"""
+    path = _settings_path()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(_settings, f)
+    os.replace(tmp, path)
+    _settings_state['mtime'] = os.path.getmtime(path)
+
+
+def _refresh_settings(force: bool = False):
+    """共享设置文件修改后重新读取"""
+    now = time.monotonic()
+    if not force and now - _settings_state['checked_at'] < SETTINGS_CHECK_SECONDS:
+        return
+    _settings_state['checked_at'] = now
+    try:
+        mtime = os.path.getmtime(_settings_path())
+        if mtime != _settings_state['mtime']:
+            with open(_settings_path(), encoding='utf-8') as f:
+                _settings.update(json.load(f))
+            _settings_state['mtime'] = mtime
+    except (OSError, ValueError):
+        pass
+
+
+def configure(request_percent: float = None, push_runs: int = None) -> dict:
+    """调整剖析比例或待剖析的推送次数（对所有进程生效），返回当前设置"""
+    with _lock:
+        _refresh_settings(force=True)
+        if request_percent is not None or push_runs is not None:
+            if request_percent is not None:
+                _settings['request_percent'] = max(0.0, min(100.0, float(request_percent)))
+            if push_runs is not None:
+                _settings['push_runs'] = max(0, int(push_runs))
+            _save_settings()
+        return dict(_settings)
+
+
+def should_profile_request() -> bool:
+    """按比例抽取要剖析的请求"""
+    _refresh_settings()
+    percent = _settings['request_percent']
+    return percent > 0 and random.random() * 100 < percent
+
+
+def take_push_run() -> bool:
+    """是否剖析本次推送（每次占用一个名额；推送只在运行后台任务的进程中执行）"""
+    with _lock:
+        _refresh_settings(force=True)
+        if _settings['push_runs'] <= 0:
+            return False
+        _settings['push_runs'] -= 1
+        if os.path.exists(_settings_path()):
+            _save_settings()
+        return True
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}"
+
+
+def collapse(frame) -> str:
+    """把调用栈折叠成一行（根在前，以分号分隔）"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def _sample_loop():
+    """采样线程：没有进行中的剖析时退出"""
+    interval = PROFILE_INTERVAL_MS / 1000
+    me = threading.get_ident()
+    while True:
+        time.sleep(interval)
+        frames = sys._current_frames()
+        with _lock:
+            if not _sessions:
+                _sampler['thread'] = None
+                return
+            named = None
+            for session in _sessions.values():
+                threads = set(session['threads'])
+                if session['prefix']:
+                    if named is None:
+                        named = {t.ident: t.name for t in threading.enumerate()}
+                    threads.update(tid for tid, name in named.items() if name.startswith(session['prefix']))
+                for tid in threads:
+                    frame = frames.get(tid)
+                    if frame is None or tid == me:
+                        continue
+                    stack = collapse(frame)
+                    session['stacks'][stack] = session['stacks'].get(stack, 0) + 1
+
+
+def _ensure_sampler():
+    """启动采样线程（fork 之后的子进程重新启动）"""
+    if _sampler['thread'] is None or _sampler['pid'] != os.getpid():
+        thread = threading.Thread(target=_sample_loop, name='profiler', daemon=True)
+        _sampler.update(thread=thread, pid=os.getpid())
+        thread.start()
+
+
+def _write(tag: str, stacks: dict) -> str:
+    """把折叠栈追加到标签对应的文件（一次 O_APPEND 写入，多进程同时写不会交错）"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f'{tag}.folded')
+    data = ''.join(f'{stack} {count}\n' for stack, count in stacks.items()).encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return path
+
+
+@contextmanager
+def profile(tag: str, thread_prefix: str = None):
+    """
+    剖析 with 块内当前线程（以及名称以 thread_prefix 开头的线程）的执行
+
+    Args:
+        tag: 结果文件名（不含扩展名）
+    """
+    session = {'tag': tag, 'threads': {threading.get_ident()}, 'prefix': thread_prefix, 'stacks': {}}
+    key = object()
+    with _lock:
+        _sessions[key] = session
+        _ensure_sampler()
+    start = time.perf_counter()
+    try:
+        yield session
+    finally:
+        with _lock:
+            _sessions.pop(key, None)
+        if session['stacks']:
+            try:
+                path = _write(tag, session['stacks'])
+                samples = sum(session['stacks'].values())
+                print(f"[性能剖析] {tag}: {(time.perf_counter() - start) * 1000:.0f}ms，"
+                      f"{samples} 个样本 -> {path}")
+            except OSError as e:
+                print(f"[性能剖析] 写入失败: {e}")
+
+
+def list_profiles() -> list:
+    """已有的剖析文件 [{'name', 'bytes', 'modified_at'}]"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    files = []
+    for name in sorted(os.listdir(PROFILE_DIR)):
+        if name.endswith('.folded'):
+            stat = os.stat(os.path.join(PROFILE_DIR, name))
+            files.append({'name': name, 'bytes': stat.st_size, 'modified_at': int(stat.st_mtime)})
+    return files
+
+
+def top_functions(path: str, n: int = 15) -> list:
+    """
+    折叠栈文件中自身耗时（栈顶样本数）最多的函数
+
+    Returns:
+        [(函数, 样本数, 占比)]
+    """
+    counts = {}
+    total = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if not stack:
+                continue
+            leaf = stack.rsplit(';', 1)[-1]
+            counts[leaf] = counts.get(leaf, 0) + int(count)
+            total += int(count)
+    ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:n]
+    return [(name, count, count / total) for name, count in ranked]
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or [os.path.join(PROFILE_DIR, f['name']) for f in list_profiles()]
+    for path in paths:
+        print(f"\n{path}")
+        for name, count, share in top_functions(path):
+            print(f"{share:7.1%} {count:8d}  {name}")
@@ -0,0 +1,83 @@
+"""
+推送渠道模块
+
+每日推送可以通过两种渠道发送：
+- text：客服消息，内容最完整，但只能发给 48 小时内互动过的用户
+- template：模板消息，不受互动窗口限制，字段由 WECHAT_PUSH_TEMPLATE_FIELDS 从推送数据映射
+
+pick_channel 按用户的互动时间和 WECHAT_PUSH_CHANNEL 配置为每位用户选择渠道。
+发送统一经过 wechat_client（重试、令牌刷新、熔断）。
+"""
+
+import time
+
+from config import WECHAT_PUSH_TEMPLATE_ID, WECHAT_PUSH_TEMPLATE_FIELDS, WECHAT_PUSH_CHANNEL
+from wechat_handler import render_daily_push_message
+from wechat_client import send_text, send_template
+
+
+# 客服消息只能发给 48 小时内互动过的用户
+CUSTOMER_SERVICE_WINDOW = 48 * 3600
+
+
+def send_text_push(client, openid: str, data: dict):
+    """通过客服消息发送每日推送"""
+    send_text(openid, render_daily_push_message(data), client)
+
+
+def build_template_data(data: dict, fields: dict = None) -> dict:
+    """
+    按字段映射生成模板消息数据
+
+    Args:
+        data: get_daily_push_data 的返回值
+        fields: {模板字段: 推送数据键}，数据键 'message' 表示完整的推送文本
+
+    Returns:
+        {模板字段: {'value': 文本}}
+    """
+    fields = fields or WECHAT_PUSH_TEMPLATE_FIELDS
+    values = dict(data, message=render_daily_push_message(data))
+    template_data = {}
+    for field, key in fields.items():
+        value = values.get(key, '')
+        if isinstance(value, float):
+            value = f'{value:,.2f}'
+        template_data[field] = {'value': str(value if value is not None else '')}
+    return template_data
+
+
+def send_template_push(client, openid: str, data: dict):
+    """通过模板消息发送每日推送"""
+    send_template(openid, WECHAT_PUSH_TEMPLATE_ID, build_template_data(data), client)
+
+
+# 渠道名称 -> 发送函数 (client, openid, data)
+CHANNELS = {
+    'text': send_text_push,
+    'template': send_template_push,
+}
+
+
+def pick_channel(user: dict, now: float = None) -> str:
+    """
+    为用户选择推送渠道
+
+    Args:
+        user: 至少包含 last_interaction_at（没有互动记录的老用户按窗口内处理）
+
+    Returns:
+        渠道名称，没有可用渠道时返回 None
+    """
+    if WECHAT_PUSH_CHANNEL == 'template' and WECHAT_PUSH_TEMPLATE_ID:
+        return 'template'
+    now = now or time.time()
+    last_interaction = user.get('last_interaction_at')
+    if last_interaction is None or now - last_interaction < CUSTOMER_SERVICE_WINDOW:
+        return 'text'
+    return 'template' if WECHAT_PUSH_TEMPLATE_ID else None
+
+
+def send_push(client, channel: str, openid: str, data: dict):
+    """通过指定渠道发送每日推送"""
+    CHANNELS[channel](client, openid, data)
@@ -0,0 +1,66 @@
+"""
+存储后端选择模块
+
+业务代码统一从本模块导入数据访问函数，具体实现由 config.DATABASE_BACKEND 决定：
+- sqlite（默认）：database.py，本地文件，支持分库
+- postgres：database_pg.py，连接池 + 服务端聚合，适合多写入者的大规模部署
+
+每个后端都必须实现 REPOSITORY_API 中列出的同名函数，参数和返回结构保持一致。
+"""
+
+import importlib
+
+from config import DATABASE_BACKEND
+
+# 后端名称 -> 实现模块
+BACKENDS = {
+    'sqlite': 'database',
+    'postgres': 'database_pg',
+}
+
+# 仓储接口：所有后端必须提供的函数
+REPOSITORY_API = (
+    'init_db',
+    # 进程生命周期
+    'warm_up', 'close_pool',
+    # 用户
+    'add_user', 'update_nickname', 'get_user', 'get_all_users', 'set_push_time',
+    'record_interaction', 'unsubscribe_user', 'suspend_push',
+    # 分类
+    'resolve_category', 'infer_category', 'merge_category', 'get_user_categories',
+    # 记账
+    'add_expense', 'add_expenses', 'search_expenses', 'get_today_summary', 'get_month_summary',
+    'get_expense_history', 'get_category_stats', 'get_month_activity',
+    # 预算
+    'set_budget', 'get_budget', 'set_family_budget', 'get_family_budget', 'take_budget_alerts',
+    # 固定开支/贷款
+    'add_recurring_expense', 'get_recurring_expenses', 'delete_recurring_expense',
+    'get_daily_debt', 'expire_recurring_expenses', 'post_recurring_charges', 'get_recurring_postings',
+    # 家庭组
+    'create_family', 'join_family', 'leave_family', 'get_user_family', 'is_family_creator',
+    'get_family_members', 'get_family_members_detail', 'get_family_recurring_expenses',
+    'get_family_daily_debt', 'get_family_debt_ranking',
+    'enqueue_family_notification', 'enqueue_family_notifications',
+    'get_due_family_digests', 'take_family_notifications',
+    # 调度协调
+    'acquire_lease', 'release_lease', 'create_push_tasks', 'claim_push_task',
+    'renew_push_task', 'release_push_task', 'get_push_targets', 'mark_user_pushed',
+)
+
+
+def load_backend(name: str):
+    """加载存储后端模块并检查接口是否完整"""
+    if name not in BACKENDS:
+        raise ValueError(f"未知的存储后端: {name}（可选: {', '.join(BACKENDS)}）")
+    module = importlib.import_module(BACKENDS[name])
+    missing = [func for func in REPOSITORY_API if not hasattr(module, func)]
+    if missing:
+        raise ImportError(f"存储后端 {name} 缺少实现: {', '.join(missing)}")
+    return module
+
+
+backend = load_backend(DATABASE_BACKEND)
+
+globals().update({func: getattr(backend, func) for func in REPOSITORY_API})
+
+__all__ = list(REPOSITORY_API)
@@ -0,0 +1,164 @@
+"""
+离线分库迁移工具
+
+把用户个人数据（记账记录、固定开支、预算、月累计）从当前分库布局迁移到新的分库数量。
+迁移期间请先停止服务，完成后修改环境变量 DATABASE_SHARDS 再启动。
+
+用法：
+    python reshard.py 4            # 从 config.DATABASE_SHARDS 迁移到 4 个分库
+    python reshard.py 1 --from 4   # 合并回单库
+"""
+
+import argparse
+import os
+import sqlite3
+
+import database
+
+# 按 openid 路由的个人数据表（expenses_fts 在目标分库中重建）
+SHARDED_TABLES = ('expenses', 'recurring_expenses', 'budgets', 'month_totals', 'recurring_postings')
+
+# 引用其他分库表 id 的列：被引用的行重新分配 id 后按新 id 改写
+REFERENCES = {'recurring_postings': {'recurring_id': 'recurring_expenses', 'expense_id': 'expenses'}}
+
+
+def _connect(path: str):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    database.init_storage(conn)
+    return conn
+
+
+def _copy_table(source, targets: dict, table: str, new_shards: int, remapped: dict) -> int:
+    """
+    逐行复制一张表到目标分库，返回复制行数
+
+    Args:
+        remapped: {表名: {旧 id: 新 id}}，同一个旧分库中重新分配了 id 的行，复制时记录并用于改写引用
+    """
+    source_cursor = source.cursor()
+    source_cursor.execute(f'PRAGMA table_info({table})')
+    columns = [row['name'] for row in source_cursor.fetchall()]
+    if not columns:
+        return 0
+
+    copied = 0
+    source_cursor.execute(f'SELECT * FROM {table} ORDER BY rowid')
+    for row in source_cursor:
+        target = targets[database.get_shard_index(row['openid'], new_shards)]
+        values = [row[c] for c in columns]
+        for column, referenced in REFERENCES.get(table, {}).items():
+            i = columns.index(column)
+            values[i] = remapped.get(referenced, {}).get(values[i], values[i])
+        try:
+            target.execute(f'''
+                INSERT INTO {table} ({', '.join(columns)})
+                VALUES ({database._placeholders(columns)})
+            ''', values)
+        except sqlite3.IntegrityError:
+            if 'id' not in columns:
+                raise
+            # 来自不同旧分库的自增 id 冲突时重新分配 id
+            rest = [c for c in columns if c != 'id']
+            cursor = target.execute(f'''
+                INSERT INTO {table} ({', '.join(rest)})
+                VALUES ({database._placeholders(rest)})
+            ''', [v for c, v in zip(columns, values) if c != 'id'])
+            remapped.setdefault(table, {})[row['id']] = cursor.lastrowid
+        copied += 1
+    return copied
+
+
+def reshard_database(new_shards: int, old_shards: int = None) -> dict:
+    """
+    把分库从 old_shards 个迁移到 new_shards 个
+
+    Returns:
+        {表名: 复制行数}
+    """
+    old_shards = old_shards or database.DATABASE_SHARDS
+    if new_shards < 1 or old_shards < 1:
+        raise ValueError("分库数量必须大于 0")
+    if new_shards == old_shards:
+        return {}
+
+    global_path = database.get_db_path()
+    sources = [database.get_shard_path(i, old_shards) for i in range(old_shards)]
+    finals = [database.get_shard_path(i, new_shards) for i in range(new_shards)]
+    # 与旧分库同名的目标先写到临时文件，全部完成后再替换
+    writes = [path + '.reshard' if path in sources else path for path in finals]
+    for path in writes:
+        if path != global_path and os.path.exists(path):
+            os.remove(path)
+
+    counts = {table: 0 for table in SHARDED_TABLES}
+    global_conn = _connect(global_path)
+    database._init_global_tables(global_conn.cursor())
+    targets = {i: (global_conn if path == global_path else _connect(path))
+               for i, path in enumerate(writes)}
+    try:
+        for target in targets.values():
+            database._init_shard_tables(target.cursor(), global_conn.cursor())
+
+        for path in sources:
+            if not os.path.exists(path):
+                continue
+            source = global_conn if path == global_path else _connect(path)
+            try:
+                # 先把旧分库升级到当前表结构
+                database._init_shard_tables(source.cursor(), global_conn.cursor())
+                source.commit()
+                remapped = {}
+                for table in SHARDED_TABLES:
+                    counts[table] += _copy_table(source, targets, table, new_shards, remapped)
+                    for target in targets.values():
+                        target.commit()
+            finally:
+                if source is not global_conn:
+                    source.close()
+
+        # 为复制过来的记录重建全文索引
+        for target in targets.values():
+            database._init_shard_tables(target.cursor(), global_conn.cursor())
+            target.commit()
+        global_conn.commit()
+
+        # 旧布局中全局库兼作分库时，清空其中已迁走的个人数据
+        if global_path in sources:
+            for table in SHARDED_TABLES + ('expenses_fts',):
+                global_conn.execute(f'DELETE FROM {table}')
+            global_conn.commit()
+    finally:
+        for target in targets.values():
+            if target is not global_conn:
+                target.close()
+        global_conn.close()
+
+    for path in sources:
+        if path != global_path and os.path.exists(path):
+            os.remove(path)
+    for write_path, final_path in zip(writes, finals):
+        if write_path != final_path:
+            os.replace(write_path, final_path)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线分库迁移（请先停止服务）')
+    parser.add_argument('shards', type=int, help='新的分库数量')
+    parser.add_argument('--from', dest='old_shards', type=int, default=None,
+                        help='当前分库数量（默认读取 DATABASE_SHARDS）')
+    args = parser.parse_args()
+
+    old_shards = args.old_shards or database.DATABASE_SHARDS
+    print(f"[分库迁移] {old_shards} → {args.shards}")
+    counts = reshard_database(args.shards, old_shards)
+    for table, count in counts.items():
+        print(f"[分库迁移] {table}: {count} 行")
+    print(f"[分库迁移] 完成，请设置 DATABASE_SHARDS={args.shards} 后重启服务")
+    print("[分库迁移] 注意：自增 id 冲突的记录会重新编号，固定开支编号可能变化")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,553 @@
 """
 定时任务调度模块
 
-实现每日推送功能
+实现每日推送功能，支持多 gunicorn worker / 多台机器同时运行：
+- 推送时间：每位用户有自己的推送时间（「推送 7:30」），默认时间的用户在窗口内随机错开，
+  下一次推送时间存于 users.next_push_at 并建索引，数据库即是按到期时间排序的推送队列
+- 分区推送：用户按 openid 哈希桶划分为分区，分区任务记录分区内最早的到期时间；
+  所有进程轮询领取已到期的分区，每次只推送一小批，交还后再按新的到期时间排队
+- 领导者选举：各进程定期争抢数据库中的租约，持有租约的领导者负责创建分区任务；
+  进程中途退出时分区租约过期，由其他进程接手
+- 渠道与并发：每批用户在线程池中并行发送，按用户的互动时间选择客服消息或模板消息
+  （见 push_channels.py）；取消关注的用户移出推送队列，超出 48 小时窗口且未配置模板的
+  用户暂停推送，等再次互动后恢复
+- 出站调用经过 wechat_client 的重试与熔断；限流或熔断时推送延后重试，不会跳过当天
+
+另外负责发送家庭支出汇总：成员记账先写入发件箱，最早一条等待 FAMILY_DIGEST_SECONDS 秒后，
+同一家庭的所有记录合并成一条通知发给其他成员。
+
+预算预警：记账时跨过预算阈值写入 budget_alerts，由各进程轮询发出（个人预警发给本人，
+家庭预警发给全部成员）。
+
+贷款/负债到期：每天凌晨停用已过结束日期的记录，并通知本人「恭喜还清」。
+
+固定开支入账：每小时把到还款日的固定开支/贷款写入账本，每个分期每月只入账一次。
+
+数据库迁移（migrate.py）：启动后执行一次待完成的迁移，持有迁移租约的进程执行，每批回填后续约。
+
+数据库维护（maintenance.py，SQLite）：定时 PRAGMA optimize，每天低峰期 ANALYZE、增量回收空闲页和 WAL 检查点。
+
+在线备份（backup.py，SQLite）：每天低峰期限速复制各库，完整性检查通过后压缩保存并轮换。
 """
 
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
 from apscheduler.schedulers.background import BackgroundScheduler
-from wechatpy import WeChatClient
 from config import (
-    WECHAT_APP_ID, WECHAT_APP_SECRET,
-    DAILY_PUSH_HOUR, DAILY_PUSH_MINUTE
+    WECHAT_PUSH_TEMPLATE_ID, CIRCUIT_RESET_SECONDS,
+    SCHEDULER_LEASE_SECONDS, PUSH_PARTITIONS, PUSH_TASK_LEASE_SECONDS, PUSH_POLL_SECONDS,
+    PUSH_BATCH_SIZE, PUSH_CONCURRENCY, FAMILY_DIGEST_SECONDS,
+    MAINTENANCE_HOUR, MAINTENANCE_OPTIMIZE_HOURS, BACKUP_HOUR
 )
-from database import get_all_users
-from wechat_handler import get_daily_push_message
+from repository import (
+    acquire_lease, release_lease, create_push_tasks, claim_push_task,
+    renew_push_task, release_push_task, get_push_targets, mark_user_pushed,
+    unsubscribe_user, suspend_push,
+    get_due_family_digests, take_family_notifications, get_family_members_detail,
+    get_month_summary, get_daily_debt, take_budget_alerts, get_user_family,
+    expire_recurring_expenses, post_recurring_charges
+)
+from wechat_handler import get_daily_push_data, render_family_digest, render_budget_alert, render_paid_off
+from push_channels import pick_channel, send_push
+from wechat_client import OutboundError, get_client, send_text
+import backup
+import category_matcher
+import maintenance
+import migrate
+import profiler
 
 
 # 全局调度器实例
 scheduler = None
 
+# 领导者租约名称
+LEADER_LEASE = 'scheduler_leader'
+
+# 迁移租约名称（多台机器同时启动时只有一个进程执行迁移）
+MIGRATION_LEASE = 'schema_migrations'
+
+# 当前进程是否为领导者
+is_leader = False
+
+# 推送发送线程的名称前缀（性能剖析时一并采样）
+PUSH_THREAD_PREFIX = 'push-send'
+
+# 微信错误码：用户未关注 / 超出客服消息回复时限
+ERR_NOT_SUBSCRIBED = 43004
+ERR_OUT_OF_WINDOW = 45015
+
+
+def get_holder_id() -> str:
+    """当前进程的标识（主机名:进程号），用于租约归属"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_push_run_key() -> str:
+    """推送分区任务的标识（分区数变化时旧任务由领导者清理）"""
+    return f"daily_push/{PUSH_PARTITIONS}"
+
+
+def plan_push_tasks(force: bool = False) -> int:
+    """
+    创建推送分区任务（仅领导者执行，重复调用不会重复创建）
+
+    Args:
+        force: 不检查领导者身份（手动触发时使用）
+
+    Returns:
+        新创建的分区数
+    """
+    if not force and not is_leader:
+        return 0
+    created = create_push_tasks(get_push_run_key(), PUSH_PARTITIONS)
+    if created:
+        print(f"[定时任务] 已创建推送分区 {created} 个")
+    return created
+
+
+def leader_heartbeat():
+    """续约/争抢领导者租约；新当选的领导者确保分区任务存在"""
+    global is_leader
+    holder = get_holder_id()
+    try:
+        leader = acquire_lease(LEADER_LEASE, holder, SCHEDULER_LEASE_SECONDS)
+    except Exception as e:
+        print(f"[调度器] 租约续约失败: {e}")
+        leader = False
+
+    if leader != is_leader:
+        print(f"[调度器] {holder} {'成为' if leader else '不再是'}领导者")
+        is_leader = leader
+        if leader:
+            plan_push_tasks()
+
+
+def run_migrations() -> list:
+    """
+    执行待完成的数据库迁移（抢到迁移租约时）
+
+    Returns:
+        本次完成的迁移，未抢到租约时为空列表
+    """
+    holder = get_holder_id()
+    if not acquire_lease(MIGRATION_LEASE, holder, SCHEDULER_LEASE_SECONDS):
+        return []
+    try:
+        return migrate.run(on_chunk=lambda: acquire_lease(MIGRATION_LEASE, holder, SCHEDULER_LEASE_SECONDS))
+    except Exception as e:
+        print(f"[迁移] 未完成，稍后重试: {e}")
+        return []
+    finally:
+        release_lease(MIGRATION_LEASE, holder)
+
+
+def _deliver_push(client, user: dict) -> str:
+    """
+    为一位用户选择渠道并发送每日推送（在线程池中执行，不写库）
+
+    Returns:
+        结果：'sent'、'failed'、'deferred'（上游暂时不可用，稍后重试）、
+        'unreachable'（暂停推送）或 'unsubscribed'
+    """
+    openid = user['openid']
+    channel = pick_channel(user)
+    if channel is None:
+        print(f"[定时任务] 超出互动窗口，暂停推送: {openid[:8]}...")
+        return 'unreachable'
+    try:
+        send_push(client, channel, openid, get_daily_push_data(openid))
+        print(f"[定时任务] 成功推送给用户 ({channel}): {openid[:8]}...")
+        return 'sent'
+    except OutboundError as e:
+        print(f"[定时任务] 推送失败 {openid[:8]}...: {e}")
+        if e.transient:
+            return 'deferred'
+        if e.errcode == ERR_NOT_SUBSCRIBED:
+            return 'unsubscribed'
+        if e.errcode == ERR_OUT_OF_WINDOW and not WECHAT_PUSH_TEMPLATE_ID:
+            return 'unreachable'
+    except Exception as e:
+        print(f"[定时任务] 推送失败 {openid[:8]}...: {e}")
+    return 'failed'
+
+
+def _record_push_result(user: dict, result: str) -> bool:
+    """按一个用户的推送结果更新推送队列，返回是否推送成功"""
+    openid = user['openid']
+    if result == 'unsubscribed':
+        unsubscribe_user(openid)
+    elif result == 'unreachable':
+        suspend_push(openid)
+    elif result == 'deferred':
+        # 限流或熔断：保留当天的推送，冷却后再试
+        suspend_push(openid, time.time() + CIRCUIT_RESET_SECONDS)
+    else:
+        # 按计划推送时间所在的日期记录，跨零点的推送不会跳过次日；
+        # 失败也排到下一天，避免每次轮询重复失败
+        push_date = datetime.fromtimestamp(user['next_push_at']).strftime('%Y-%m-%d')
+        mark_user_pushed(openid, push_date)
+    return result == 'sent'
+
+
+def process_push_task(client, task: dict) -> int:
+    """
+    并行推送分区内已到期的一小批用户，每个用户发完立即更新推送队列，然后交还分区
+
+    发送期间每过租约的三分之一续约一次，整批耗时超过租约也不会被其他进程接手重复推送；
+    续约失败（已被其他进程接手）时取消还没开始的发送，已发完的照常记录。
+
+    Returns:
+        成功推送的用户数
+    """
+    holder = get_holder_id()
+    run_key = task['run_key']
+    partition_no = task['partition_no']
+    users = get_push_targets(partition_no, task['partitions'], time.time(), PUSH_BATCH_SIZE)
+    if not users:
+        release_push_task(run_key, partition_no, holder)
+        return 0
+
+    success_count = 0
+    held = True
+    renewed_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=PUSH_CONCURRENCY, thread_name_prefix=PUSH_THREAD_PREFIX) as pool:
+        futures = {pool.submit(_deliver_push, client, user): user for user in users}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            success_count += _record_push_result(futures[future], future.result())
+            if held and time.monotonic() - renewed_at >= PUSH_TASK_LEASE_SECONDS / 3:
+                held = renew_push_task(run_key, partition_no, holder, PUSH_TASK_LEASE_SECONDS)
+                renewed_at = time.monotonic()
+                if not held:
+                    for pending in futures:
+                        pending.cancel()
+
+    # 发送期间租约被其他进程接手时不交还，由接手方负责
+    if held and renew_push_task(run_key, partition_no, holder, PUSH_TASK_LEASE_SECONDS):
+        release_push_task(run_key, partition_no, holder)
+    else:
+        print(f"[定时任务] 分区 {partition_no} 已被其他进程接手")
+    print(f"[定时任务] 分区 {partition_no} 推送 {success_count}/{len(users)}")
+    return success_count
+
+
+def work_push_tasks(client=None) -> int:
+    """
+    领取并处理已到期的推送分区，直到没有到期的分区
+
+    Returns:
+        处理的分区批次数
+    """
+    holder = get_holder_id()
+    done = 0
+    try:
+        task = claim_push_task(holder, PUSH_TASK_LEASE_SECONDS)
+        if task and profiler.take_push_run():
+            # 剖析本次推送（领到分区时才占用名额，空轮询不算）
+            with profiler.profile('push', PUSH_THREAD_PREFIX):
+                done = _drain_push_tasks(client, holder, task)
+        elif task:
+            done = _drain_push_tasks(client, holder, task)
+    except Exception as e:
+        print(f"[定时任务] 处理推送分区失败: {e}")
+    return done
+
+
+def _drain_push_tasks(client, holder: str, task: dict) -> int:
+    """处理已领取的分区，并继续领取直到没有到期的分区，返回处理的批次数"""
+    done = 0
+    while task:
+        # 进程内共享的微信客户端
+        client = client or get_client()
+        process_push_task(client, task)
+        done += 1
+        task = claim_push_task(holder, PUSH_TASK_LEASE_SECONDS)
+    return done
+
 
 def send_daily_push():
-    """发送每日推送"""
+    """手动触发推送：确保分区任务存在，并在本进程内推送所有已到期的用户"""
     print(f"[定时任务] 开始发送每日推送...")
-    
+    plan_push_tasks(force=True)
+    done = work_push_tasks()
+    print(f"[定时任务] 本进程处理 {done} 个分区批次")
+
+
+def flush_family_digests(notify=None, window: float = None) -> int:
+    """
+    发送到期的家庭支出汇总（每个家庭一条，合计数据每次汇总只查一次）
+
+    Args:
+        notify: 发送函数 (openid, message)，默认发送客服消息
+        window: 合并窗口（秒），默认 FAMILY_DIGEST_SECONDS
+
+    Returns:
+        发出的通知条数
+    """
+    notify = notify or send_text
+    window = FAMILY_DIGEST_SECONDS if window is None else window
+    sent = 0
     try:
-        # 初始化微信客户端
-        client = WeChatClient(WECHAT_APP_ID, WECHAT_APP_SECRET)
-        
-        # 获取所有用户
-        users = get_all_users()
-        print(f"[定时任务] 共有 {len(users)} 个用户")
-        
-        success_count = 0
-        for openid in users:
-            try:
-                # 生成推送消息
-                message = get_daily_push_message(openid)
-                
-                # 发送客服消息
-                client.message.send_text(openid, message)
-                success_count += 1
-                print(f"[定时任务] 成功推送给用户: {openid[:8]}...")
-            except Exception as e:
-                print(f"[定时任务] 推送失败 {openid[:8]}...: {e}")
-        
-        print(f"[定时任务] 推送完成，成功 {success_count}/{len(users)}")
-        
+        for family_id in get_due_family_digests(time.time() - window):
+            items = take_family_notifications(family_id)
+            if not items:
+                continue
+            members = get_family_members_detail(family_id)
+            totals = {}
+            for openid in dict.fromkeys(item['openid'] for item in items):
+                totals[openid] = {
+                    'month_expense': get_month_summary(openid)['expense'],
+                    'daily_debt': get_daily_debt(openid)['daily_total'],
+                }
+            for member in members:
+                message = render_family_digest(items, members, totals, member['openid'])
+                if not message:
+                    continue
+                try:
+                    notify(member['openid'], message)
+                    sent += 1
+                except OutboundError as e:
+                    print(f"[通知失败] {member['openid'][:8]}...: {e}")
+    except Exception as e:
+        print(f"[定时任务] 发送家庭汇总失败: {e}")
+    return sent
+
+
+def flush_budget_alerts(notify=None) -> int:
+    """
+    发送待发的预算预警（取出时即标记已发送，发送失败不重试，避免重复提醒）
+
+    Args:
+        notify: 发送函数 (openid, message)，默认发送客服消息
+
+    Returns:
+        发出的通知条数
+    """
+    notify = notify or send_text
+    sent = 0
+    try:
+        for alert in take_budget_alerts():
+            if alert['scope'] == 'family':
+                members = get_family_members_detail(int(alert['scope_id']))
+                if not members:
+                    continue
+                family = get_user_family(members[0]['openid'])
+                message = render_budget_alert(alert, family['name'] if family else '')
+                recipients = [m['openid'] for m in members]
+            else:
+                message = render_budget_alert(alert)
+                recipients = [alert['scope_id']]
+            for openid in recipients:
+                try:
+                    notify(openid, message)
+                    sent += 1
+                except OutboundError as e:
+                    print(f"[通知失败] {openid[:8]}...: {e}")
+    except Exception as e:
+        print(f"[定时任务] 发送预算预警失败: {e}")
+    return sent
+
+
+def sweep_paid_off(notify=None) -> int:
+    """
+    停用到期的贷款/负债并通知本人（停用是逐条原子的，多个进程同时执行也只通知一次）
+
+    Args:
+        notify: 发送函数 (openid, message)，默认发送客服消息
+
+    Returns:
+        停用的记录数
+    """
+    notify = notify or send_text
+    try:
+        expired = expire_recurring_expenses()
     except Exception as e:
-        print(f"[定时任务] 发送失败: {e}")
+        print(f"[定时任务] 停用到期贷款失败: {e}")
+        return 0
+    for item in expired:
+        try:
+            notify(item['openid'], render_paid_off(item))
+        except OutboundError as e:
+            print(f"[通知失败] {item['openid'][:8]}...: {e}")
+    if expired:
+        print(f"[定时任务] {len(expired)} 笔贷款/负债到期已停用")
+    return len(expired)
+
+
+def bill_recurring() -> int:
+    """
+    把到还款日的固定开支/贷款写入账本（按 (分期, 月份) 认领，多个进程同时执行也只入账一次）
+
+    Returns:
+        入账的笔数
+    """
+    try:
+        posted = post_recurring_charges()
+    except Exception as e:
+        print(f"[定时任务] 固定开支入账失败: {e}")
+        return 0
+    if posted:
+        print(f"[定时任务] {len(posted)} 笔固定开支/贷款已入账")
+    return len(posted)
 
 
 def init_scheduler():
-    """初始化并启动调度器"""
+    """初始化并启动调度器（每个进程都可以调用，只有领导者会创建分区任务）"""
     global scheduler
-    
+
     if scheduler is not None:
         return scheduler
-    
+
     scheduler = BackgroundScheduler()
-    
-    # 添加每日推送任务
+
+    # 租约心跳，间隔取租约时长的三分之一
+    scheduler.add_job(
+        leader_heartbeat,
+        'interval',
+        seconds=max(1, SCHEDULER_LEASE_SECONDS // 3),
+        id='leader_heartbeat',
+        next_run_time=datetime.now(),
+        replace_existing=True
+    )
+
+    # 所有进程轮询领取已到期的推送分区
+    scheduler.add_job(
+        work_push_tasks,
+        'interval',
+        seconds=PUSH_POLL_SECONDS,
+        id='push_worker',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 所有进程轮询发送到期的家庭支出汇总（取出发件箱是原子的，不会重复发送）
+    scheduler.add_job(
+        flush_family_digests,
+        'interval',
+        seconds=max(1, min(PUSH_POLL_SECONDS, FAMILY_DIGEST_SECONDS)),
+        id='family_digest',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 启动时构建分类推断自动机，之后词典文件修改时重新加载
+    scheduler.add_job(
+        category_matcher.reload_if_changed,
+        'interval',
+        seconds=60,
+        id='category_keywords',
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 每天凌晨停用到期的贷款/负债（结束日期按 UTC 日期比较）
     scheduler.add_job(
-        send_daily_push,
+        sweep_paid_off,
         'cron',
-        hour=DAILY_PUSH_HOUR,
-        minute=DAILY_PUSH_MINUTE,
-        id='daily_push',
+        hour=0,
+        minute=10,
+        id='paid_off_sweep',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 每小时把到还款日的分期写入账本（启动时补上停机期间到期的）
+    scheduler.add_job(
+        bill_recurring,
+        'interval',
+        hours=1,
+        id='recurring_billing',
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 启动后执行待完成的迁移，失败或被中断时每小时重试（从中断处继续）
+    scheduler.add_job(
+        run_migrations,
+        'interval',
+        hours=1,
+        id='migrations',
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 数据库维护（SQLite 只在一台机器上，由本机的后台任务进程执行）：定时更新统计信息，
+    # 每天低峰期（推送时间之前）ANALYZE、分步回收空闲页、截断 WAL
+    scheduler.add_job(
+        maintenance.optimize,
+        'interval',
+        hours=MAINTENANCE_OPTIMIZE_HOURS,
+        id='db_optimize',
+        max_instances=1,
+        coalesce=True,
         replace_existing=True
     )
-    
+    scheduler.add_job(
+        maintenance.nightly,
+        'cron',
+        hour=MAINTENANCE_HOUR,
+        minute=30,
+        id='db_maintenance',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 每天低峰期在线备份（SQLite）
+    scheduler.add_job(
+        backup.backup_databases,
+        'cron',
+        hour=BACKUP_HOUR,
+        minute=0,
+        id='db_backup',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
+    # 所有进程轮询发送预算预警
+    scheduler.add_job(
+        flush_budget_alerts,
+        'interval',
+        seconds=PUSH_POLL_SECONDS,
+        id='budget_alerts',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
     scheduler.start()
-    print(f"[调度器] 已启动，每日 {DAILY_PUSH_HOUR:02d}:{DAILY_PUSH_MINUTE:02d} 推送")
-    
+    print(f"[调度器] 已启动（{get_holder_id()}），每 {PUSH_POLL_SECONDS} 秒检查到期推送")
+
     return scheduler
 
 
 def shutdown_scheduler():
-    """关闭调度器"""
-    global scheduler
+    """关闭调度器并释放领导者租约"""
+    global scheduler, is_leader
     if scheduler:
         scheduler.shutdown()
         scheduler = None
+        if is_leader:
+            try:
+                release_lease(LEADER_LEASE, get_holder_id())
+            except Exception as e:
+                print(f"[调度器] 释放租约失败: {e}")
+            is_leader = False
         print("[调度器] 已关闭")
 
 
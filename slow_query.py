@@ -0,0 +1,160 @@
+"""
+慢查询日志模块（SQLite）
+
+database.get_connection 建立的连接使用本模块的 Connection / Cursor，每条语句计时：
+- 执行（execute / executemany，含 SQLite 计算聚合、排序和返回第一行）超过 SLOW_QUERY_MS 毫秒时记录
+- 记录内容：语句、参数形状（各参数的类型，不记录值）、调用它的 database.py 函数、
+  虚拟机执行步数（进度回调每 PROGRESS_STEPS 条指令计一次）
+- 每条不同的语句只在第一次变慢时执行一次 EXPLAIN QUERY PLAN 并打印，之后只累计次数和耗时；
+  执行出错的语句不取执行计划（留到之后成功执行又变慢时），没有参数行的 executemany 不记录
+- top(n) 返回本进程累计耗时最多的慢语句，供 /admin/slow-queries 查看
+
+统计在进程内，gunicorn 多个 worker 各自统计。PostgreSQL 请使用 log_min_duration_statement / pg_stat_statements。
+"""
+
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from config import SLOW_QUERY_MS
+
+
+# 进度回调的间隔（虚拟机指令数），回调里只做计数
+PROGRESS_STEPS = 1000
+
+# 慢语句统计 {规范化语句: 统计}，以及已经取过执行计划的语句
+_stats = {}
+_stats_lock = threading.Lock()
+
+DATABASE_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.py')
+
+
+def normalize(sql: str) -> str:
+    """合并空白，作为同一条语句的键"""
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def param_shape(params, many: bool = False) -> str:
+    """参数形状：各参数的类型名，executemany 时附带行数"""
+    if many:
+        rows = params if isinstance(params, (list, tuple)) else list(params)
+        return f'{len(rows)} 行 × {param_shape(rows[0]) if rows else "()"}'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in params.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in (params or ())) + ')'
+
+
+def _caller() -> str:
+    """调用栈中最近的 database.py 函数"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_filename == DATABASE_MODULE:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return '?'
+
+
+def _explain(conn, sql: str, params) -> list:
+    """EXPLAIN QUERY PLAN 的输出（每行一个步骤）"""
+    try:
+        rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', params or ()).fetchall()
+    except sqlite3.Error as e:
+        return [f'无法获取执行计划: {e}']
+    return [row[3] for row in rows]
+
+
+def _record(conn, sql: str, params, many: bool, elapsed_ms: float, steps: int, failed: bool = False):
+    key = normalize(sql)
+    caller = _caller()
+    with _stats_lock:
+        entry = _stats.get(key)
+        first = entry is None
+        if first:
+            entry = _stats[key] = {
+                'sql': key, 'function': caller, 'params': param_shape(params, many),
+                'plan': None, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'steps': 0,
+            }
+        entry['count'] += 1
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+        entry['steps'] = max(entry['steps'], steps)
+        explain = entry['plan'] is None and not failed
+    status = '（执行出错）' if failed else ''
+    if first or explain:
+        print(f"[慢查询] {caller} 耗时 {elapsed_ms:.1f}ms{status} 参数 {entry['params']}: {key[:200]}")
+    else:
+        print(f"[慢查询] {caller} 耗时 {elapsed_ms:.1f}ms{status}（第 {entry['count']} 次）: {key[:80]}")
+    if explain:
+        entry['plan'] = _explain(conn, sql, params[0] if many else params)
+        for step in entry['plan']:
+            print(f"[慢查询]   {step}")
+
+
+class Cursor(sqlite3.Cursor):
+    """计时的游标"""
+
+    def execute(self, sql, params=()):
+        return self.connection._timed(super().execute, sql, params, False)
+
+    def executemany(self, sql, params):
+        if not isinstance(params, (list, tuple)):
+            params = list(params)
+        return self.connection._timed(super().executemany, sql, params, True)
+
+
+class Connection(sqlite3.Connection):
+    """默认使用计时游标的连接（sqlite3.connect(path, factory=Connection)）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._steps = 0
+        self.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+    def _progress(self):
+        self._steps += 1
+        return 0
+
+    def _timed(self, run, sql, params, many):
+        self._steps = 0
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = run(sql, params)
+            failed = False
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            # 没有参数行的 executemany 什么也没执行
+            if elapsed_ms >= SLOW_QUERY_MS and not (many and not params):
+                _record(self, sql, params, many, elapsed_ms, self._steps * PROGRESS_STEPS, failed)
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+
+def top(n: int = 20) -> list:
+    """
+    本进程累计耗时最多的慢语句
+
+    Returns:
+        [{'sql', 'function', 'params', 'plan', 'count', 'total_ms', 'max_ms', 'avg_ms', 'steps'}]
+    """
+    with _stats_lock:
+        entries = sorted(_stats.values(), key=lambda e: e['total_ms'], reverse=True)[:n]
+        return [dict(e, total_ms=round(e['total_ms'], 1), max_ms=round(e['max_ms'], 1),
+                     avg_ms=round(e['total_ms'] / e['count'], 1)) for e in entries]
+
+
+def reset():
+    """清空统计"""
+    with _stats_lock:
+        _stats.clear()
@@ -6,6 +6,7 @@ Run this script to verify core logic
 import os
 import sys
 import io
+from datetime import datetime
 
 # Fix Windows console encoding
 if sys.platform == 'win32':
@@ -20,16 +21,26 @@ if not os.path.exists('data'):
     os.makedirs('data')
 
 # Override config
+import shutil
 import config
 config.DATABASE_PATH = 'data/test_expense.db'
+config.JOURNAL_DIR = 'data/test_journal'
 
 # Remove old test database
 if os.path.exists('data/test_expense.db'):
     os.remove('data/test_expense.db')
+shutil.rmtree('data/test_journal', ignore_errors=True)
 
 import database
+import repository
 import wechat_handler
 
+# Run the same suite against PostgreSQL:
+#   DATABASE_BACKEND=postgres DATABASE_URL=postgresql://... python test_logic.py
+if config.DATABASE_BACKEND == 'postgres':
+    import database_pg
+    database_pg.drop_tables()
+
 def print_result(test_name, passed, details=""):
     status = "[PASS]" if passed else "[FAIL]"
     print(f"{status} {test_name}")
@@ -42,7 +53,7 @@ def run_tests():
     print("=" * 50)
     
     # Initialize database
-    database.init_db()
+    repository.init_db()
     print("\nDatabase initialized\n")
     
     passed = 0
@@ -50,9 +61,8 @@ def run_tests():
     
     # ===== Test 1: User Creation =====
     try:
-        database.add_user('test_user', 'TestUser')
-        with database.get_connection() as conn:
-            user = conn.cursor().execute('SELECT * FROM users WHERE openid="test_user"').fetchone()
+        repository.add_user('test_user', 'TestUser')
+        user = repository.get_user('test_user')
         if user and user['nickname'] == 'TestUser':
             print_result("User Creation", True)
             passed += 1
@@ -106,7 +116,7 @@ def run_tests():
     
     # ===== Test 5: Debt Summary =====
     try:
-        debt = database.get_daily_debt('test_user')
+        debt = repository.get_daily_debt('test_user')
         # 10000 + 300 + 1000 = 11300/month
         expected_monthly = 10000 + 300 + 1000
         if debt['monthly_total'] == expected_monthly:
@@ -137,10 +147,10 @@ def run_tests():
     
     # ===== Test 7: Join Family =====
     try:
-        family = database.get_user_family('test_user')
+        family = repository.get_user_family('test_user')
         if family:
             invite_code = family['invite_code']
-            database.add_user('spouse', 'Spouse')
+            repository.add_user('spouse', 'Spouse')
             resp = wechat_handler.parse_message('spouse', f'加入家庭 {invite_code}')
             if '成功加入' in resp:
                 print_result("Join Family", True)
@@ -184,17 +194,23 @@ def run_tests():
         print_result("Family Debt Ranking", False, str(e))
         failed += 1
     
-    # ===== Test 10: Family Notification (Mock) =====
+    # ===== Test 10: Family Notification Digest (Mock) =====
     try:
+        import scheduler
         notifications = []
         def mock_notify(target_openid, message):
             notifications.append((target_openid, message))
         
-        wechat_handler.parse_message('test_user', '支出 88 购物 测试物品', notify_callback=mock_notify)
+        wechat_handler.parse_message('test_user', '支出 88 购物 测试物品')
+        wechat_handler.parse_message('test_user', '支出 12 餐饮 奶茶')
+        # 合并窗口未到时不发送
+        early = scheduler.flush_family_digests(mock_notify)
+        scheduler.flush_family_digests(mock_notify, window=0)
+        again = scheduler.flush_family_digests(mock_notify, window=0)
         
-        if len(notifications) == 1 and notifications[0][0] == 'spouse':
+        if early == 0 and again == 0 and len(notifications) == 1 and notifications[0][0] == 'spouse':
             msg = notifications[0][1]
-            if '家庭支出提醒' in msg and '88.00' in msg:
+            if '家庭支出提醒' in msg and '88.00' in msg and '12.00' in msg and '共 2 笔' in msg:
                 print_result("Family Expense Notification", True)
                 passed += 1
             else:
@@ -238,6 +254,1132 @@ def run_tests():
         print_result("Help Message", False, str(e))
         failed += 1
     
+    # ===== Test 13: Keyword Search (FTS) =====
+    try:
+        wechat_handler.parse_message('test_user', '支出 35 餐饮 星巴克拿铁')
+        wechat_handler.parse_message('test_user', '支出 28 星巴克')
+        wechat_handler.parse_message('test_user', '支出 15 餐饮 瑞幸')
+        result = repository.search_expenses('test_user', '星巴克')
+        single = repository.search_expenses('test_user', '拿')
+        resp = wechat_handler.parse_message('test_user', '搜索 星巴克 30')
+        if (result['count'] == 2 and result['expense'] == 63 and single['count'] == 1
+                and '2 笔' in resp and '63.00' in resp):
+            print_result("Keyword Search (FTS)", True)
+            passed += 1
+        else:
+            print_result("Keyword Search (FTS)", False, f"Result: {result}, Response: {resp[:80]}")
+            failed += 1
+    except Exception as e:
+        print_result("Keyword Search (FTS)", False, str(e))
+        failed += 1
+    
+    # ===== Test 14: Category Aliases and Merge =====
+    try:
+        wechat_handler.parse_message('cat_user', '支出 20 午饭')
+        wechat_handler.parse_message('cat_user', '支出 30 餐饮')
+        wechat_handler.parse_message('cat_user', '支出 40 奶茶')
+        wechat_handler.parse_message('cat_user', '合并分类 奶茶 餐饮')
+        resp = wechat_handler.parse_message('cat_user', '支出 12 奶茶')
+        stats = repository.get_category_stats('cat_user')
+        # 回滚的事务中新建的分类不能留在进程缓存里
+        store = database_pg if config.DATABASE_BACKEND == 'postgres' else database
+        with store.get_connection() as conn:
+            cursor = database_pg._cursor(conn) if store is not database else conn.cursor()
+            store._intern_category(cursor, '回滚分类')
+            conn.rollback()
+        # 原分类写错时不新建分类；迁移记录失败后重试仍能把记录迁走
+        missing = wechat_handler.parse_message('cat_user', '合并分类 奶茶茶 餐饮')
+        wechat_handler.parse_message('cat_retry', '支出 8 乐高')
+        wechat_handler.parse_message('cat_retry', '支出 9 收藏品')
+        if store is database:
+            def broken_index(*args):
+                raise RuntimeError('分库写入失败')
+            index_expense, database._index_expense = database._index_expense, broken_index
+            try:
+                wechat_handler.parse_message('cat_retry', '合并分类 乐高 收藏品')
+            except RuntimeError:
+                pass
+            finally:
+                database._index_expense = index_expense
+        retried = wechat_handler.parse_message('cat_retry', '合并分类 乐高 收藏品')
+        retry_stats = repository.get_category_stats('cat_retry')
+        if (len(stats['categories']) == 1 and stats['categories'][0]['category'] == '餐饮'
+                and stats['total'] == 102 and '分类：餐饮' in resp
+                and '回滚分类' not in store._category_ids
+                and '未找到分类' in missing and '奶茶茶' not in store._category_ids
+                and '迁移记录：1 笔' in retried
+                and [c['category'] for c in retry_stats['categories']] == ['收藏品']):
+            print_result("Category Aliases and Merge", True)
+            passed += 1
+        else:
+            print_result("Category Aliases and Merge", False,
+                         f"Stats: {stats}, Missing: {missing}, Retried: {retried}, RetryStats: {retry_stats}")
+            failed += 1
+    except Exception as e:
+        print_result("Category Aliases and Merge", False, str(e))
+        failed += 1
+    
+    # ===== Test 15: Sharded Storage and Reshard (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Sharded Storage and Reshard")
+    else:
+        try:
+            import reshard
+            database.DATABASE_SHARDS = 4
+            database.init_db()
+            # 找两个落在不同分库的用户组成家庭
+            owners = ['shard_a']
+            while database.get_shard_index(owners[-1]) == database.get_shard_index(owners[0]):
+                owners.append(f'shard_{len(owners)}')
+            owner_a, owner_b = owners[0], owners[-1]
+            for openid in (owner_a, owner_b):
+                database.add_user(openid)
+            code = database.create_family(owner_a, 'ShardFamily')
+            database.join_family(owner_b, code)
+            family_id = database.get_user_family(owner_a)['id']
+            database.add_recurring_expense(owner_a, 'loan', 'LoanA', monthly_amount=3000)
+            database.add_recurring_expense(owner_b, 'fixed', 'FixedB', monthly_amount=600)
+            database.add_expense(owner_b, 'expense', 50, '餐饮', '星巴克')
+        
+            sharded = database.get_family_daily_debt(family_id)['monthly_total']
+            reshard.reshard_database(2, 4)
+            database.DATABASE_SHARDS = 2
+            resharded = database.get_family_daily_debt(family_id)['monthly_total']
+            found = database.search_expenses(owner_b, '星巴克')['count']
+            if sharded == 3600 and resharded == 3600 and found == 1:
+                print_result("Sharded Storage and Reshard", True)
+                passed += 1
+            else:
+                print_result("Sharded Storage and Reshard", False, f"Before={sharded}, After={resharded}, Search={found}")
+                failed += 1
+            reshard.reshard_database(1, 2)
+        except Exception as e:
+            print_result("Sharded Storage and Reshard", False, str(e))
+            failed += 1
+        finally:
+            database.DATABASE_SHARDS = 1
+    
+    # ===== Test 16: Leader Lease and Partitioned Push =====
+    import time as time_module
+    real_time = time_module.time
+    try:
+        import scheduler
+        first = repository.acquire_lease('test_leader', 'host_a', 60)
+        blocked = not repository.acquire_lease('test_leader', 'host_b', 60)
+        # 租约过期后其他进程可以接手
+        repository.acquire_lease('test_leader', 'host_a', -1)
+        taken = repository.acquire_lease('test_leader', 'host_b', 60)
+        
+        # 所有用户改为 00:00 推送，再把时钟拨到次日 00:05，每人恰好到期一次
+        users = repository.get_all_users()
+        due = [repository.set_push_time(openid, '00:00') for openid in users]
+        time_module.time = lambda: max(due) + 240
+        
+        # 模拟进程领取分区后宕机：租约过期后分区被其他进程重新领取
+        run_key = scheduler.get_push_run_key()
+        repository.create_push_tasks(run_key, 4)
+        repository.create_push_tasks(run_key, 4)
+        dead = repository.claim_push_task('dead_worker', -1)
+        
+        class MockMessage:
+            def __init__(self):
+                self.sent = []
+            def send_text(self, openid, content):
+                self.sent.append(openid)
+        class MockClient:
+            message = MockMessage()
+        client = MockClient()
+        done = scheduler.work_push_tasks(client)
+        sent = client.message.sent
+        remaining = repository.get_push_targets(0, 1, time_module.time())
+        if (first and blocked and taken and dead and done >= 4
+                and sorted(sent) == sorted(users) and not remaining):
+            print_result("Leader Lease and Partitioned Push", True)
+            passed += 1
+        else:
+            print_result("Leader Lease and Partitioned Push", False,
+                         f"Lease={first, blocked, taken}, Done={done}, Sent={len(sent)}/{len(users)}")
+            failed += 1
+    except Exception as e:
+        print_result("Leader Lease and Partitioned Push", False, str(e))
+        failed += 1
+    finally:
+        time_module.time = real_time
+    
+    # ===== Test 17: Per-user Push Time =====
+    try:
+        resp = wechat_handler.parse_message('push_user', '推送 7:30')
+        custom = repository.get_user('push_user')
+        bad = wechat_handler.parse_message('push_user', '推送 25:00')
+        wechat_handler.parse_message('push_user', '推送 关闭')
+        off = repository.get_user('push_user')
+        wechat_handler.parse_message('push_user', '推送 默认')
+        default = repository.get_user('push_user')
+        due_at = datetime.fromtimestamp(custom['next_push_at'])
+        if (custom['push_time'] == '07:30' and (due_at.hour, due_at.minute) == (7, 30)
+                and '❌' in bad and not off['push_enabled'] and off['next_push_at'] is None
+                and default['push_time'] is None and default['next_push_at']):
+            print_result("Per-user Push Time", True)
+            passed += 1
+        else:
+            print_result("Per-user Push Time", False, f"Response: {resp[:80]}, User: {custom}")
+            failed += 1
+    except Exception as e:
+        print_result("Per-user Push Time", False, str(e))
+        failed += 1
+    
+    # ===== Test 18: Subscription and Interaction Window =====
+    try:
+        import scheduler
+        repository.record_interaction('reach_a')
+        repository.record_interaction('reach_b')
+        repository.record_interaction('reach_c')
+        repository.unsubscribe_user('reach_c')
+        listed = repository.get_all_users()
+        due = [repository.set_push_time(openid, '00:00') for openid in ('reach_a', 'reach_b', 'reach_c')]
+        
+        # 三天后只有 reach_a 再次互动过，reach_b 已超出 48 小时窗口
+        time_module.time = lambda: max(d for d in due if d) + 3 * 86400
+        repository.record_interaction('reach_a')
+        
+        class MockMessage:
+            def __init__(self):
+                self.sent = []
+            def send_text(self, openid, content):
+                self.sent.append(openid)
+        class MockClient:
+            message = MockMessage()
+        client = MockClient()
+        scheduler.work_push_tasks(client)
+        sent = client.message.sent
+        parked = repository.get_user('reach_b')
+        # 再次互动后重新排入推送队列
+        repository.record_interaction('reach_b')
+        requeued = repository.get_user('reach_b')
+        if ('reach_c' not in listed and 'reach_a' in listed and due[2] is None
+                and 'reach_a' in sent and 'reach_b' not in sent and 'reach_c' not in sent
+                and parked['next_push_at'] is None and requeued['next_push_at']):
+            print_result("Subscription and Interaction Window", True)
+            passed += 1
+        else:
+            print_result("Subscription and Interaction Window", False, f"Sent={sent}, Parked={parked}")
+            failed += 1
+    except Exception as e:
+        print_result("Subscription and Interaction Window", False, str(e))
+        failed += 1
+    finally:
+        time_module.time = real_time
+    
+    # ===== Test 19: Push Channels =====
+    try:
+        import push_channels
+        data = wechat_handler.get_daily_push_data('test_user')
+        fields = push_channels.build_template_data(
+            data, {'first': 'date', 'keyword1': 'daily_debt', 'remark': 'message'})
+        now = real_time()
+        push_channels.WECHAT_PUSH_TEMPLATE_ID = ''
+        no_template = push_channels.pick_channel({'last_interaction_at': now - 3 * 86400}, now)
+        push_channels.WECHAT_PUSH_TEMPLATE_ID = 'tpl'
+        channels = (push_channels.pick_channel({'last_interaction_at': now - 3600}, now),
+                    push_channels.pick_channel({'last_interaction_at': now - 3 * 86400}, now),
+                    push_channels.pick_channel({'last_interaction_at': None}, now))
+        push_channels.WECHAT_PUSH_TEMPLATE_ID = config.WECHAT_PUSH_TEMPLATE_ID
+        if (no_template is None and channels == ('text', 'template', 'text')
+                and fields['keyword1']['value'] == f"{data['daily_debt']:,.2f}"
+                and fields['remark']['value'] == wechat_handler.get_daily_push_message('test_user')):
+            print_result("Push Channels", True)
+            passed += 1
+        else:
+            print_result("Push Channels", False, f"Channels={no_template, channels}, Fields={fields}")
+            failed += 1
+    except Exception as e:
+        print_result("Push Channels", False, str(e))
+        failed += 1
+    
+    # ===== Test 20: Outbound Retry and Circuit Breaker =====
+    try:
+        import wechat_client
+        from wechatpy.exceptions import WeChatClientException
+        wechat_client.OUTBOUND_BACKOFF_BASE = 0
+        
+        class FlakyClient:
+            access_token_key = 'token'
+            def __init__(self, errors):
+                self.errors = list(errors)
+                self.calls = 0
+                self.refreshed = 0
+                self.session = self
+                self.message = self
+            def delete(self, key):
+                pass
+            def fetch_access_token(self):
+                self.refreshed += 1
+            def send_text(self, openid, content):
+                self.calls += 1
+                if self.errors:
+                    raise WeChatClientException(self.errors.pop(0), 'mock')
+                return {'errcode': 0}
+        
+        wechat_client.reset_circuit()
+        token = FlakyClient([42001])
+        wechat_client.send_text('u', 'hi', token)
+        busy = FlakyClient([-1, 45009])
+        wechat_client.send_text('u', 'hi', busy)
+        try:
+            wechat_client.send_text('u', 'hi', FlakyClient([43004]))
+            unreachable = None
+        except wechat_client.OutboundError as e:
+            unreachable = e.kind
+        # 上游持续故障：达到阈值后熔断，后续请求不再调用接口
+        down = FlakyClient([-1] * 100)
+        for _ in range(3):
+            try:
+                wechat_client.send_text('u', 'hi', down)
+            except wechat_client.OutboundError:
+                pass
+        calls_before = down.calls
+        try:
+            wechat_client.send_text('u', 'hi', down)
+            fast_fail = None
+        except wechat_client.OutboundError as e:
+            fast_fail = e.kind
+        state = wechat_client.get_circuit_state()
+        wechat_client.reset_circuit()
+        if (token.refreshed == 1 and token.calls == 2 and busy.calls == 3
+                and unreachable == wechat_client.UNREACHABLE and fast_fail == wechat_client.CIRCUIT_OPEN
+                and down.calls == calls_before and state == 'open'):
+            print_result("Outbound Retry and Circuit Breaker", True)
+            passed += 1
+        else:
+            print_result("Outbound Retry and Circuit Breaker", False,
+                         f"Token={token.calls, token.refreshed}, Busy={busy.calls}, Kinds={unreachable, fast_fail}, State={state}")
+            failed += 1
+    except Exception as e:
+        print_result("Outbound Retry and Circuit Breaker", False, str(e))
+        failed += 1
+    
+    # ===== Test 21: Running Month Total and Budget Alerts =====
+    try:
+        import scheduler
+        wechat_handler.parse_message('budget_a', '创建家庭 预算家')
+        code = repository.get_user_family('budget_a')['invite_code']
+        wechat_handler.parse_message('budget_b', f'加入家庭 {code}')
+        wechat_handler.parse_message('budget_a', '预算 100')
+        denied = wechat_handler.parse_message('budget_b', '家庭预算 200')
+        wechat_handler.parse_message('budget_a', '家庭预算 200')
+        # 个人：85 跨过 80%，105 跨过 100%；家庭：165 跨过 80%
+        for openid, amount in [('budget_a', 50), ('budget_a', 35), ('budget_b', 20),
+                               ('budget_a', 20), ('budget_b', 60), ('budget_a', 5)]:
+            wechat_handler.parse_message(openid, f'支出 {amount} 餐饮')
+        wechat_handler.parse_message('budget_a', '收入 1000 工资')
+        alerts = []
+        sent = scheduler.flush_budget_alerts(lambda openid, message: alerts.append((openid, message)))
+        again = scheduler.flush_budget_alerts(lambda openid, message: alerts.append((openid, message)))
+        personal = repository.get_budget('budget_a')
+        family = repository.get_family_budget(repository.get_user_family('budget_a')['id'])
+        resp = wechat_handler.parse_message('budget_b', '家庭预算')
+        # 服务器本地时间已到下个月、账本时钟（UTC）还在本月：这一笔要计入账本时钟的本月
+        repository.add_expense('budget_c', 'expense', 10, '餐饮')
+        import datetime as dt
+        store = database_pg if config.DATABASE_BACKEND == 'postgres' else database
+        class NextMonthDate(dt.date):
+            @classmethod
+            def today(cls):
+                return (dt.date.today().replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+        store.date = NextMonthDate
+        try:
+            repository.add_expense('budget_c', 'expense', 35, '餐饮')
+        finally:
+            store.date = dt.date
+        crossed = (repository.get_budget('budget_c')['spent'], repository.get_month_summary('budget_c')['expense'],
+                   repository.get_month_activity('budget_c')['entries'])
+        recipients = sorted(openid for openid, _ in alerts)
+        if (sent == 4 and again == 0 and '创建者' in denied
+                and recipients == ['budget_a', 'budget_a', 'budget_a', 'budget_b']
+                and sum('超出预算' in message for _, message in alerts) == 1
+                and personal['spent'] == 110 and family['spent'] == 190
+                and family['percent'] == 95 and '预算家' in resp and '190' in resp
+                and crossed == (45, 45, 2)):
+            print_result("Running Month Total and Budget Alerts", True)
+            passed += 1
+        else:
+            print_result("Running Month Total and Budget Alerts", False,
+                         f"Sent={sent, again}, Alerts={recipients}, Personal={personal}, Family={family}, "
+                         f"Crossed={crossed}")
+            failed += 1
+    except Exception as e:
+        print_result("Running Month Total and Budget Alerts", False, str(e))
+        failed += 1
+    
+    # ===== Test 22: Multi-entry Messages =====
+    try:
+        import scheduler
+        wechat_handler.parse_message('batch_a', '创建家庭 批量家')
+        code = repository.get_user_family('batch_a')['invite_code']
+        wechat_handler.parse_message('batch_b', f'加入家庭 {code}')
+        rejected = wechat_handler.parse_message('batch_a', '支出 12 早餐\n支出 abc 午餐')
+        empty = repository.get_budget('batch_a')['spent']
+        # 备注、家庭名中的分号不拆成多笔
+        single = wechat_handler.parse_message('batch_c', '支出 35 餐饮 午饭;和同事')
+        single_rows = repository.search_expenses('batch_c', '和同事')['count']
+        family_resp = wechat_handler.parse_message('batch_c', '创建家庭 我家;小家')
+        family_name = (repository.get_user_family('batch_c') or {}).get('name')
+        resp = wechat_handler.parse_message('batch_a', '支出 12 早饭\n支出 35 餐饮 午餐；收入 100 红包')
+        notifications = []
+        scheduler.flush_family_digests(lambda openid, message: notifications.append((openid, message)), window=0)
+        notifications = [n for n in notifications if n[0].startswith('batch_')]
+        spent = repository.get_budget('batch_a')['spent']
+        found = repository.search_expenses('batch_a', '午餐')['count']
+        if ('未记录' in rejected and empty == 0 and '已记录 3 笔' in resp and '47.00' in resp
+                and '已记录支出 35' in single and single_rows == 1 and family_name == '我家;小家'
+                and '100.00' in resp and spent == 47 and found == 1
+                and len(notifications) == 1 and notifications[0][0] == 'batch_b'
+                and '共 2 笔' in notifications[0][1]):
+            print_result("Multi-entry Messages", True)
+            passed += 1
+        else:
+            print_result("Multi-entry Messages", False,
+                         f"Response: {resp[:80]}, Spent={empty, spent}, Found={found}, Notifications={len(notifications)}, "
+                         f"Single={single_rows}, Family={family_name, family_resp[:40]}")
+            failed += 1
+    except Exception as e:
+        print_result("Multi-entry Messages", False, str(e))
+        failed += 1
+    
+    # ===== Test 23: Category Inference =====
+    try:
+        import json
+        import tempfile
+        import time as time_module
+        import category_matcher
+        merchant = wechat_handler.parse_message('infer_user', '支出 35 星巴克拿铁')
+        ride = wechat_handler.parse_message('infer_user', '支出 18 滴滴快车')
+        wechat_handler.parse_message('infer_user', '支出 30 宠物 猫粮')
+        learned = wechat_handler.parse_message('infer_user', '支出 25 猫粮罐头')
+        unknown = wechat_handler.parse_message('infer_user', '支出 9')
+        stats = {c['category']: c['total'] for c in repository.get_category_stats('infer_user')['categories']}
+        # 词典文件可热加载；数万关键词时单次推断仍在毫秒以内
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as f:
+            json.dump({'宠物用品': ['狗粮'] + [f'商户{i}' for i in range(20000)]}, f, ensure_ascii=False)
+        category_matcher.reload_keywords(f.name)
+        reloaded = category_matcher.infer_category('超市买狗粮')
+        start = time_module.perf_counter()
+        for i in range(1000):
+            category_matcher.infer_category(f'周末在商户{i}买了点东西')
+        per_call = (time_module.perf_counter() - start) / 1000
+        os.remove(f.name)
+        category_matcher.reload_keywords()
+        if ('分类：餐饮' in merchant and '备注：星巴克拿铁' in merchant and '分类：交通' in ride
+                and '分类：宠物' in learned and '分类：其他' in unknown
+                and stats == {'餐饮': 35, '交通': 18, '宠物': 55, '其他': 9}
+                and reloaded == '宠物用品' and per_call < 0.001):
+            print_result("Category Inference", True)
+            passed += 1
+        else:
+            print_result("Category Inference", False,
+                         f"Stats={stats}, Reloaded={reloaded}, PerCall={per_call:.6f}, Response: {learned[:60]}")
+            failed += 1
+    except Exception as e:
+        print_result("Category Inference", False, str(e))
+        failed += 1
+    
+    # ===== Test 24: Mutation Journal Replay (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Mutation Journal Replay")
+    else:
+        try:
+            import journal
+            # 派生数据：从日志回放每位用户的记账合计与固定开支数量
+            derived = {}
+            def apply(op, values, ts):
+                if op == 'add_expense':
+                    derived[values[1]] = derived.get(values[1], 0) + values[3]
+                elif op == 'add_recurring_expense':
+                    derived[('recurring', values[1])] = derived.get(('recurring', values[1]), 0) + 1
+            journal.save_checkpoint('test_rollup', journal.end_position())
+            journal.JOURNAL_SEGMENT_BYTES = 200  # 小分段，验证跨分段回放
+            wechat_handler.parse_message('journal_user', '支出 12 早餐\n支出 30.5 午餐')
+            wechat_handler.parse_message('journal_user', '固定 物业 300')
+            first = journal.catch_up('test_rollup', apply)
+            wechat_handler.parse_message('journal_user', '支出 7.5 餐饮')
+            second = journal.catch_up('test_rollup', apply)
+            third = journal.catch_up('test_rollup', apply)
+            # 互动创建的用户、取消关注后重新关注、学习的别名、新建的分类也要记入日志
+            database.record_interaction('journal_visitor')
+            database.unsubscribe_user('journal_visitor')
+            database.record_interaction('journal_visitor')
+            wechat_handler.parse_message('journal_user', '支出 6 日志分类 煎饼')
+            segments = len(journal.list_segments())
+            journal.JOURNAL_SEGMENT_BYTES = config.JOURNAL_SEGMENT_BYTES
+            records = [(op, values) for _, _, op, values in journal.replay()]
+            ops = [op for op, values in records if values and 'journal_user' in values]
+            category_id = database._category_ids.get('日志分类')
+            if (derived == {'journal_user': 50, ('recurring', 'journal_user'): 1}
+                    and second == 1 and third == 0 and first >= 3 and segments > 1
+                    and ops[:1] == ['add_user'] and ops.count('add_expense') == 4
+                    and ('add_user', ('journal_visitor', None)) in records
+                    and [op for op, values in records if values == ('journal_visitor',)][-2:]
+                    == ['unsubscribe_user', 'resubscribe_user']
+                    and ('add_category', (category_id, '日志分类')) in records
+                    and ('learn_alias', ('journal_user', '煎饼', category_id)) in records):
+                print_result("Mutation Journal Replay", True)
+                passed += 1
+            else:
+                print_result("Mutation Journal Replay", False,
+                             f"Derived={derived}, Counts={first, second, third}, Segments={segments}, Ops={ops}")
+                failed += 1
+        except Exception as e:
+            print_result("Mutation Journal Replay", False, str(e))
+            failed += 1
+    
+    # ===== Test 25: Hot Cache Matches SQL (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Hot Cache Matches SQL")
+    else:
+        try:
+            import hot_cache
+            def snapshot(openid):
+                today = database.get_today_summary(openid)
+                return (
+                    today['income'], today['expense'], today['recurring'],
+                    sorted((r['type'], r['amount'], r['category'], r['description'] or '', r['created_at'])
+                           for r in today['records']),
+                    database.get_month_summary(openid),
+                    sorted((r['id'], r['category'], r['amount'], r['date'], r['time'])
+                           for r in database.get_expense_history(openid, 30)),
+                    database.get_category_stats(openid, 30),
+                )
+            wechat_handler.parse_message('hot_user', '支出 12.3 早餐\n支出 30 星巴克拿铁\n收入 500 奖金\n支出 8 零嘴')
+            sql_before = snapshot('hot_user')
+            hot_cache.HOT_CACHE_ENABLED = True
+            cached_before = snapshot('hot_user')
+            # 缓存后的写入和合并分类通过变更日志同步进来
+            wechat_handler.parse_message('hot_user', '支出 6.6 地铁')
+            wechat_handler.parse_message('hot_user', '合并分类 零嘴 餐饮')
+            cached_after = snapshot('hot_user')
+            hot_cache.HOT_CACHE_ENABLED = False
+            sql_mid = snapshot('hot_user')
+            hot_cache.HOT_CACHE_ENABLED = True
+            # 本进程写日志失败：丢弃缓存，重新从数据库加载
+            real_write = journal._write
+            def broken_write(data):
+                raise OSError('disk full')
+            journal._write = broken_write
+            try:
+                wechat_handler.parse_message('hot_user', '支出 2 口香糖')
+            finally:
+                journal._write = real_write
+            cached_failed = snapshot('hot_user')
+            # 回放不到的写入（如其他进程写日志失败）：超过 TTL 后重新加载
+            journal.JOURNAL_ENABLED = False
+            try:
+                database.add_expense('hot_user', 'income', 1, '其他', '漏记')
+            finally:
+                journal.JOURNAL_ENABLED = config.JOURNAL_ENABLED
+            cached_stale = snapshot('hot_user')
+            hot_cache.HOT_CACHE_TTL_SECONDS = 0
+            cached_reloaded = snapshot('hot_user')
+            hot_cache.HOT_CACHE_TTL_SECONDS = config.HOT_CACHE_TTL_SECONDS
+            hot_cache.HOT_CACHE_ENABLED = False
+            sql_after = snapshot('hot_user')
+            # 内存上限很小时按 LRU 淘汰
+            hot_cache.HOT_CACHE_ENABLED = True
+            hot_cache.HOT_CACHE_MAX_BYTES = 3 * hot_cache.ENTRY_BYTES
+            for i in range(5):
+                database.add_expense(f'hot_lru_{i}', 'expense', 10 + i, '餐饮', None)
+                database.get_month_summary(f'hot_lru_{i}')
+            database.get_month_summary('hot_lru_4')
+            cache_stats = hot_cache.stats()
+            cached_users = list(hot_cache._entries)
+            hot_cache.HOT_CACHE_ENABLED = config.HOT_CACHE_ENABLED
+            hot_cache.HOT_CACHE_MAX_BYTES = config.HOT_CACHE_MAX_BYTES
+            hot_cache.invalidate()
+            if (cached_before == sql_before and cached_after == sql_mid and sql_mid != sql_before
+                    and sql_mid[1] == 56.9
+                    and cached_failed[1] == 58.9 and cached_stale[0] == cached_failed[0]
+                    and cached_reloaded == sql_after and sql_after[0] == 501 and cache_stats['users'] < 5
+                    and cache_stats['bytes'] <= 3 * hot_cache.ENTRY_BYTES and cached_users[-1] == 'hot_lru_4'
+                    and 'hot_user' not in cached_users):
+                print_result("Hot Cache Matches SQL", True)
+                passed += 1
+            else:
+                print_result("Hot Cache Matches SQL", False,
+                             f"SQL={sql_after}, Cached={cached_after, cached_failed[:2], cached_reloaded[:2]}, "
+                             f"Stats={cache_stats}, Users={cached_users}")
+                failed += 1
+        except Exception as e:
+            print_result("Hot Cache Matches SQL", False, str(e))
+            failed += 1
+    
+    # ===== Test 26: Safe-Mode Message Encryption =====
+    try:
+        import app as wechat_app
+        import wechat_message
+        from wechatpy import parse_message as wechatpy_parse
+        from wechatpy.crypto import WeChatCrypto
+        aes_key = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+        wechat_message.WECHAT_ENCODING_AES_KEY = aes_key
+        wechat_message.reset_context()
+        wechat_app.WECHAT_MESSAGE_MODE = 'safe'
+        crypto = WeChatCrypto(config.WECHAT_TOKEN, aes_key, config.WECHAT_APP_ID)
+        plain = ('<xml><ToUserName><![CDATA[gh_test]]></ToUserName>'
+                 '<FromUserName><![CDATA[aes_user]]></FromUserName><CreateTime>1700000000</CreateTime>'
+                 '<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[支出 35 星巴克拿铁]]></Content>'
+                 '<MsgId>1</MsgId></xml>')
+        # 与 wechatpy 互通：双方加密的内容对方都能解开
+        ours = wechat_message.encrypt_reply(plain, 'n1', '1700000000')
+        ours_fields = wechat_message.parse_xml(ours)
+        interop = (wechatpy_parse(crypto.decrypt_message(ours, ours_fields['MsgSignature'], '1700000000', 'n1')).content
+                   == '支出 35 星巴克拿铁')
+        body = crypto.encrypt_message(plain, 'n2', '1700000001')
+        msg_signature = wechat_message.parse_xml(body)['MsgSignature']
+        query = {
+            'signature': wechat_message.sign(config.WECHAT_TOKEN, '1700000001', 'n2'),
+            'timestamp': '1700000001', 'nonce': 'n2',
+        }
+        client = wechat_app.app.test_client()
+        response = client.post('/wechat', query_string=dict(query, encrypt_type='aes', msg_signature=msg_signature),
+                               data=body.encode('utf-8'))
+        reply_fields = wechat_message.parse_xml(response.data)
+        reply = wechatpy_parse(crypto.decrypt_message(response.data.decode('utf-8'), reply_fields['MsgSignature'],
+                                                      reply_fields['TimeStamp'], 'n2'))
+        tampered = client.post('/wechat', query_string=dict(query, encrypt_type='aes', msg_signature='0' * 40),
+                               data=body.encode('utf-8')).status_code
+        plaintext = client.post('/wechat', query_string=query, data=plain.encode('utf-8')).status_code
+        wechat_app.WECHAT_MESSAGE_MODE = config.WECHAT_MESSAGE_MODE
+        wechat_message.WECHAT_ENCODING_AES_KEY = config.WECHAT_ENCODING_AES_KEY
+        wechat_message.reset_context()
+        parsed = wechat_message.parse_xml(plain)
+        if (interop and response.status_code == 200 and reply.target == 'aes_user'
+                and '分类：餐饮' in reply.content and tampered == 403 and plaintext == 403
+                and parsed['Content'] == wechatpy_parse(plain).content and parsed['MsgType'] == 'text'):
+            print_result("Safe-Mode Message Encryption", True)
+            passed += 1
+        else:
+            print_result("Safe-Mode Message Encryption", False,
+                         f"Interop={interop}, Status={response.status_code, tampered, plaintext}, Reply={reply_fields}")
+            failed += 1
+    except Exception as e:
+        print_result("Safe-Mode Message Encryption", False, str(e))
+        failed += 1
+    
+    # ===== Test 27: App Factory and Worker Lifecycle =====
+    try:
+        import app as wechat_app
+        import fcntl
+        # create_app 不访问数据库、不启动线程，每次返回独立的应用
+        fresh = wechat_app.create_app()
+        routes = sorted(rule.rule for rule in fresh.url_map.iter_rules() if rule.endpoint != 'static')
+        wechat_app.after_fork()
+        wechat_app.warm_up()
+        client = fresh.test_client()
+        client.get('/health')
+        first = client.get('/health').get_json()['startup']
+        # 另一个进程持有后台任务锁时不启动调度器
+        wechat_app.BACKGROUND_LOCK_PATH = 'data/test_background.lock'
+        holder = open(wechat_app.BACKGROUND_LOCK_PATH, 'a+')
+        fcntl.flock(holder, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        started = wechat_app.start_background()
+        holder.close()
+        os.remove('data/test_background.lock')
+        wechat_app.BACKGROUND_LOCK_PATH = config.BACKGROUND_LOCK_PATH
+        if (routes == ['/', '/admin/maintenance', '/admin/profile', '/admin/slow-queries', '/health', '/wechat'] and fresh is not wechat_app.app
+                and first['cold_start_ms'] is not None and first['first_request_ms'] is not None
+                and started is False and wechat_app._background_lock is None):
+            print_result("App Factory and Worker Lifecycle", True)
+            passed += 1
+        else:
+            print_result("App Factory and Worker Lifecycle", False,
+                         f"Routes={routes}, Startup={first}, Started={started}")
+            failed += 1
+    except Exception as e:
+        print_result("App Factory and Worker Lifecycle", False, str(e))
+        failed += 1
+    
+    # ===== Test 28: Slow-Query Log (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Slow-Query Log")
+    else:
+        try:
+            import app as wechat_app
+            import slow_query
+            slow_query.reset()
+            slow_query.SLOW_QUERY_MS = 0  # 记录所有语句
+            database.get_category_stats('journal_user', 30)
+            database.get_category_stats('hot_user', 7)
+            database.add_expenses('slow_user', [{'type': 'expense', 'amount': 5, 'category': '餐饮'},
+                                                {'type': 'expense', 'amount': 6, 'category': '餐饮'}])
+            # 没有参数行的 executemany 不记录；执行出错的语句只计时，不取执行计划
+            with database.get_connection() as conn:
+                conn.executemany('DELETE FROM users WHERE openid = ?', [])
+                try:
+                    conn.execute('SELECT no_such_column FROM users')
+                except Exception:
+                    pass
+            slow_query.SLOW_QUERY_MS = config.SLOW_QUERY_MS
+            stats = [e for e in slow_query.top(100) if e['function'] == 'get_category_stats']
+            batch = [e for e in slow_query.top(100) if e['sql'].startswith('INSERT INTO expenses_fts')]
+            empty = [e for e in slow_query.top(100) if e['sql'].startswith('DELETE FROM users')]
+            broken = [e for e in slow_query.top(100) if 'no_such_column' in e['sql']]
+            wechat_app.ADMIN_TOKEN = 'test-admin'
+            client = wechat_app.app.test_client()
+            denied = client.get('/admin/slow-queries').status_code
+            in_query = client.get('/admin/slow-queries?token=test-admin').status_code
+            listed = client.get('/admin/slow-queries?limit=3', headers={'X-Admin-Token': 'test-admin'}).get_json()
+            wechat_app.ADMIN_TOKEN = config.ADMIN_TOKEN
+            closed = client.get('/admin/slow-queries').status_code
+            slow_query.reset()
+            if (len(stats) == 1 and stats[0]['count'] == 2 and stats[0]['params'] == '(str, str)'
+                    and stats[0]['plan'] and batch and batch[0]['params'].startswith('2 行')
+                    and not empty and len(broken) == 1 and broken[0]['plan'] is None
+                    and denied == 403 and in_query == 403 and closed == 404 and len(listed['statements']) == 3):
+                print_result("Slow-Query Log", True)
+                passed += 1
+            else:
+                print_result("Slow-Query Log", False, f"Stats={stats}, Batch={batch}, Empty={empty}, Broken={broken}, Status={denied, closed}")
+                failed += 1
+        except Exception as e:
+            print_result("Slow-Query Log", False, str(e))
+            failed += 1
+    
+    # ===== Test 29: Sampling Profiler =====
+    try:
+        import time
+        import app as wechat_app
+        import profiler
+        import wechat_message
+        profiler.PROFILE_DIR = 'data/test_profiles'
+        shutil.rmtree(profiler.PROFILE_DIR, ignore_errors=True)
+        commands = [wechat_handler.command_name(c) for c in
+                    ('支出 35 星巴克', '支出 1 早餐\n收入 2 奖金', '合并分类 零食 餐饮', '添加贷款 房贷 5000', '你好')]
+        def busy_report():
+            deadline = time.time() + 0.1
+            while time.time() < deadline:
+                sum(range(1000))
+        with profiler.profile('test-busy'):
+            busy_report()
+        busy_top = profiler.top_functions(os.path.join(profiler.PROFILE_DIR, 'test-busy.folded'))
+        # 管理接口调整设置，写入共享设置文件
+        wechat_app.ADMIN_TOKEN = 'test-admin'
+        client = wechat_app.app.test_client()
+        headers = {'X-Admin-Token': 'test-admin'}
+        settings = client.post('/admin/profile', data={'request_percent': 100, 'push': 1},
+                               headers=headers).get_json()['settings']
+        first_push, second_push = profiler.take_push_run(), profiler.take_push_run()
+        query = {'signature': wechat_message.sign(config.WECHAT_TOKEN, '1', 'n'), 'timestamp': '1', 'nonce': 'n'}
+        plain = ('<xml><ToUserName>gh</ToUserName><FromUserName>profile_user</FromUserName>'
+                 '<MsgType>text</MsgType><Content>支出 12 午餐</Content></xml>')
+        status = client.post('/wechat', query_string=query, data=plain.encode('utf-8')).status_code
+        listed = client.get('/admin/profile', headers=headers).get_json()
+        profiler.configure(request_percent=0, push_runs=0)
+        wechat_app.ADMIN_TOKEN = config.ADMIN_TOKEN
+        shutil.rmtree(profiler.PROFILE_DIR, ignore_errors=True)
+        profiler.PROFILE_DIR = config.PROFILE_DIR
+        if (commands == ['支出', '多笔', '合并分类', '贷款', '其他']
+                and busy_top and busy_top[0][0].startswith('test_logic:') and busy_top[0][2] > 0.5
+                and settings == {'request_percent': 100.0, 'push_runs': 1}
+                and (first_push, second_push) == (True, False) and status == 200
+                and 'test-busy.folded' in [f['name'] for f in listed['files']]):
+            print_result("Sampling Profiler", True)
+            passed += 1
+        else:
+            print_result("Sampling Profiler", False,
+                         f"Commands={commands}, Top={busy_top[:2]}, Settings={settings}, Status={status}")
+            failed += 1
+    except Exception as e:
+        print_result("Sampling Profiler", False, str(e))
+        failed += 1
+
+    # ===== Test 30: Query Cost Guard =====
+    try:
+        import time
+        import cost_guard
+        wechat_handler.parse_message('cost_user', '支出 10 餐饮 早餐\n支出 20 餐饮 午餐；支出 30 交通 打车')
+        for text in ('支出 40 餐饮 晚餐', '收入 50 红包', '支出 60 购物 衣服'):
+            wechat_handler.parse_message('cost_user', text)
+        activity = repository.get_month_activity('cost_user')
+        clamped = wechat_handler.parse_message('cost_user', '历史 99999999')
+        # 默认 30 天恰好不算重查询，365 天需要进线程池
+        saved = (cost_guard.HEAVY_READ_ROWS, cost_guard.HEAVY_READ_QUEUE, cost_guard.HEAVY_READ_TIMEOUT)
+        cost_guard.HEAVY_READ_ROWS = cost_guard.estimate_rows('cost_user', 30)
+        pooled = wechat_handler.parse_message('cost_user', '统计 全部 365')
+        cost_guard.HEAVY_READ_QUEUE = 0
+        degraded = wechat_handler.parse_message('cost_user', '统计 全部 365')
+        shed = wechat_handler.parse_message('cost_user', '搜索 午餐')
+        cost_guard.HEAVY_READ_QUEUE, cost_guard.HEAVY_READ_TIMEOUT = 8, 0.05
+        try:
+            cost_guard.run_read('cost_user', 365, 30, lambda d: time.sleep(0.3))
+            timed_out = False
+        except cost_guard.Overloaded:
+            timed_out = True
+        time.sleep(0.4)
+        pending = cost_guard.stats()['pending']
+        cost_guard.HEAVY_READ_ROWS, cost_guard.HEAVY_READ_QUEUE, cost_guard.HEAVY_READ_TIMEOUT = saved
+        if (activity['entries'] == 6 and '最近366天' in clamped and '最多查询最近 366 天' in clamped
+                and '支出统计（365天）' in pooled and '缩短' not in pooled
+                and '支出统计（30天）' in degraded and '已缩短为最近 30 天' in degraded
+                and shed == wechat_handler.BUSY_REPLY and timed_out and pending == 0):
+            print_result("Query Cost Guard", True)
+            passed += 1
+        else:
+            print_result("Query Cost Guard", False,
+                         f"Activity={activity}, Degraded={degraded[:40]}, Shed={shed[:20]}, "
+                         f"Timeout={timed_out}, Pending={pending}")
+            failed += 1
+    except Exception as e:
+        print_result("Query Cost Guard", False, str(e))
+        failed += 1
+
+    # ===== Test 31: Schema Migrations and Chunked Backfill =====
+    try:
+        import migrate
+        def month_entries():
+            rows = {}
+            for _, _, connect in migrate._targets():
+                with connect() as conn:
+                    cursor = migrate._cursor(conn)
+                    cursor.execute('SELECT openid, month, entries FROM month_totals')
+                    rows.update({(r['openid'], r['month']): r['entries'] for r in cursor.fetchall()})
+                    conn.commit()
+            return rows
+        expected = month_entries()
+        # 模拟升级前的数据：月累计行没有笔数
+        for _, _, connect in migrate._targets():
+            with connect() as conn:
+                migrate._cursor(conn).execute(
+                    'UPDATE month_totals SET entries = 0 WHERE expense != 0 OR income != 0')
+                conn.commit()
+        migrate.BACKFILL_CHUNK, migrate.BACKFILL_PAUSE_MS = 3, 0
+        try:
+            migrate.run(on_chunk=lambda: False)
+            interrupted = False
+        except migrate.MigrationError:
+            interrupted = True
+        partial = sum(1 for v in month_entries().values() if v)
+        done = migrate.run()
+        again = migrate.run()
+        migrate.BACKFILL_CHUNK, migrate.BACKFILL_PAUSE_MS = config.BACKFILL_CHUNK, config.BACKFILL_PAUSE_MS
+        pending = [item['pending'] for item in migrate.status()]
+        indexed = True
+        if config.DATABASE_BACKEND == 'sqlite':
+            with database.get_connection() as conn:
+                indexed = 'idx_expenses_openid_created' in [
+                    row['name'] for row in conn.execute('PRAGMA index_list(expenses)')]
+        if (interrupted and 0 < partial < len(expected) and month_entries() == expected
+                and [version for _, version, _ in done][:1] == [2]
+                and again == [] and all(p == [] for p in pending) and indexed):
+            print_result("Schema Migrations and Chunked Backfill", True)
+            passed += 1
+        else:
+            print_result("Schema Migrations and Chunked Backfill", False,
+                         f"Interrupted={interrupted}, Partial={partial}/{len(expected)}, Done={done}, Pending={pending}")
+            failed += 1
+    except Exception as e:
+        print_result("Schema Migrations and Chunked Backfill", False, str(e))
+        failed += 1
+
+    # ===== Test 32: Loan End Dates and Paid-off Sweep =====
+    try:
+        import migrate
+        import scheduler
+        import hot_cache
+        from datetime import date, timedelta
+        today = hot_cache.utc_today()
+        terms = (database._term_end(date(2026, 1, 31), 1, 'loan'), database._term_end(date(2026, 10, 19), 12, 'debt'),
+                 database._term_end(date(2026, 10, 19), 12, 'fixed'))
+        wechat_handler.parse_message('payoff_user', '贷款 车贷 12000 12')
+        wechat_handler.parse_message('payoff_user', '负债 花呗 300 3')
+        wechat_handler.parse_message('payoff_user', '固定 保险 3600 12')
+        items = {e['name']: e for e in repository.get_recurring_expenses('payoff_user')}
+        created_end = str(items['车贷']['end_date'])
+        # 模拟升级前的记录：半年前开始的 3 期负债没有结束日期，由迁移回填
+        for _, _, connect in migrate._targets():
+            with connect() as conn:
+                cursor = migrate._cursor(conn)
+                cursor.execute(migrate._sql('''
+                    UPDATE recurring_expenses SET start_date = ?, end_date = NULL WHERE id = ?
+                '''), ((today - timedelta(days=200)).isoformat(), items['花呗']['id']))
+                cursor.execute('DELETE FROM schema_version WHERE version = 3')
+                cursor.execute("DELETE FROM backfill_progress WHERE name = 'recurring_end_date'")
+                conn.commit()
+        done = [version for _, version, _ in migrate.run()]
+        before = repository.get_daily_debt('payoff_user')['monthly_total']
+        notices = []
+        swept = scheduler.sweep_paid_off(lambda openid, message: notices.append((openid, message)))
+        again = scheduler.sweep_paid_off(lambda openid, message: notices.append((openid, message)))
+        remaining = sorted(e['name'] for e in repository.get_recurring_expenses('payoff_user'))
+        plan = ''
+        if config.DATABASE_BACKEND == 'sqlite':
+            with database.get_connection('payoff_user') as conn:
+                plan = ' '.join(row[3] for row in conn.execute(
+                    'EXPLAIN QUERY PLAN SELECT name FROM recurring_expenses WHERE openid = ? AND is_active = 1',
+                    ('payoff_user',)))
+        if (terms == (date(2026, 2, 27), date(2027, 10, 18), None)
+                and created_end == database._term_end(today, 12, 'loan').isoformat()
+                and items['保险']['end_date'] is None and done == [3]
+                and before == 1000 + 300 and swept == 1 and again == 0
+                and len(notices) == 1 and notices[0][0] == 'payoff_user'
+                and '恭喜还清' in notices[0][1] and '花呗' in notices[0][1]
+                and remaining == ['保险', '车贷']
+                and (config.DATABASE_BACKEND != 'sqlite' or 'idx_recurring_active' in plan)):
+            print_result("Loan End Dates and Paid-off Sweep", True)
+            passed += 1
+        else:
+            print_result("Loan End Dates and Paid-off Sweep", False,
+                         f"Terms={terms}, End={created_end}, Done={done}, Debt={before}, "
+                         f"Swept={swept, again}, Remaining={remaining}, Plan={plan}")
+            failed += 1
+    except Exception as e:
+        print_result("Loan End Dates and Paid-off Sweep", False, str(e))
+        failed += 1
+
+    # ===== Test 33: Database Maintenance (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Database Maintenance")
+    else:
+        try:
+            import sqlite3
+            import maintenance
+            maintenance.MAINTENANCE_LOG_PATH = 'data/test_maintenance.json'
+            maintenance.MAINTENANCE_VACUUM_PAGES = 8
+            maintenance.MAINTENANCE_PAUSE_MS = 0
+            with database.get_connection() as conn:
+                storage = (conn.execute('PRAGMA auto_vacuum').fetchone()[0],
+                           conn.execute('PRAGMA journal_mode').fetchone()[0])
+                # 删除一张临时表，留下空闲页
+                conn.execute('CREATE TABLE maintenance_scratch (payload TEXT)')
+                conn.executemany('INSERT INTO maintenance_scratch VALUES (?)', [('x' * 500,)] * 400)
+                conn.commit()
+                conn.execute('DROP TABLE maintenance_scratch')
+                conn.commit()
+
+            nightly = maintenance.nightly()['databases'][0]
+            maintenance.optimize()
+            latest = [r['kind'] for r in maintenance.history(2)]
+            with database.get_connection() as conn:
+                analyzed = conn.execute(
+                    "SELECT COUNT(*) FROM sqlite_stat1 WHERE tbl = 'expenses'"
+                ).fetchone()[0]
+
+            # 升级前创建的库（auto_vacuum = none）VACUUM 一次后切换为增量回收，超过大小上限时跳过
+            legacy_path = 'data/test_legacy.db'
+            legacy = sqlite3.connect(legacy_path, isolation_level=None)
+            legacy.execute('CREATE TABLE t (v TEXT)')
+            skipped = maintenance._enable_incremental(legacy, legacy_path, 0)
+            converted = maintenance._enable_incremental(legacy, legacy_path, None)
+            legacy_mode = legacy.execute('PRAGMA auto_vacuum').fetchone()[0]
+            legacy.close()
+            os.remove(legacy_path)
+            os.remove(maintenance.MAINTENANCE_LOG_PATH)
+
+            if (storage == (2, 'wal')
+                    and nightly['before']['freelist'] > 8 and nightly['after']['freelist'] == 0
+                    and nightly['freed_pages'] > 8
+                    and nightly['after']['pages'] < nightly['before']['pages']
+                    and nightly['checkpoint']['busy'] == 0 and nightly['after']['wal_bytes'] == 0
+                    and {'analyze', 'incremental_vacuum', 'checkpoint', 'total'} <= set(nightly['ms'])
+                    and analyzed > 0 and latest == ['optimize', 'nightly']
+                    and not skipped and converted and legacy_mode == 2):
+                print_result("Database Maintenance", True)
+                passed += 1
+            else:
+                print_result("Database Maintenance", False,
+                             f"Storage={storage}, Nightly={nightly}, Analyzed={analyzed}, History={latest}, "
+                             f"Legacy={skipped, converted, legacy_mode}")
+                failed += 1
+        except Exception as e:
+            print_result("Database Maintenance", False, str(e))
+            failed += 1
+
+    # ===== Test 34: Online Backup (SQLite only) =====
+    if config.DATABASE_BACKEND != 'sqlite':
+        print("[SKIP] Online Backup")
+    else:
+        try:
+            import threading
+            import time
+            import backup
+            backup.BACKUP_DIR = 'data/test_backups'
+            backup.BACKUP_KEEP = 2
+            backup.BACKUP_STEP_PAGES = 4
+            backup.BACKUP_RATE_MB = 1
+            shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+            database.add_user('test_backup_user')
+            database.add_expenses('test_backup_user', [
+                {'type': 'expense', 'amount': 10 + i, 'category': '餐饮', 'note': f'备份测试 {i} ' + 'x' * 200}
+                for i in range(300)
+            ])
+
+            # 限速分步复制期间持续记账：写入不被阻塞，备份也不会因为新写入而从头开始
+            stop = threading.Event()
+            latencies = []
+
+            def keep_writing():
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    database.add_expense('test_backup_user', 'expense', 1, '餐饮', '备份期间')
+                    latencies.append(time.perf_counter() - started)
+                    time.sleep(0.005)
+
+            writer = threading.Thread(target=keep_writing)
+            writer.start()
+            try:
+                results = backup.backup_databases()
+            finally:
+                stop.set()
+                writer.join()
+            first = results[0]
+            for stamp in ('20990101-000000', '20990102-000000'):
+                backup.backup_file(database.get_db_path(), stamp)
+            kept = [os.path.basename(p) for p in backup.snapshots('test_expense')]
+            verified = backup.verify(os.path.join(backup.BACKUP_DIR, kept[-1]))
+            with open(os.path.join(backup.BACKUP_DIR, 'broken.db'), 'wb') as f:
+                f.write(b'SQLite format 3\x00' + b'\x00' * 4096)
+            broken = backup.backup_file(os.path.join(backup.BACKUP_DIR, 'broken.db'))
+            leftovers = [f for f in os.listdir(backup.BACKUP_DIR) if not f.endswith('.db.gz') and f != 'broken.db']
+            shutil.rmtree(backup.BACKUP_DIR, ignore_errors=True)
+
+            if ('error' not in first and first['pages'] > 3 * backup.BACKUP_STEP_PAGES
+                    and first['compressed_bytes'] < first['bytes']
+                    and len(latencies) > 5 and max(latencies) < 1.0
+                    and kept == ['test_expense-20990101-000000.db.gz', 'test_expense-20990102-000000.db.gz']
+                    and verified == 'ok' and 'error' in broken and broken['snapshot'] is None
+                    and not leftovers):
+                print_result("Online Backup", True)
+                passed += 1
+            else:
+                print_result("Online Backup", False,
+                             f"First={first}, Writes={len(latencies)}, MaxWrite={max(latencies or [0]):.3f}s, "
+                             f"Kept={kept}, Verified={verified}, Broken={broken}, Leftovers={leftovers}")
+                failed += 1
+        except Exception as e:
+            print_result("Online Backup", False, str(e))
+            failed += 1
+
+    # ===== Test 35: Recurring Charges Posted to the Ledger =====
+    try:
+        import threading
+        from datetime import timedelta
+        import hot_cache
+        openid = 'billing_user'
+        repository.add_user(openid)
+        repository.set_budget(openid, 1000)
+        repository.add_recurring_expense(openid, 'loan', '车贷', total_amount=6000, total_months=6)
+        repository.add_recurring_expense(openid, 'fixed', '房租', monthly_amount=800)
+        today = hot_cache.utc_today()
+        early = repository.post_recurring_charges(today=today - timedelta(days=1))
+        posted = [p for p in repository.post_recurring_charges(chunk=1) if p['openid'] == openid]
+        again = repository.post_recurring_charges()
+
+        # 两个进程同时入账同一个分期，只有一个认领成功
+        repository.add_recurring_expense(openid, 'fixed', '物业费', monthly_amount=200)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(repository.post_recurring_charges()))
+                   for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        raced = sorted(len(r) for r in results)
+
+        summary = repository.get_month_summary(openid)
+        categories = {c['category']: c['total'] for c in repository.get_category_stats(openid, 1)['categories']}
+        budget = repository.get_budget(openid)
+        postings = [p['name'] for p in repository.get_recurring_postings(openid)]
+        report = wechat_handler.get_month_report(openid)
+        today_summary = repository.get_today_summary(openid)
+        push = wechat_handler.get_daily_push_data(openid)
+        alerts = sorted(a['threshold'] for a in repository.take_budget_alerts()
+                        if a['scope'] == 'user' and a['scope_id'] == openid)
+
+        # 停机两个月：下次执行时补记漏掉的月份，每个分期每月只记一次
+        next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+        month_after = (next_month + timedelta(days=32)).replace(day=1)
+        resumed = (month_after + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        caught_up = sorted(p['period'] for p in repository.post_recurring_charges(today=resumed)
+                           if p['openid'] == openid)
+        missed = sum(p['amount'] for p in repository.get_recurring_postings(openid, next_month.strftime('%Y-%m')))
+        resumed_again = repository.post_recurring_charges(today=resumed)
+        # 入账当月的分期记在入账日（与 period 同一个账本时钟），不是执行时的真实时间
+        ids = [p['expense_id'] for p in repository.get_recurring_postings(openid, month_after.strftime('%Y-%m'))]
+        if config.DATABASE_BACKEND == 'postgres':
+            with database_pg.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT to_char(created_at, 'YYYY-MM-DD') FROM expenses WHERE id = ANY(%s)", (ids,))
+                posted_days = {row[0] for row in cursor.fetchall()}
+        else:
+            with database.get_connection(openid) as conn:
+                posted_days = {row[0] for row in conn.execute(
+                    f"SELECT date(created_at) FROM expenses WHERE id IN ({','.join('?' * len(ids))})", ids)}
+
+        if (early == [] and sorted(p['name'] for p in posted) == ['房租', '车贷'] and again == []
+                and raced == [0, 1]
+                and summary['expense'] == 2000 and budget['spent'] == 2000
+                and categories == {'还贷': 1000, '固定开支': 1000}
+                and sorted(postings) == ['房租', '物业费', '车贷']
+                and '其中固定支出：2000.00 元' in report and alerts == [80, 100]
+                and today_summary['expense'] == 2000 and today_summary['recurring'] == 2000
+                and push['net_income'] == -push['daily_debt']
+                and caught_up == [next_month.strftime('%Y-%m')] * 3 + [month_after.strftime('%Y-%m')] * 3
+                and missed == 2000 and resumed_again == [] and posted_days == {resumed.isoformat()}):
+            print_result("Recurring Charges Posted to the Ledger", True)
+            passed += 1
+        else:
+            print_result("Recurring Charges Posted to the Ledger", False,
+                         f"Early={early}, Posted={posted}, Again={again}, Raced={raced}, "
+                         f"Summary={summary}, Categories={categories}, Budget={budget}, "
+                         f"Postings={postings}, Alerts={alerts}, Report={report}, "
+                         f"CaughtUp={caught_up}, Missed={missed}, Again={resumed_again}, PostedDays={posted_days}, "
+                         f"Today={today_summary['expense'], today_summary['recurring']}, Push={push['net_income']}")
+            failed += 1
+    except Exception as e:
+        print_result("Recurring Charges Posted to the Ledger", False, str(e))
+        failed += 1
+
+    # ===== Test 36: Push Lease Renewed During a Batch =====
+    real_time = time_module.time
+    real_renew = scheduler.renew_push_task
+    try:
+        # 把时钟拨到所有用户都已到期；推送期间第二次续约时租约已被其他进程接手
+        users = repository.get_all_users()
+        due = [repository.set_push_time(openid, '00:00') for openid in users]
+        time_module.time = lambda: max(due) + 240
+        renewals = []
+        def renew(*args):
+            renewals.append(args)
+            return len(renewals) < 2
+        scheduler.renew_push_task = renew
+        scheduler.PUSH_TASK_LEASE_SECONDS = 0  # 每发完一位就续约
+        scheduler.PUSH_CONCURRENCY = 1
+        run_key = scheduler.get_push_run_key() + '-renew'
+        repository.create_push_tasks(run_key, 1)
+        task = repository.claim_push_task(scheduler.get_holder_id(), 60)
+        scheduled = lambda: {u['openid']: u['next_push_at']
+                             for u in repository.get_push_targets(0, 1, time_module.time(), len(users))}
+        before = scheduled()
+        client = MockClient()
+        client.message = MockMessage()
+        scheduler.process_push_task(client, task)
+        sent = client.message.sent
+        after = scheduled()
+        # 发完的用户立即排到下一次，续约失败后没开始的发送被取消，仍按原时间等待接手方推送
+        moved = {openid for openid in before if after.get(openid) != before[openid]}
+        if len(renewals) == 2 and set(sent) <= moved and 2 <= len(moved) < len(before):
+            print_result("Push Lease Renewed During a Batch", True)
+            passed += 1
+        else:
+            print_result("Push Lease Renewed During a Batch", False,
+                         f"Renewals={len(renewals)}, Sent={len(sent)}/{len(before)}, Moved={len(moved)}")
+            failed += 1
+    except Exception as e:
+        print_result("Push Lease Renewed During a Batch", False, str(e))
+        failed += 1
+    finally:
+        time_module.time = real_time
+        scheduler.renew_push_task = real_renew
+        scheduler.PUSH_TASK_LEASE_SECONDS = config.PUSH_TASK_LEASE_SECONDS
+        scheduler.PUSH_CONCURRENCY = config.PUSH_CONCURRENCY
+
     # Summary
     print("\n" + "=" * 50)
     total = passed + failed
@@ -249,6 +1391,7 @@ def run_tests():
     print("=" * 50)
     
     # Clean up test database
+    shutil.rmtree('data/test_journal', ignore_errors=True)
     if os.path.exists('data/test_expense.db'):
         os.remove('data/test_expense.db')
         print("\nTest database cleaned up")
@@ -0,0 +1,200 @@
+"""
+微信出站调用模块
+
+所有主动调用微信接口的地方（家庭通知、每日推送）都通过 call_api 执行：
+- 错误分类：令牌过期、限流/系统繁忙、用户不可达、其他错误、网络错误
+- 令牌过期（40001/40014/42001）时刷新 access_token 后立即重试
+- 限流、系统繁忙和网络错误按指数退避（带随机抖动）重试
+- 熔断器：上游连续失败达到阈值后在冷却期内直接失败，冷却结束后放行一次探测请求
+"""
+
+import random
+import threading
+import time
+
+import requests
+from wechatpy import WeChatClient
+from wechatpy.exceptions import WeChatClientException
+
+from config import (
+    WECHAT_APP_ID, WECHAT_APP_SECRET,
+    OUTBOUND_TIMEOUT, OUTBOUND_RETRIES, OUTBOUND_BACKOFF_BASE, OUTBOUND_BACKOFF_MAX,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS
+)
+
+
+# 错误类型
+TOKEN_EXPIRED = 'token_expired'
+RATE_LIMITED = 'rate_limited'
+UNREACHABLE = 'unreachable'
+NETWORK = 'network'
+CIRCUIT_OPEN = 'circuit_open'
+ERROR = 'error'
+
+# 微信错误码分类
+ERRCODE_KINDS = {
+    40001: TOKEN_EXPIRED,   # access_token 无效
+    40014: TOKEN_EXPIRED,   # 不合法的 access_token
+    42001: TOKEN_EXPIRED,   # access_token 超时
+    -1: RATE_LIMITED,       # 系统繁忙
+    45009: RATE_LIMITED,    # 接口调用超过限制
+    45011: RATE_LIMITED,    # API 调用太频繁
+    45047: RATE_LIMITED,    # 客服消息下行条数超过上限
+    40003: UNREACHABLE,     # 不合法的 OpenID
+    43004: UNREACHABLE,     # 用户未关注
+    43019: UNREACHABLE,     # 用户在黑名单中
+    45015: UNREACHABLE,     # 超出客服消息回复时限
+}
+
+# 可以退避重试、并计入熔断的错误类型
+TRANSIENT_KINDS = (RATE_LIMITED, NETWORK)
+
+
+class OutboundError(Exception):
+    """出站调用失败（已分类）"""
+
+    def __init__(self, kind: str, errcode: int = None, message: str = ''):
+        super().__init__(f"[{kind}] {errcode if errcode is not None else ''} {message}".strip())
+        self.kind = kind
+        self.errcode = errcode
+
+    @property
+    def transient(self) -> bool:
+        """稍后重试可能成功（限流、网络、熔断中）"""
+        return self.kind in TRANSIENT_KINDS or self.kind == CIRCUIT_OPEN
+
+
+# 进程内共享的微信客户端（access_token 缓存在客户端会话中）
+_client = None
+_client_lock = threading.Lock()
+
+# 熔断器状态
+_circuit = {'failures': 0, 'opened_at': None, 'probing': False}
+_circuit_lock = threading.Lock()
+
+
+def get_client() -> WeChatClient:
+    """获取进程内共享的微信客户端（关闭 wechatpy 自带的无限令牌重试，由 call_api 处理）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WeChatClient(WECHAT_APP_ID, WECHAT_APP_SECRET,
+                                       timeout=OUTBOUND_TIMEOUT, auto_retry=False)
+    return _client
+
+
+def classify_error(e: Exception) -> OutboundError:
+    """把微信接口或网络异常归类为 OutboundError"""
+    if isinstance(e, OutboundError):
+        return e
+    if isinstance(e, WeChatClientException):
+        return OutboundError(ERRCODE_KINDS.get(e.errcode, ERROR), e.errcode, e.errmsg)
+    if isinstance(e, requests.RequestException):
+        return OutboundError(NETWORK, None, str(e))
+    return OutboundError(ERROR, None, str(e))
+
+
+def _circuit_allow() -> bool:
+    """熔断器是否放行本次请求（冷却结束后只放行一个探测请求）"""
+    with _circuit_lock:
+        if _circuit['opened_at'] is None:
+            return True
+        if time.time() - _circuit['opened_at'] < CIRCUIT_RESET_SECONDS or _circuit['probing']:
+            return False
+        _circuit['probing'] = True
+        return True
+
+
+def _circuit_record(success: bool):
+    """记录一次上游调用结果"""
+    with _circuit_lock:
+        if success:
+            if _circuit['opened_at'] is not None:
+                print("[微信接口] 上游恢复，熔断关闭")
+            _circuit.update(failures=0, opened_at=None, probing=False)
+            return
+        _circuit['failures'] += 1
+        if _circuit['probing'] or _circuit['failures'] >= CIRCUIT_FAILURE_THRESHOLD:
+            if _circuit['opened_at'] is None or _circuit['probing']:
+                print(f"[微信接口] 连续失败 {_circuit['failures']} 次，熔断 {CIRCUIT_RESET_SECONDS} 秒")
+            _circuit.update(opened_at=time.time(), probing=False)
+
+
+def reset_circuit():
+    """重置熔断器（测试或手动恢复时使用）"""
+    with _circuit_lock:
+        _circuit.update(failures=0, opened_at=None, probing=False)
+
+
+def get_circuit_state() -> str:
+    """熔断器状态：closed、open 或 half_open"""
+    with _circuit_lock:
+        if _circuit['opened_at'] is None:
+            return 'closed'
+        if time.time() - _circuit['opened_at'] < CIRCUIT_RESET_SECONDS:
+            return 'open'
+        return 'half_open'
+
+
+def _refresh_token(client):
+    """丢弃缓存的 access_token 并重新获取"""
+    try:
+        client.session.delete(client.access_token_key)
+        client.fetch_access_token()
+    except Exception as e:
+        raise classify_error(e)
+
+
+def call_api(action, client=None, retries: int = None):
+    """
+    执行一次微信出站调用
+
+    Args:
+        action: 接收客户端并发起调用的函数，如 lambda c: c.message.send_text(openid, text)
+        client: 微信客户端，默认使用 get_client()
+        retries: 限流/网络错误的最大重试次数，默认 OUTBOUND_RETRIES
+
+    Returns:
+        action 的返回值
+
+    Raises:
+        OutboundError: 分类后的失败原因；熔断中直接抛出 kind=circuit_open
+    """
+    client = client or get_client()
+    retries = OUTBOUND_RETRIES if retries is None else retries
+    token_refreshed = False
+    attempt = 0
+    while True:
+        if not _circuit_allow():
+            raise OutboundError(CIRCUIT_OPEN, None, '微信接口熔断中')
+        try:
+            result = action(client)
+        except Exception as e:
+            error = classify_error(e)
+            if error.kind == TOKEN_EXPIRED and not token_refreshed:
+                # 令牌问题不是上游故障，刷新后立即重试一次
+                _circuit_record(True)
+                token_refreshed = True
+                _refresh_token(client)
+                continue
+            _circuit_record(error.kind not in TRANSIENT_KINDS)
+            if error.kind not in TRANSIENT_KINDS or attempt >= retries:
+                raise error
+            # 指数退避 + 全抖动
+            delay = random.uniform(0, min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            time.sleep(delay)
+            continue
+        _circuit_record(True)
+        return result
+
+
+def send_text(openid: str, content: str, client=None):
+    """发送客服文本消息"""
+    return call_api(lambda c: c.message.send_text(openid, content), client)
+
+
+def send_template(openid: str, template_id: str, data: dict, client=None):
+    """发送模板消息"""
+    return call_api(lambda c: c.message.send_template(openid, template_id, data), client)
@@ -5,24 +5,81 @@
 """
 
 import re
-from database import (
+from datetime import datetime
+import cost_guard
+from config import DAILY_PUSH_HOUR, DAILY_PUSH_MINUTE, MAX_QUERY_DAYS
+from repository import (
     add_user, add_expense, get_today_summary, get_month_summary,
     add_recurring_expense, get_recurring_expenses, delete_recurring_expense,
-    get_daily_debt, create_family, join_family, get_user_family, get_family_members, leave_family,
+    get_daily_debt, create_family, join_family, get_user_family, leave_family,
     get_family_members_detail, get_family_debt_ranking,
     get_family_recurring_expenses, get_family_daily_debt, update_nickname,
-    get_expense_history, get_category_stats, set_budget, get_budget, is_family_creator
+    get_expense_history, get_category_stats, set_budget, get_budget, is_family_creator,
+    search_expenses, resolve_category, merge_category, get_user_categories,
+    get_user, set_push_time, enqueue_family_notification,
+    set_family_budget, get_family_budget, add_expenses, enqueue_family_notifications,
+    get_recurring_postings
 )
 
 
-def parse_message(openid: str, content: str, notify_callback=None) -> str:
+# 多笔记账：一条消息中按换行或分号分隔的记账行
+ENTRY_SEPARATOR = re.compile(r'[\n;；]+')
+ENTRY_PATTERN = re.compile(r'^(支出|收入)\s+(\d+(?:\.\d+)?)\s*(\S*)\s*(.*)$')
+ENTRY_TYPES = {'支出': 'expense', '收入': 'income'}
+MAX_BATCH_ENTRIES = 50
+
+# 指令关键词（较长的在前），用于按指令归类消息，例如性能剖析的标签
+COMMAND_NAMES = tuple(sorted((
+    '帮助', '今日', '本月', '固定', '贷款', '欠款', '支出', '收入', '负债', '删除',
+    '创建家庭', '加入家庭', '退出家庭', '家庭成员', '家庭欠款', '家庭预算', '家庭',
+    '昵称', '改名', '我叫', '历史', '搜索', '统计', '分类', '合并分类', '预算', '推送', '初始化',
+), key=len, reverse=True))
+
+
+def batch_lines(content: str) -> list:
+    """
+    多笔记账的各行：按换行或分号拆开后至少两段，且每一段都是「支出/收入 金额 ...」
+
+    其他情况返回空列表，按单条指令处理（备注、家庭名等可以包含分号）
+    """
+    lines = [line.strip() for line in ENTRY_SEPARATOR.split(content) if line.strip()]
+    if len(lines) > 1 and all(ENTRY_PATTERN.match(line) for line in lines):
+        return lines
+    return []
+
+
+def command_name(content: str) -> str:
+    """消息对应的指令名称（多笔记账为「多笔」，无法识别为「其他」），不包含用户输入的内容"""
+    content = (content or '').strip()
+    if batch_lines(content):
+        return '多笔'
+    content = content[2:] if content.startswith('添加') else content
+    for name in COMMAND_NAMES:
+        if content.startswith(name):
+            return name
+    return '其他'
+
+
+# 重查询过多时的回复
+BUSY_REPLY = '⏳ 当前查询的人较多，请稍后再试，或缩短天数（如「历史 7」）'
+
+
+def _window_note(requested: int, days: int) -> str:
+    """实际查询的天数少于用户要求时附加的说明"""
+    if days >= requested:
+        return ''
+    if days == MAX_QUERY_DAYS:
+        return f'\n\n💡 最多查询最近 {MAX_QUERY_DAYS} 天'
+    return f'\n\n💡 当前查询的人较多，已缩短为最近 {days} 天'
+
+
+def parse_message(openid: str, content: str) -> str:
     """
     解析用户消息并返回响应
     
     Args:
         openid: 用户 OpenID
         content: 消息内容
-        notify_callback: 用于发送通知的回调函数 (openid, message)
     
     Returns:
         响应文本
@@ -32,6 +89,14 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
     
     content = content.strip()
     
+    # 多笔记账：多行或分号分隔
+    lines = batch_lines(content)
+    if lines:
+        return handle_batch_entries(openid, lines)
+    if '\n' in content:
+        # 单条指令不会跨行：多行但不全是记账行时提示无法识别的行，不记录任何账目
+        return invalid_batch_reply(content)
+    
     # 帮助指令
     if content in ['帮助', '?', '？', 'help']:
         return get_help_message()
@@ -48,39 +113,23 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
     if content in ['固定', '贷款', '欠款']:
         return get_recurring_report(openid)
     
-    # 支出指令: 支出 金额 [分类] [备注]
+    # 支出指令: 支出 金额 [分类] [备注]（分类写成商户名或没写分类时自动推断）
     match = re.match(r'^支出\s+(\d+(?:\.\d+)?)\s*(\S*)\s*(.*)$', content)
     if match:
         amount = float(match.group(1))
-        category = match.group(2) or '其他'
-        description = match.group(3) or None
-        add_expense(openid, 'expense', amount, category, description)
+        record = add_expenses(openid, [{
+            'type': 'expense', 'amount': amount, 'category': match.group(2) or None,
+            'description': match.group(3) or None, 'infer': True,
+        }])[0]
+        category = record['category']
+        description = record['description']
         
         response = f'✅ 已记录支出 {amount} 元\n分类：{category}' + (f'\n备注：{description}' if description else '')
         
-        # 家庭组通知逻辑
+        # 家庭组通知：放入发件箱，由调度器合并后统一发送
         family = get_user_family(openid)
-        if family and notify_callback:
-            members = get_family_members(family['id'])
-            month_summary = get_month_summary(openid)
-            debt = get_daily_debt(openid)
-            
-            notify_msg = f'''📢 家庭支出提醒
-
-成员：{"另一半" if family["role"] == "member" else "创建者"}
-物品：{category}
-金额：{amount:.2f} 元'''
-            if description:
-                notify_msg += f'\n备注：{description}'
-            
-            notify_msg += f'''
-
-📊 本月累计支出：{month_summary["expense"]:.2f} 元
-🏠 每日固定欠款：{debt["daily_total"]:.2f} 元'''
-            
-            for member_openid in members:
-                if member_openid != openid:
-                    notify_callback(member_openid, notify_msg)
+        if family:
+            enqueue_family_notification(family['id'], openid, category, amount, description)
         
         return response
     
@@ -88,9 +137,9 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
     match = re.match(r'^收入\s+(\d+(?:\.\d+)?)\s*(\S*)\s*(.*)$', content)
     if match:
         amount = float(match.group(1))
-        category = match.group(2) or '其他'
+        category_id, category = resolve_category(openid, match.group(2) or '其他')
         description = match.group(3) or None
-        add_expense(openid, 'income', amount, category, description)
+        add_expense(openid, 'income', amount, category, description, category_id=category_id)
         return f'✅ 已记录收入 {amount} 元\n分类：{category}' + (f'\n备注：{description}' if description else '')
     
     # 添加贷款: 支持两种格式
@@ -291,11 +340,15 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
     # 历史记录: 历史 [天数]
     match = re.match(r'^历史(?:\s+(\d+))?$', content)
     if match:
-        days = int(match.group(1)) if match.group(1) else 7
-        records = get_expense_history(openid, days)
+        requested = int(match.group(1)) if match.group(1) else 7
+        try:
+            records, days = cost_guard.run_read(
+                openid, requested, 7, lambda d: get_expense_history(openid, d))
+        except cost_guard.Overloaded:
+            return BUSY_REPLY
         
         if not records:
-            return f'📋 最近{days}天暂无记账记录'
+            return f'📋 最近{days}天暂无记账记录' + _window_note(requested, days)
         
         msg = f'📋 最近{days}天记录\n'
         msg += '─────────────────────'
@@ -312,18 +365,54 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
             if r['description']:
                 msg += f' ({r["description"]})'
         
-        return msg
+        return msg + _window_note(requested, days)
+    
+    # 关键词搜索: 搜索 关键词 [天数]
+    match = re.match(r'^搜索\s+(.+?)(?:\s+(\d+))?$', content)
+    if match:
+        keyword = match.group(1).strip()
+        requested = int(match.group(2)) if match.group(2) else 365
+        try:
+            result, days = cost_guard.run_read(
+                openid, requested, 365, lambda d: search_expenses(openid, keyword, d))
+        except cost_guard.Overloaded:
+            return BUSY_REPLY
+        
+        if not result['count']:
+            return f'🔍 最近{days}天没有找到「{keyword}」相关记录' + _window_note(requested, days)
+        
+        msg = f'''🔍 「{keyword}」搜索结果（{days}天）
+┌─────────────────────
+│ 📝 匹配：{result["count"]} 笔
+│ 💸 支出：{result["expense"]:,.2f} 元'''
+        if result['income']:
+            msg += f'\n│ 💵 收入：{result["income"]:,.2f} 元'
+        msg += '\n└─────────────────────'
+        
+        for r in result['records']:
+            icon = '💵' if r['type'] == 'income' else '💸'
+            category = r['category'] or '其他'
+            msg += f'\n{r["date"][5:]} {icon} {category} {r["amount"]:.0f}元'
+            if r['description']:
+                msg += f' ({r["description"]})'
+        
+        if result['count'] > len(result['records']):
+            msg += f'\n\n仅显示最近 {len(result["records"])} 笔'
+        return msg + _window_note(requested, days)
     
     # 分类统计: 统计 [分类] [天数]
     match = re.match(r'^统计(?:\s+(\S+))?(?:\s+(\d+))?$', content)
     if match:
         category_filter = match.group(1)
-        days = int(match.group(2)) if match.group(2) else 30
-        
-        stats = get_category_stats(openid, days)
+        requested = int(match.group(2)) if match.group(2) else 30
+        try:
+            stats, days = cost_guard.run_read(
+                openid, requested, 30, lambda d: get_category_stats(openid, d))
+        except cost_guard.Overloaded:
+            return BUSY_REPLY
         
         if stats['total'] == 0:
-            return f'📊 最近{days}天暂无支出记录'
+            return f'📊 最近{days}天暂无支出记录' + _window_note(requested, days)
         
         msg = f'''📊 支出统计（{days}天）
 ┌─────────────────────
@@ -339,8 +428,32 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
             msg += f'\n{cat_name}：{c["total"]:,.0f}元'
             msg += f'\n{bar} {percent:.0f}%'
         
+        return msg + _window_note(requested, days)
+    
+    # 分类映射: 分类
+    if content == '分类':
+        categories = get_user_categories(openid)
+        if not categories:
+            return '📂 暂无分类记录\n\n发送「支出 50 餐饮 午餐」开始记账'
+        
+        msg = '📂 我的分类\n─────────────────────'
+        for c in categories:
+            msg += f'\n{c["category"]}：{c["count"]} 笔'
+            if c['aliases']:
+                msg += f'\n    ← {"、".join(c["aliases"])}'
+        msg += '\n\n💡 合并命令：合并分类 原分类 目标分类'
         return msg
     
+    # 合并分类: 合并分类 原分类 目标分类
+    match = re.match(r'^合并分类\s+(\S+)\s+(\S+)$', content)
+    if match:
+        source, target = match.group(1), match.group(2)
+        moved = merge_category(openid, source, target)
+        if moved is None:
+            return f'❌ 未找到分类「{source}」，发送「分类」查看已有分类'
+        _, target_name = resolve_category(openid, target)
+        return f'✅ 已将「{source}」合并到「{target_name}」\n迁移记录：{moved} 笔\n以后记「{source}」会自动归入「{target_name}」'
+    
     # 预算设置: 预算 金额
     match = re.match(r'^预算\s+(\d+(?:\.\d+)?)$', content)
     if match:
@@ -355,32 +468,31 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
         if not budget_info['budget']:
             return '📋 您还未设置预算\n\n发送「预算 5000」设置月预算'
         
-        budget = budget_info['budget']
-        spent = budget_info['spent']
-        remaining = budget_info['remaining']
-        percent = budget_info['percent']
-        
-        # 进度条
-        bar_len = min(int(percent / 10), 10)
-        bar = '█' * bar_len + '░' * (10 - bar_len)
+        return render_budget('💰 本月预算', budget_info)
+    
+    # 家庭预算设置: 家庭预算 金额（仅创建者）
+    match = re.match(r'^家庭预算(?:\s+(\d+(?:\.\d+)?))?$', content)
+    if match:
+        family = get_user_family(openid)
+        if not family:
+            return '❌ 您当前不在任何家庭组中。'
         
-        # 状态提示
-        if percent >= 100:
-            status = '🚨 已超支！'
-        elif percent >= 80:
-            status = '⚠️ 即将超支'
-        else:
-            status = '✅ 正常'
+        if match.group(1):
+            if family['role'] != 'creator':
+                return '❌ 只有家庭创建者可以设置家庭预算'
+            amount = float(match.group(1))
+            set_family_budget(family['id'], amount)
+            return f'✅ 家庭月预算已设置为：{amount:,.0f} 元'
         
-        return f'''💰 本月预算
-┌─────────────────────
-│ 预算：{budget:,.0f} 元
-│ 已用：{spent:,.0f} 元
-│ 剩余：{remaining:,.0f} 元
-└─────────────────────
-
-{bar} {percent:.0f}%
-{status}'''
+        budget_info = get_family_budget(family['id'])
+        if not budget_info['budget']:
+            return '📋 家庭还未设置预算\n\n创建者发送「家庭预算 8000」设置家庭月预算'
+        return render_budget(f'👨‍👩‍👧‍👦 {family["name"]} 本月预算', budget_info)
+    
+    # 推送设置: 推送 [7:30|关闭|开启|默认]
+    match = re.match(r'^推送(?:\s+(\S+))?$', content)
+    if match:
+        return handle_push_setting(openid, match.group(1))
     
     # 初始化引导
     if content in ['初始化', '设置', '开始', 'start', 'init']:
@@ -390,6 +502,93 @@ def parse_message(openid: str, content: str, notify_callback=None) -> str:
     return '❓ 无法识别的指令，发送"帮助"查看使用说明'
 
 
+def invalid_batch_reply(content: str) -> str:
+    """多行消息中有无法识别的行时的回复（本次不记录任何账目）"""
+    lines = [line.strip() for line in ENTRY_SEPARATOR.split(content) if line.strip()]
+    invalid = [f'第 {i} 行：{line}' for i, line in enumerate(lines, 1) if not ENTRY_PATTERN.match(line)]
+    return '❌ 以下内容无法识别，本次未记录任何账目：\n' + '\n'.join(invalid) + \
+           '\n\n每行格式：支出 50 餐饮 午餐'
+
+
+def handle_batch_entries(openid: str, lines: list) -> str:
+    """
+    多笔记账：在一个事务内写入全部行，回复一条合计
+
+    lines 来自 batch_lines()，每一行都已符合记账格式；有一行不符合时整条消息不会走到这里，
+    多行消息由 invalid_batch_reply() 提示，不会只记一部分。
+    """
+    if len(lines) > MAX_BATCH_ENTRIES:
+        return f'❌ 一次最多记录 {MAX_BATCH_ENTRIES} 笔，请分开发送'
+    
+    entries = []
+    for line in lines:
+        match = ENTRY_PATTERN.match(line)
+        entry_type = ENTRY_TYPES[match.group(1)]
+        entries.append({
+            'type': entry_type,
+            'amount': float(match.group(2)),
+            'category': match.group(3) or (None if entry_type == 'expense' else '其他'),
+            'description': match.group(4) or None,
+            'infer': entry_type == 'expense',
+        })
+    
+    records = add_expenses(openid, entries)
+    expenses = [r for r in records if r['type'] == 'expense']
+    incomes = [r for r in records if r['type'] == 'income']
+    
+    msg = f'✅ 已记录 {len(records)} 笔'
+    for r in records:
+        icon = '💵' if r['type'] == 'income' else '💸'
+        msg += f'\n{icon} {r["category"]} {r["amount"]:.2f} 元'
+        if r['description']:
+            msg += f'（{r["description"]}）'
+    msg += '\n─────────────────────'
+    if expenses:
+        msg += f'\n支出合计：{sum(r["amount"] for r in expenses):,.2f} 元（{len(expenses)} 笔）'
+    if incomes:
+        msg += f'\n收入合计：{sum(r["amount"] for r in incomes):,.2f} 元（{len(incomes)} 笔）'
+    
+    # 家庭组通知：整批一次写入发件箱，合并成一条通知
+    if expenses:
+        family = get_user_family(openid)
+        if family:
+            enqueue_family_notifications(family['id'], openid, expenses)
+    
+    return msg
+
+
+def handle_push_setting(openid: str, arg: str = None) -> str:
+    """查看或修改每日推送时间"""
+    user = get_user(openid)
+    if arg is None:
+        if not user['push_enabled']:
+            return '🔕 每日推送已关闭\n\n发送「推送 开启」恢复推送'
+        push_time = user['push_time'] or f'{DAILY_PUSH_HOUR:02d}:{DAILY_PUSH_MINUTE:02d}（默认）'
+        msg = f'⏰ 每日推送时间：{push_time}'
+        if user['next_push_at']:
+            msg += f'\n下次推送：{datetime.fromtimestamp(user["next_push_at"]).strftime("%m-%d %H:%M")}'
+        msg += '\n\n💡 修改：推送 7:30 / 推送 关闭'
+        return msg
+    
+    if arg == '关闭':
+        set_push_time(openid, user['push_time'], enabled=False)
+        return '🔕 已关闭每日推送\n\n发送「推送 开启」恢复推送'
+    
+    if arg in ('开启', '打开'):
+        next_push_at = set_push_time(openid, user['push_time'])
+    elif arg == '默认':
+        next_push_at = set_push_time(openid, None)
+    else:
+        match = re.match(r'^(\d{1,2})[:：点](\d{1,2})?$', arg)
+        if not match or int(match.group(1)) > 23 or int(match.group(2) or 0) > 59:
+            return '❌ 时间格式不正确，例如：推送 7:30'
+        push_time = f'{int(match.group(1)):02d}:{int(match.group(2) or 0):02d}'
+        next_push_at = set_push_time(openid, push_time)
+    
+    next_time = datetime.fromtimestamp(next_push_at).strftime('%m-%d %H:%M')
+    return f'✅ 每日推送已开启\n下次推送：{next_time}'
+
+
 def get_init_guide() -> str:
     """返回初始化录入引导"""
     return '''🚀 欢迎使用记账小助手！
@@ -436,6 +635,7 @@ def get_help_message() -> str:
 💰 【日常记账】
 • 支出 50 餐饮 午餐
 • 收入 1000 工资
+• 多笔可换行或用分号分隔
 
 🏠 【贷款】
 • 贷款 房贷 1000000 360
@@ -450,7 +650,17 @@ def get_help_message() -> str:
 • 今日/本月/欠款
 • 历史 [天数]
 • 统计 [天数]
+• 搜索 关键词 [天数]
 • 预算 [金额]
+• 家庭预算 [金额]
+
+⏰ 【每日推送】
+• 推送 7:30
+• 推送 关闭/开启/默认
+
+📂 【分类】
+• 分类
+• 合并分类 吃饭 餐饮
 
 👨‍👩‍👧‍👦 【家庭组】
 • 创建家庭/加入家庭
@@ -461,9 +671,8 @@ def get_help_message() -> str:
 
 
 def get_today_report(openid: str) -> str:
-    """生成今日报告"""
+    """生成今日报告（固定开支在还款日自动入账，已包含在支出中）"""
     summary = get_today_summary(openid)
-    debt = get_daily_debt(openid)
     
     msg = f'''📅 今日账单
 
@@ -471,13 +680,6 @@ def get_today_report(openid: str) -> str:
 💸 支出：{summary["expense"]:.2f} 元
 📊 结余：{summary["balance"]:.2f} 元'''
     
-    if debt['daily_total'] > 0:
-        net = summary['balance'] - debt['daily_total']
-        msg += f'''
-
-🏠 每日固定支出：{debt["daily_total"]:.2f} 元
-💰 实际结余：{net:.2f} 元'''
-    
     if summary['records']:
         msg += '\n\n📝 今日明细：'
         for r in summary['records'][:5]:  # 最多显示5条
@@ -488,9 +690,9 @@ def get_today_report(openid: str) -> str:
 
 
 def get_month_report(openid: str) -> str:
-    """生成本月报告"""
+    """生成本月报告（收支直接来自账本，到期的固定开支/贷款已自动入账）"""
     summary = get_month_summary(openid)
-    debt = get_daily_debt(openid)
+    postings = get_recurring_postings(openid)
     
     msg = f'''📅 本月统计
 
@@ -499,12 +701,12 @@ def get_month_report(openid: str) -> str:
 📊 结余：{summary["balance"]:.2f} 元
 📆 记账天数：{summary["days"]} 天'''
     
-    if debt['monthly_total'] > 0:
-        net = summary['balance'] - debt['monthly_total']
+    if postings:
         msg += f'''
 
-🏠 固定支出：{debt["monthly_total"]:.2f} 元
-💰 实际结余：{net:.2f} 元'''
+🏠 其中固定支出：{sum(p["amount"] for p in postings):.2f} 元'''
+        for p in postings:
+            msg += f'\n• {p["name"]} {p["amount"]:.2f} 元'
     
     return msg
 
@@ -569,6 +771,8 @@ def get_recurring_report(openid: str) -> str:
             if e.get('total_amount') and e.get('total_months'):
                 msg += f"\n[{e['id']}] {name}{owner_tag}"
                 msg += f"\n    {e['total_amount']:,.0f} ÷ {e['total_months']}期"
+                if e.get('end_date'):
+                    msg += f"，{e['end_date']} 到期"
                 msg += f"\n    → {e['monthly_amount']:,.0f}/月 | {daily:.0f}/日"
             else:
                 msg += f"\n[{e['id']}] {name}{owner_tag}"
@@ -580,63 +784,190 @@ def get_recurring_report(openid: str) -> str:
     return msg
 
 
-def get_daily_push_message(openid: str) -> str:
-    """生成每日推送消息"""
+def render_budget(title: str, budget_info: dict) -> str:
+    """生成预算使用情况（get_budget / get_family_budget 的返回值）"""
+    budget = budget_info['budget']
+    spent = budget_info['spent']
+    remaining = budget_info['remaining']
+    percent = budget_info['percent']
+    
+    # 进度条
+    bar_len = min(int(percent / 10), 10)
+    bar = '█' * bar_len + '░' * (10 - bar_len)
+    
+    # 状态提示
+    if percent >= 100:
+        status = '🚨 已超支！'
+    elif percent >= 80:
+        status = '⚠️ 即将超支'
+    else:
+        status = '✅ 正常'
+    
+    return f'''{title}
+┌─────────────────────
+│ 预算：{budget:,.0f} 元
+│ 已用：{spent:,.0f} 元
+│ 剩余：{remaining:,.0f} 元
+└─────────────────────
+
+{bar} {percent:.0f}%
+{status}'''
+
+
+def render_budget_alert(alert: dict, family_name: str = None) -> str:
+    """
+    生成预算预警通知
+
+    Args:
+        alert: take_budget_alerts 返回的一条预警
+        family_name: 家庭预算预警时的家庭名称
+    """
+    title = f'家庭「{family_name}」' if alert['scope'] == 'family' else '您的'
+    if alert['threshold'] >= 100:
+        head = f'🚨 预算提醒：{title}本月支出已超出预算'
+    else:
+        head = f'⚠️ 预算提醒：{title}本月支出已达预算的 {alert["threshold"]}%'
+    return f'''{head}
+┌─────────────────────
+│ 预算：{alert["budget"]:,.0f} 元
+│ 已用：{alert["spent"]:,.0f} 元
+│ 剩余：{alert["budget"] - alert["spent"]:,.0f} 元
+└─────────────────────'''
+
+
+def render_paid_off(item: dict) -> str:
+    """
+    生成贷款/负债还清通知
+
+    Args:
+        item: expire_recurring_expenses 返回的一条记录
+    """
+    label = '贷款' if item['type'] == 'loan' else '负债'
+    msg = f'''🎉 恭喜还清！
+{label}「{item["name"]}」已于 {item["end_date"]} 到期'''
+    if item['total_amount']:
+        msg += f'\n💰 共 {item["total_months"]} 期，合计 {item["total_amount"]:,.0f} 元'
+    msg += '\n\n已从每日欠款中移除，继续加油！'
+    return msg
+
+
+def render_family_digest(items: list, members: list, totals: dict, recipient: str) -> str:
+    """
+    生成发给某位家庭成员的支出汇总通知
+
+    Args:
+        items: 发件箱中的通知（按记账先后）
+        members: get_family_members_detail 的返回值
+        totals: {openid: {'month_expense', 'daily_debt'}}，每次汇总只计算一次
+        recipient: 接收人，不包含本人记的账
+
+    Returns:
+        通知文本，没有需要告知的记录时返回 None
+    """
+    others = [item for item in items if item['openid'] != recipient]
+    if not others:
+        return None
+    
+    names = {}
+    for m in members:
+        names[m['openid']] = m['nickname'] or ('创建者' if m['role'] == 'creator' else '另一半')
+    
+    msg = '📢 家庭支出提醒' + (f'（共 {len(others)} 笔）' if len(others) > 1 else '')
+    actors = list(dict.fromkeys(item['openid'] for item in others))
+    for actor in actors:
+        msg += f'\n\n👤 {names.get(actor, "家庭成员")}'
+        for item in others:
+            if item['openid'] == actor:
+                msg += f'\n• {item["category"]} {item["amount"]:.2f} 元'
+                if item['description']:
+                    msg += f'（{item["description"]}）'
+        msg += f'''
+📊 本月累计支出：{totals[actor]["month_expense"]:.2f} 元
+🏠 每日固定欠款：{totals[actor]["daily_debt"]:.2f} 元'''
+    return msg
+
+
+def get_daily_push_data(openid: str) -> dict:
+    """
+    汇总每日推送所需的数据（客服消息和模板消息共用）
+
+    Returns:
+        {'date', 'net_income', 'daily_debt', 'monthly_debt', 'details', 'balance',
+         'family_name', 'family_ranking', 'family_daily', 'family_monthly', 'has_debt'}
+    """
     debt = get_daily_debt(openid)
     today_summary = get_today_summary(openid)
     family = get_user_family(openid)
+    ranking = get_family_debt_ranking(family['id']) if family else None
     
-    # 计算今日净收入（考虑固定开支）
+    # 计算今日净收入（考虑固定开支）：今日账本中自动入账的分期已按日均计入，不再重复扣除
     daily_debt = debt['daily_total']
-    today_income = today_summary['income']
-    today_expense = today_summary['expense']
-    net_income = today_income - today_expense - daily_debt
+    net_income = today_summary['income'] - (today_summary['expense'] - today_summary['recurring']) - daily_debt
+    family_daily = ranking['total_daily'] if ranking else 0
+    
+    return {
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'net_income': net_income,
+        'daily_debt': daily_debt,
+        'monthly_debt': debt['monthly_total'],
+        'details': debt['details'],
+        'balance': today_summary['balance'],
+        'family_name': family['name'] if family else None,
+        'family_ranking': ranking['ranking'] if ranking else [],
+        'family_daily': family_daily,
+        'family_monthly': ranking['total_monthly'] if ranking else 0,
+        'has_debt': daily_debt > 0 or family_daily > 0,
+    }
+
+
+def render_daily_push_message(data: dict) -> str:
+    """把每日推送数据渲染成客服消息文本"""
+    if not data['has_debt']:
+        return f'''☀️ 早安！
+
+昨日结余：{data["balance"]:.2f} 元
+
+还没有设置固定开支哦~
+发送「初始化」开始设置贷款和固定开支'''
     
-    # 生成推送消息
-    if daily_debt > 0 or (family and get_family_debt_ranking(family['id'])['total_daily'] > 0):
-        msg = f'''☀️ 早安！眼睛一睁
+    msg = f'''☀️ 早安！眼睛一睁
 
-💸 你今日的收入是：{net_income:,.2f} 元
+💸 你今日的收入是：{data["net_income"]:,.2f} 元
 
 📊 每日欠款明细：'''
-        
-        type_icons = {'loan': '🏠', 'debt': '💳', 'fixed': '📝'}
-        for d in debt['details']:
-            icon = type_icons.get(d['type'], '📌')
-            msg += f'\n{icon} {d["name"]}：-{d["daily"]:.2f}元'
-        
-        msg += f'''
+    
+    type_icons = {'loan': '🏠', 'debt': '💳', 'fixed': '📝'}
+    for d in data['details']:
+        icon = type_icons.get(d['type'], '📌')
+        msg += f'\n{icon} {d["name"]}：-{d["daily"]:.2f}元'
+    
+    msg += f'''
 
 ━━━━━━━━━━━━━━━━━
-📌 每日欠款：{daily_debt:.2f} 元
-📅 每月欠款：{debt["monthly_total"]:,.2f} 元'''
+📌 每日欠款：{data["daily_debt"]:.2f} 元
+📅 每月欠款：{data["monthly_debt"]:,.2f} 元'''
 
-        # 如果在家庭组中，添加家庭排行
-        if family:
-            ranking = get_family_debt_ranking(family['id'])
-            if ranking['total_daily'] > 0:
-                msg += f'''
+    # 如果在家庭组中，添加家庭排行
+    if data['family_daily'] > 0:
+        msg += f'''
 
 👨‍👩‍👧‍👦 家庭欠款排行：'''
-                medals = ['🥇', '🥈', '🥉']
-                for i, r in enumerate(ranking['ranking']):
-                    if r['daily'] > 0:
-                        medal = medals[i] if i < 3 else f'{i+1}.'
-                        nickname = r['nickname'] or r['openid'][:8]
-                        msg += f'\n{medal} {nickname}：-{r["daily"]:.2f}元/日'
-                
-                msg += f'''
-
-💰 全家每日：{ranking["total_daily"]:.2f} 元
-📅 全家每月：{ranking["total_monthly"]:,.2f} 元'''
-        
-        msg += '\n\n💪 努力搬砖，今天也要加油！'
-    else:
-        msg = f'''☀️ 早安！
-
-昨日结余：{today_summary["balance"]:.2f} 元
+        medals = ['🥇', '🥈', '🥉']
+        for i, r in enumerate(data['family_ranking']):
+            if r['daily'] > 0:
+                medal = medals[i] if i < 3 else f'{i+1}.'
+                nickname = r['nickname'] or r['openid'][:8]
+                msg += f'\n{medal} {nickname}：-{r["daily"]:.2f}元/日'
+        
+        msg += f'''
 
-还没有设置固定开支哦~
-发送「初始化」开始设置贷款和固定开支'''
+💰 全家每日：{data["family_daily"]:.2f} 元
+📅 全家每月：{data["family_monthly"]:,.2f} 元'''
     
+    msg += '\n\n💪 努力搬砖，今天也要加油！'
     return msg
+
+
+def get_daily_push_message(openid: str) -> str:
+    """生成每日推送消息"""
+    return render_daily_push_message(get_daily_push_data(openid))
@@ -0,0 +1,217 @@
+"""
+微信消息收发模块
+
+公众号服务器收到的消息和返回的被动回复都在这里处理：
+- 解析：公众号消息是一层平铺的 XML，用一个预编译的正则顺序扫描各字段，不构建 DOM，也不处理 DTD/实体定义
+- 回复：文本回复直接按模板渲染
+- 安全模式（AES）：消息体为 Encrypt 字段，校验 msg_signature 后解密；回复加密后再签名。
+  兼容模式下明文字段和 Encrypt 同时存在，请求带 encrypt_type=aes 时按密文处理并加密回复
+
+AES 密钥和 Cipher 对象每个进程只构建一次（get_context），每条消息只创建一次性的加解密上下文。
+性能对比：python3 wechat_message.py
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import re
+import struct
+import threading
+import time
+from xml.sax.saxutils import unescape
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from config import WECHAT_TOKEN, WECHAT_APP_ID, WECHAT_ENCODING_AES_KEY
+
+
+# 平铺字段：<Name><![CDATA[值]]></Name> 或 <Name>值</Name>（嵌套的外层元素不匹配，内层字段照常取出）
+FIELD_PATTERN = re.compile(r'<(\w+)>\s*(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))\s*</\1>', re.S)
+
+TEXT_REPLY = ('<xml><ToUserName><![CDATA[{to}]]></ToUserName>'
+              '<FromUserName><![CDATA[{source}]]></FromUserName>'
+              '<CreateTime>{time}</CreateTime>'
+              '<MsgType><![CDATA[text]]></MsgType>'
+              '<Content><![CDATA[{content}]]></Content></xml>')
+
+ENCRYPTED_REPLY = ('<xml><Encrypt><![CDATA[{encrypt}]]></Encrypt>'
+                   '<MsgSignature><![CDATA[{signature}]]></MsgSignature>'
+                   '<TimeStamp>{timestamp}</TimeStamp>'
+                   '<Nonce><![CDATA[{nonce}]]></Nonce></xml>')
+
+# 微信的 PKCS#7 补位按 32 字节分块
+BLOCK_SIZE = 32
+
+# 进程内的加解密上下文（首次使用时构建）
+_context = None
+_context_lock = threading.Lock()
+
+
+class MessageCryptoError(Exception):
+    """密文消息无法校验或解密"""
+    pass
+
+
+def parse_xml(data) -> dict:
+    """
+    解析公众号消息 XML
+
+    Returns:
+        {字段名: 文本}，字段名与微信文档一致（ToUserName、MsgType、Content、Event 等）
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    message = {}
+    for name, cdata, text in FIELD_PATTERN.findall(data):
+        message[name] = cdata if cdata or not text else unescape(text).strip()
+    return message
+
+
+def message_event(message: dict) -> str:
+    """事件名（小写）；未关注用户扫码关注记为 subscribe_scan，与 wechatpy 一致"""
+    event = message.get('Event', '').lower()
+    if event == 'subscribe' and message.get('EventKey', '').startswith('qrscene_'):
+        return 'subscribe_scan'
+    return event
+
+
+def render_text_reply(message: dict, content: str) -> str:
+    """渲染文本被动回复（发回给消息的发送者）"""
+    return TEXT_REPLY.format(
+        to=message.get('FromUserName', ''),
+        source=message.get('ToUserName', ''),
+        time=int(time.time()),
+        content=content.replace(']]>', ']]]]><![CDATA[>'),
+    )
+
+
+def get_context() -> dict:
+    """
+    获取本进程的加解密上下文
+
+    Returns:
+        {'cipher': AES-256-CBC Cipher（IV 为密钥前 16 字节）, 'app_id': bytes}
+    """
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                if not WECHAT_ENCODING_AES_KEY:
+                    raise MessageCryptoError('未配置 WECHAT_ENCODING_AES_KEY')
+                key = base64.b64decode(WECHAT_ENCODING_AES_KEY + '=')
+                if len(key) != 32:
+                    raise MessageCryptoError('EncodingAESKey 长度应为 43 个字符')
+                _context = {
+                    'cipher': Cipher(algorithms.AES(key), modes.CBC(key[:16])),
+                    'app_id': WECHAT_APP_ID.encode('utf-8'),
+                }
+    return _context
+
+
+def reset_context():
+    """丢弃缓存的上下文（修改密钥配置后调用）"""
+    global _context
+    _context = None
+
+
+def sign(*parts) -> str:
+    """消息签名：各部分字典序排序后拼接取 SHA1"""
+    return hashlib.sha1(''.join(sorted(str(part) for part in parts)).encode('utf-8')).hexdigest()
+
+
+def check_msg_signature(msg_signature: str, timestamp: str, nonce: str, encrypt: str) -> bool:
+    """校验密文消息的 msg_signature"""
+    return hmac.compare_digest(sign(WECHAT_TOKEN, timestamp, nonce, encrypt), msg_signature or '')
+
+
+def encrypt(text: str) -> str:
+    """加密：16 字节随机数 + 4 字节长度（网络字节序）+ 明文 + AppID，补位后 AES 加密并 Base64"""
+    context = get_context()
+    body = text.encode('utf-8')
+    plain = os.urandom(16) + struct.pack('>I', len(body)) + body + context['app_id']
+    pad = BLOCK_SIZE - len(plain) % BLOCK_SIZE
+    encryptor = context['cipher'].encryptor()
+    return base64.b64encode(encryptor.update(plain + bytes([pad]) * pad) + encryptor.finalize()).decode('ascii')
+
+
+def decrypt(encrypted: str) -> str:
+    """解密 Encrypt 字段，校验 AppID 后返回明文 XML"""
+    context = get_context()
+    try:
+        data = base64.b64decode(encrypted)
+        decryptor = context['cipher'].decryptor()
+        plain = decryptor.update(data) + decryptor.finalize()
+    except ValueError as e:
+        raise MessageCryptoError(f'解密失败: {e}')
+    pad = plain[-1] if plain else 0
+    if not 1 <= pad <= BLOCK_SIZE or len(plain) < 20 + pad:
+        raise MessageCryptoError('补位错误')
+    content = plain[16:-pad]
+    length = struct.unpack('>I', content[:4])[0]
+    if content[4 + length:] != context['app_id']:
+        raise MessageCryptoError('AppID 不匹配')
+    return content[4:4 + length].decode('utf-8')
+
+
+def decrypt_message(data, msg_signature: str, timestamp: str, nonce: str) -> dict:
+    """校验签名并解密安全模式 / 兼容模式的消息，返回解析后的明文字段"""
+    encrypted = parse_xml(data).get('Encrypt')
+    if not encrypted:
+        raise MessageCryptoError('消息中没有 Encrypt 字段')
+    if not check_msg_signature(msg_signature, timestamp, nonce, encrypted):
+        raise MessageCryptoError('msg_signature 校验失败')
+    return parse_xml(decrypt(encrypted))
+
+
+def encrypt_reply(reply: str, nonce: str, timestamp: str = None) -> str:
+    """加密被动回复并签名"""
+    timestamp = timestamp or str(int(time.time()))
+    encrypted = encrypt(reply)
+    return ENCRYPTED_REPLY.format(
+        encrypt=encrypted,
+        signature=sign(WECHAT_TOKEN, timestamp, nonce, encrypted),
+        timestamp=timestamp,
+        nonce=nonce,
+    )
+
+
+def benchmark(rounds: int = 20000) -> dict:
+    """与 wechatpy 对比解析、回复和加解密的单次耗时（微秒）"""
+    from wechatpy import parse_message, create_reply
+    from wechatpy.crypto import WeChatCrypto
+
+    xml = ('<xml><ToUserName><![CDATA[gh_test]]></ToUserName>'
+           '<FromUserName><![CDATA[o_benchmark_user]]></FromUserName>'
+           '<CreateTime>1700000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+           '<Content><![CDATA[支出 35 星巴克拿铁]]></Content><MsgId>1234567890123456</MsgId></xml>')
+    reply_text = '✅ 已记录支出 35.00 元\n分类：餐饮'
+    crypto = WeChatCrypto(WECHAT_TOKEN, WECHAT_ENCODING_AES_KEY, WECHAT_APP_ID)
+    encrypted_xml = crypto.encrypt_message(xml, 'nonce', '1700000000')
+    signature = parse_xml(encrypted_xml)['MsgSignature']
+
+    def timed(fn) -> float:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        return round((time.perf_counter() - start) / rounds * 1e6, 2)
+
+    return {
+        'parse': (timed(lambda: parse_xml(xml)), timed(lambda: parse_message(xml))),
+        'reply': (timed(lambda: render_text_reply(parse_xml(xml), reply_text)),
+                  timed(lambda: create_reply(reply_text, parse_message(xml)).render())),
+        'decrypt': (timed(lambda: decrypt_message(encrypted_xml, signature, '1700000000', 'nonce')),
+                    timed(lambda: parse_message(crypto.decrypt_message(encrypted_xml, signature,
+                                                                       '1700000000', 'nonce')))),
+        'encrypt': (timed(lambda: encrypt_reply(xml, 'nonce')),
+                    timed(lambda: crypto.encrypt_message(xml, 'nonce'))),
+    }
+
+
+if __name__ == '__main__':
+    # 未配置密钥时用随机密钥测试
+    if not WECHAT_ENCODING_AES_KEY:
+        WECHAT_ENCODING_AES_KEY = base64.b64encode(os.urandom(32)).decode('ascii')[:43]
+    print(f"{'':10}{'本模块(μs)':>12}{'wechatpy(μs)':>14}")
+    for name, (ours, theirs) in benchmark().items():
+        print(f"{name:10}{ours:>12}{theirs:>14}")